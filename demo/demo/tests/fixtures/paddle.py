@@ -1,7 +1,17 @@
+from __future__ import annotations
+
+import json
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep
+
 import pytest
 
 from subscriptions.models import SubscriptionPayment
 from subscriptions.providers import get_provider, get_providers
+from subscriptions.providers.circuit_breakers import get_provider_circuit_breaker
+from subscriptions.providers.limits import get_provider_limiter
 from subscriptions.providers.paddle import PaddleProvider
 
 from ..helpers import usd
@@ -14,6 +24,8 @@ def paddle(settings) -> str:
     ]
     get_provider.cache_clear()
     get_providers.cache_clear()
+    get_provider_circuit_breaker.cache_clear()  # don't inherit failures from other tests
+    get_provider_limiter.cache_clear()
     provider = get_provider()
     assert isinstance(provider, PaddleProvider)
     return provider
@@ -84,3 +96,76 @@ def paddle_webhook_payload(db, paddle, paddle_unconfirmed_payment) -> dict:
 @pytest.fixture
 def paddle_test_email(settings) -> str:
     return settings.PADDLE_TEST_EMAIL
+
+
+class FakePaddleHandler(BaseHTTPRequestHandler):
+    """ Minimal Paddle API: one-off charges and webhook history (filtered by `created_at`, if present). """
+
+    server: FakePaddleServer
+
+    def do_POST(self):
+        path = self.path.removeprefix(self.server.PREFIX)
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+        self.server.requests.append((path, payload))
+
+        if match := re.fullmatch(r'/subscription/(\d+)/charge', path):
+            sleep(self.server.charge_delay)
+            response = {'invoice_id': len(self.server.requests), 'subscription_id': int(match[1]), 'status': self.server.charge_status}
+        elif path == '/alert/webhooks':
+            page, per_page = payload.get('page', 1), self.server.alerts_per_page
+            alerts = [
+                alert for alert in self.server.alerts
+                if 'created_at' not in alert
+                or payload.get('query_tail', '') <= alert['created_at'] <= payload.get('query_head', '9999')
+            ]
+            response = {
+                'current_page': page,
+                'total_pages': max(1, -(-len(alerts) // per_page)),
+                'alerts_per_page': per_page,
+                'total_alerts': len(alerts),
+                'data': alerts[(page - 1) * per_page:page * per_page],
+            }
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps({'success': True, 'response': response}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakePaddleServer(ThreadingHTTPServer):
+    PREFIX = '/api/2.0'
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakePaddleHandler)
+        self.requests: list[tuple[str, dict]] = []
+        self.charge_status = 'success'
+        self.charge_delay = 0.
+        self.alerts: list[dict] = []
+        self.alerts_per_page = 2
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_port}{self.PREFIX}'
+
+
+@pytest.fixture
+def paddle_server(paddle, monkeypatch) -> FakePaddleServer:
+    server = FakePaddleServer()
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(paddle, 'endpoint', server.url)
+    monkeypatch.setattr(paddle._api, 'endpoint', server.url)
+    yield server
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,105 @@
+"""
+Benchmarks are skipped by default; run them with
+
+    BENCHMARK=1 pytest -s demo/demo/tests/test_benchmarks.py
+"""
+
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from itertools import count
+from time import perf_counter
+from uuid import uuid4
+
+import pytest
+from dateutil.relativedelta import relativedelta
+from django.contrib.auth import get_user_model
+
+from subscriptions.models import Subscription, SubscriptionPayment
+from subscriptions.periods import as_period, relativedelta_to_dict
+from subscriptions.reports import HOURLY, SubscriptionsReport, TransactionsReport, generate_reports
+
+pytestmark = pytest.mark.skipif(not os.environ.get('BENCHMARK'), reason='set BENCHMARK=1 to run benchmarks')
+
+YEAR_START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+YEAR_END = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def year_of_data(plan, paddle):
+    random.seed(0)
+    users = get_user_model().objects.bulk_create(get_user_model()(username=f'user{i}') for i in range(1000))
+    year_seconds = int((YEAR_END - YEAR_START).total_seconds())
+
+    subscriptions = Subscription.objects.bulk_create(
+        Subscription(
+            user=user,
+            plan=plan,
+            start=(start := YEAR_START + timedelta(seconds=random.randrange(year_seconds))),
+            end=start + timedelta(days=random.randint(1, 90)),
+            auto_prolong=False,
+        )
+        for user in users
+        for _ in range(5)
+    )
+    SubscriptionPayment.objects.bulk_create(
+        SubscriptionPayment(
+            uid=uuid4(),
+            provider_codename=paddle.codename,
+            user_id=subscription.user_id,
+            plan=plan,
+            subscription=subscription,
+            amount=plan.charge_amount,
+            status=random.choice(SubscriptionPayment.Status.values),
+            created=subscription.start,
+            updated=subscription.start,
+        )
+        for subscription in subscriptions
+    )
+
+
+@pytest.mark.django_db(databases=['actual_db'], transaction=True)
+def test__benchmark__generate_reports__hourly_year(year_of_data, paddle):
+    periods = list(SubscriptionsReport.iter_period_bounds(HOURLY, since=YEAR_START, until=YEAR_END))
+    assert len(periods) == 365 * 24
+
+    cases = [
+        (SubscriptionsReport, ['get_new_count', 'get_active_count'], {}),
+        (TransactionsReport, ['get_payments_count_by_status', 'get_completed_payments_total_by_currency'], {'provider_codename': paddle.codename}),
+    ]
+    for report_cls, methods, kwargs in cases:
+        expected = None
+        for workers, processes in [(1, False), (8, False), (8, True)]:
+            start = perf_counter()
+            results = [values for _, values in generate_reports(report_cls, periods, methods, workers=workers, processes=processes, **kwargs)]
+            duration = perf_counter() - start
+
+            print(f'{report_cls.__name__}: {len(periods)} hourly periods, {workers=}, {processes=}: {duration:.1f}s')
+            assert results == (expected := expected or results)
+
+
+def test__benchmark__periods():
+    start = datetime(2023, 1, 31, tzinfo=timezone.utc)
+    at = datetime(2043, 1, 1, tzinfo=timezone.utc)
+    repeat = 20000
+
+    for period in (relativedelta(months=1), relativedelta(days=1)):
+        compiled, value = as_period(period), relativedelta_to_dict(period)  # value is what is loaded from db
+        expected = next(i for i in count() if start + i * period >= at)
+
+        cases = {
+            'relativedelta boundaries': lambda: [start + i * period for i in range(100)],
+            'Period.nth_boundary': lambda: [compiled.nth_boundary(start, i) for i in range(100)],
+            'relativedelta(**value)': lambda: [relativedelta(**value) for _ in range(100)],
+            'as_period(value)': lambda: [as_period(value) for _ in range(100)],
+        }
+        for name, fn in cases.items():
+            start_time = perf_counter()
+            for _ in range(repeat // 100):
+                fn()
+            print(f'{period}: {name}: {(perf_counter() - start_time) / repeat * 1e6:.2f}us per call')
+
+        start_time = perf_counter()
+        for _ in range(100):
+            assert compiled.index_at(start, at) == expected
+        print(f'{period}: Period.index_at {expected} periods away: {(perf_counter() - start_time) / 100 * 1e6:.2f}us per call')
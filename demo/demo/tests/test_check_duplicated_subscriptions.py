@@ -1,7 +1,10 @@
 import pytest
+from django.utils.timezone import now
 
 from subscriptions.models import Subscription, SubscriptionPayment
-from subscriptions.tasks import check_duplicated_payments
+from subscriptions.tasks import check_duplicated_payments, iter_duplicated_payments
+
+from .helpers import days
 
 
 @pytest.mark.django_db(databases=['actual_db'])
@@ -94,3 +97,47 @@ def test__duplicates__duplicated_transactions(user, plan):
     assert ('test-1', 'transaction-1') in results
     entries = results[('test-1', 'transaction-1')]
     assert {payment_1.uid, payment_2.uid} == set([entry.uid for entry in entries])
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__duplicates__since(user, plan):
+    for transaction_id, created in [
+        ('transaction-1', now() - days(10)),
+        ('transaction-1', now() - days(9)),
+        ('transaction-2', now() - days(10)),
+        ('transaction-2', now() - days(1)),
+        ('transaction-3', None),
+        ('transaction-3', None),
+    ]:
+        payment = SubscriptionPayment.objects.create(
+            user=user,
+            plan=plan,
+            provider_codename='test-1',
+            provider_transaction_id=transaction_id,
+        )
+        if created:
+            SubscriptionPayment.objects.filter(pk=payment.pk).update(created=created)
+
+    assert set(check_duplicated_payments()) == {('test-1', 'transaction-1'), ('test-1', 'transaction-2'), ('test-1', 'transaction-3')}
+
+    # older payments of recently duplicated transactions are reported as well
+    results = check_duplicated_payments(since=now() - days(2))
+    assert set(results) == {('test-1', 'transaction-2'), ('test-1', 'transaction-3')}
+    assert len(results[('test-1', 'transaction-2')]) == 2
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__duplicates__chunks(user, plan):
+    for idx in range(5):
+        for _ in range(idx % 3 + 1):
+            SubscriptionPayment.objects.create(
+                user=user,
+                plan=plan,
+                provider_codename='test-1',
+                provider_transaction_id=f'transaction-{idx}',
+            )
+
+    assert [
+        (transaction_id, len(entries))
+        for (_, transaction_id), entries in iter_duplicated_payments(chunk_size=2)
+    ] == [('transaction-1', 2), ('transaction-2', 3), ('transaction-4', 2)]
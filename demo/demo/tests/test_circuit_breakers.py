@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import timedelta
+from unittest import mock
+
+import pytest
+import requests
+from requests import Response
+
+from subscriptions.exceptions import PaymentError, ProviderUnavailable
+from subscriptions.providers.circuit_breakers import (
+    CircuitBreaker,
+    CircuitState,
+    get_provider_circuit_breaker,
+)
+from subscriptions.providers.paddle.api import Paddle
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.
+
+    def __call__(self) -> float:
+        return self.time
+
+
+@pytest.fixture
+def clock() -> FakeClock:
+    return FakeClock()
+
+
+@pytest.fixture
+def breaker(clock) -> CircuitBreaker:
+    return CircuitBreaker(
+        name='test',
+        failure_rate=0.5,
+        min_calls=4,
+        window=timedelta(seconds=60),
+        reset_timeout=timedelta(seconds=30),
+        clock=clock,
+    )
+
+
+def fail():
+    raise ConnectionError()
+
+
+def succeed():
+    return 'ok'
+
+
+def test__circuit_breakers__opens_on_failure_rate(breaker):
+    for fn in (succeed, fail, succeed):
+        with pytest.raises(ConnectionError) if fn is fail else mock.MagicMock():
+            breaker.call(fn)
+    assert breaker.state == CircuitState.CLOSED
+
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.state == CircuitState.OPEN
+
+    called = mock.Mock()
+    with pytest.raises(ProviderUnavailable):
+        breaker.call(called)
+    assert not called.called
+
+
+def test__circuit_breakers__old_failures_are_forgotten(breaker, clock):
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+
+    clock.time += 61
+    breaker.call(succeed)
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test__circuit_breakers__result_failure(breaker):
+    for _ in range(4):
+        breaker.call(succeed, is_failure=lambda result: result == 'ok')
+    assert breaker.state == CircuitState.OPEN
+
+
+def test__circuit_breakers__half_open(breaker, clock):
+    for _ in range(4):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    assert breaker.state == CircuitState.OPEN
+
+    # trial call fails -> open again
+    clock.time += 30
+    assert breaker.state == CircuitState.HALF_OPEN
+    with pytest.raises(ConnectionError):
+        breaker.call(fail)
+    assert breaker.state == CircuitState.OPEN
+
+    # only limited number of trial calls is allowed
+    clock.time += 30
+    breaker.before_call()
+    with pytest.raises(ProviderUnavailable):
+        breaker.before_call()
+    breaker.record(is_success=True)
+    assert breaker.state == CircuitState.CLOSED
+
+    # all calls pass when circuit is closed
+    for _ in range(10):
+        breaker.call(succeed)
+
+
+def test__circuit_breakers__half_open__cancelled_trial(breaker, clock):
+    for _ in range(4):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    clock.time += 30
+
+    async def run():
+        trial = asyncio.create_task(breaker.acall(asyncio.sleep, 10))
+        await asyncio.sleep(0)
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+
+    # cancelled trial call gives back its slot, so the next call is a trial call
+    asyncio.run(run())
+    assert breaker.state == CircuitState.HALF_OPEN
+    breaker.call(succeed)
+    assert breaker.state == CircuitState.CLOSED
+
+    # same for interrupted sync calls
+    for _ in range(4):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    clock.time += 30
+
+    def interrupt():
+        raise KeyboardInterrupt()
+
+    with pytest.raises(KeyboardInterrupt):
+        breaker.call(interrupt)
+    breaker.call(succeed)
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test__circuit_breakers__disabled(clock):
+    breaker = CircuitBreaker(enabled=False, min_calls=1, clock=clock)
+    for _ in range(10):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail)
+    assert breaker.state == CircuitState.CLOSED
+
+
+def test__circuit_breakers__provider_unavailable_is_payment_error():
+    assert issubclass(ProviderUnavailable, PaymentError)
+
+
+def test__circuit_breakers__from_settings(settings):
+    settings.SUBSCRIPTIONS_PROVIDER_CIRCUIT_BREAKERS = {
+        'paddle': {'min_calls': 100},
+    }
+    get_provider_circuit_breaker.cache_clear()
+
+    breaker = get_provider_circuit_breaker('paddle')
+    assert breaker.name == 'paddle'
+    assert breaker.min_calls == 100
+    assert breaker.failure_rate == 0.5
+    assert get_provider_circuit_breaker('paddle') is breaker
+
+    get_provider_circuit_breaker.cache_clear()
+
+
+def test__circuit_breakers__paddle_stops_retrying_when_open(clock):
+    breaker = CircuitBreaker(min_calls=3, clock=clock)
+    api = Paddle(vendor_id=1, vendor_auth_code='secret', circuit_breaker=breaker)
+
+    response = Response()
+    response.status_code = requests.codes.service_unavailable
+    with mock.patch.object(api._session, 'request', return_value=response) as request, \
+         mock.patch('tenacity.nap.time.sleep'):
+        with pytest.raises(ProviderUnavailable):
+            api.request('get', '/subscription/plans')
+
+    assert request.call_count == 3
@@ -6,12 +6,13 @@ from datetime import datetime, timedelta
 from itertools import count, product
 from operator import attrgetter
 from time import sleep
+from unittest import mock
 
 import pytest
 from dateutil.parser import parse
 from dateutil.relativedelta import relativedelta
 from django.core.cache import caches
-from django.db import connections
+from django.db import DatabaseError, connections
 from django.utils.timezone import now
 from djmoney.money import Money
 from freezegun import freeze_time
@@ -22,9 +23,12 @@ from subscriptions.functions import (
     get_cache_name,
     get_default_features,
     get_remaining_amount,
+    iter_remaining_amounts,
     iter_subscriptions_involved,
     merge_feature_sets,
+    record_usages,
     use_resource,
+    UsageBuffer,
 )
 from subscriptions.models import (
     INFINITY,
@@ -349,6 +353,81 @@ def test__function__use_resource(user, subscription, quota, resource, remains):
             pass
 
 
+@pytest.mark.django_db(databases=['actual_db'])
+def test__function__record_usages(cache_backend, user, subscription, quota, resource, remains, django_assert_num_queries):
+    at = subscription.start + timedelta(hours=1)
+    assert remains(at=at + timedelta(hours=1)) == 100  # cached remaining chunks
+
+    usages = (Usage(user=user, resource=resource, amount=1, datetime=at) for _ in range(30))
+    with django_assert_num_queries(3 + 2, connection=connections['actual_db']):  # batches + savepoint
+        assert record_usages(usages, batch_size=10) == 30
+
+    # cache is dropped, because it doesn't include older usages
+    assert caches[get_cache_name()].get(user.pk) is None
+    assert remains(at=at + timedelta(hours=1)) == 70
+
+    # usages are inserted in a single transaction: first batch is rolled back when second one fails
+    bulk_create = Usage.objects.bulk_create
+    batches = count()
+
+    def fail_second_batch(batch):
+        if next(batches) == 1:
+            raise DatabaseError('connection lost')
+        return bulk_create(batch)
+
+    usages = [Usage(user=user, resource=resource, amount=1, datetime=at) for _ in range(30)]
+    with mock.patch.object(Usage.objects, 'bulk_create', side_effect=fail_second_batch):
+        with pytest.raises(DatabaseError):
+            record_usages(usages, batch_size=10)
+    assert Usage.objects.count() == 30
+
+
+@pytest.mark.django_db(transaction=True, databases=['actual_db'])
+def test__function__usage_buffer(user, subscription, quota, resource, remains):
+    buffer = UsageBuffer(max_size=3, max_delay=timedelta(seconds=60))
+
+    # buffered usages are not in the database, but quota checks take them into account
+    with buffer.use_resource(user, resource, 40) as left:
+        assert left == 60
+    with buffer.use_resource(user, resource, 40) as left:
+        assert left == 20
+    assert remains() == 100
+    assert buffer.get_pending_amount(user.pk, resource.pk) == 80
+
+    with pytest.raises(QuotaLimitExceeded):
+        with buffer.use_resource(user, resource, 40):
+            pass
+
+    # usage is not recorded if the block raises
+    with pytest.raises(ValueError):
+        with buffer.use_resource(user, resource, 10):
+            raise ValueError()
+    assert buffer.get_pending_amount(user.pk, resource.pk) == 80
+
+    # failed flush is retried without duplicating usages
+    with mock.patch('subscriptions.functions.record_usages', side_effect=DatabaseError('connection lost')):
+        with pytest.raises(DatabaseError):
+            buffer.flush()
+    assert buffer.get_pending_amount(user.pk, resource.pk) == 80
+    assert remains() == 100
+
+    # flushed by size
+    with buffer.use_resource(user, resource, 10) as left:
+        assert left == 10
+    assert remains() == 10
+    assert buffer.get_pending_amount(user.pk, resource.pk) == 0
+    assert buffer.flush() == 0
+
+    # flushed by time
+    buffer.max_delay = timedelta(milliseconds=100)
+    with buffer.use_resource(user, resource, 5):
+        pass
+    assert remains() == 10
+    sleep(1)
+    assert remains() == 5
+    assert Usage.objects.count() == 4
+
+
 @pytest.mark.django_db(transaction=True, databases=['actual_db'])
 def test__function__use_resource__hard_db_lock(user, subscription, quota, resource, remains):
     num_parallel_threads = 8
@@ -388,6 +467,35 @@ def test__function__use_resource__hard_db_lock(user, subscription, quota, resour
             assert usage.resource == resource
 
 
+@pytest.mark.django_db(databases=['actual_db'])
+def test__functions__iter_remaining_amounts(user, two_subscriptions, resource, django_assert_max_num_queries):
+    now_ = two_subscriptions[0].start
+
+    # another subscription after a gap
+    Subscription.objects.create(user=user, plan=two_subscriptions[0].plan, start=now_ + days(20), end=now_ + days(30))
+    Usage.objects.create(user=user, resource=resource, amount=30, datetime=now_ + days(21))
+
+    since, until = now_ - days(1), now_ + days(32)
+    with django_assert_max_num_queries(10, connection=connections['actual_db']):
+        series = list(iter_remaining_amounts(user=user, since=since, until=until, step=timedelta(hours=6)))
+
+    assert len(series) == 33 * 4 + 1
+    assert series[0][0] == since and series[-1][0] == until
+    for point, amount in series:
+        assert amount == get_remaining_amount(user=user, at=point), point
+
+    # sample points
+    points = [now_, now_ + days(1), now_ + days(6), now_ + days(21), now_ + days(40)]
+    assert [
+        amount.get(resource, 0)
+        for _, amount in iter_remaining_amounts(user=user, points=points)
+    ] == [100, 50, 50, 70, 0]
+
+    assert list(iter_remaining_amounts(user=user, points=[])) == []
+    with pytest.raises(AssertionError):
+        list(iter_remaining_amounts(user=user, points=[now_, now_ - days(1)]))
+
+
 @pytest.mark.django_db(databases=['actual_db'])
 def test__functions__cache_backend_correctness(cache_backend, user, two_subscriptions, remains, resource):
     now_ = two_subscriptions[0].start
@@ -676,3 +784,45 @@ def test_resource_refresh_moments(subscription, resource, remains, refreshes):
     # No matter what we assume, if at given moment there is no subscription, we cannot assume anything about the future.
     assert refreshes(at=subscription.start + days(3), assume_subscription_refresh=False) is None
     assert refreshes(at=subscription.start + days(3)) is None
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test_resource_refresh_moments__cache(cache_backend, subscription, resource, refreshes, django_assert_num_queries):
+    subscription.end = subscription.start + days(30)
+    subscription.save(update_fields=['end'])
+
+    quota = Quota.objects.create(
+        plan=subscription.plan,
+        resource=resource,
+        limit=1,
+        recharge_period=days(7),
+    )
+
+    assert refreshes(at=subscription.start + timedelta(days=1)) == subscription.start + days(7)
+
+    # cached until the earliest refresh moment
+    with django_assert_num_queries(0, connection=connections['actual_db']):
+        assert refreshes(at=subscription.start + timedelta(days=3)) == subscription.start + days(7)
+        assert refreshes(at=subscription.start + days(7)) == subscription.start + days(7)
+
+    # not cached after it
+    with django_assert_num_queries(3, connection=connections['actual_db']):
+        assert refreshes(at=subscription.start + timedelta(days=7, seconds=1)) == subscription.start + days(14)
+
+    # changing quotas drops cache
+    quota.recharge_period = days(5)
+    quota.save()
+    assert refreshes(at=subscription.start + timedelta(days=7, seconds=2)) == subscription.start + days(10)
+
+    # changing subscriptions drops cache
+    subscription.end = subscription.start + days(8)
+    subscription.save(update_fields=['end'])
+    assert refreshes(at=subscription.start + timedelta(days=7, seconds=3), assume_subscription_refresh=False) is None
+
+    # refresh moments are found without iterating over all periods since subscription start
+    subscription.end = subscription.start + days(365 * 1000)
+    subscription.save(update_fields=['end'])
+    at = subscription.start + timedelta(days=365 * 500, seconds=1)
+    moment = refreshes(at=at)
+    assert at <= moment < at + timedelta(days=5)
+    assert (moment - subscription.start) % timedelta(days=5) == timedelta(0)
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+from unittest import mock
+
+import pytest
+from requests import Response
+from tenacity import RetryError
+
+from subscriptions.providers.limits import ProviderLimiter, TokenBucket, get_provider_limiter
+from subscriptions.providers.paddle.api import Paddle
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.
+
+    def __call__(self) -> float:
+        return self.time
+
+    def sleep(self, seconds: float):
+        self.time += seconds
+
+
+def test__limits__token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock, sleep=clock.sleep)
+
+    # burst
+    for _ in range(3):
+        assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+    # sustained rate
+    for _ in range(4):
+        bucket.acquire()
+    assert clock.time == pytest.approx(2)
+
+    # bucket doesn't hold more than capacity
+    clock.time += 100
+    for _ in range(3):
+        assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() > 0
+
+
+def test__limits__token_bucket__drain():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, capacity=10, clock=clock, sleep=clock.sleep)
+    bucket.drain()
+    assert bucket.try_acquire() == pytest.approx(1)
+
+
+def test__limits__max_concurrency():
+    limiter = ProviderLimiter(max_concurrency=2)
+    lock = Lock()
+    num_running = max_running = 0
+
+    @limiter.limit
+    def request():
+        nonlocal num_running, max_running
+        with lock:
+            num_running += 1
+            max_running = max(max_running, num_running)
+        sleep(0.01)
+        with lock:
+            num_running -= 1
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for _ in range(16):
+            pool.submit(request)
+
+    assert max_running == 2
+
+
+def test__limits__async_waiters_are_woken_in_order():
+    real_sleep = asyncio.sleep
+
+    for limits in ({'max_concurrency': 1}, {'rate': 1, 'burst': 1}, {'rate': 1, 'burst': 1, 'max_concurrency': 2}):
+        clock = FakeClock()
+        limiter = ProviderLimiter(**limits)
+        if limiter._bucket:
+            limiter._bucket = TokenBucket(rate=1, capacity=1, clock=clock, sleep=clock.sleep)
+
+        sleeps, order = [], []
+
+        async def fake_sleep(delay):
+            sleeps.append(delay)
+            clock.time += delay
+            await real_sleep(0)
+
+        async def request(i):
+            async with limiter:
+                order.append(i)
+                await real_sleep(0)
+
+        async def run():
+            await asyncio.gather(*(request(i) for i in range(10)))
+
+        with mock.patch('asyncio.sleep', fake_sleep):
+            asyncio.run(run())
+
+        assert order == list(range(10))
+
+        # no polling: waiters sleep only while waiting for a token, one at a time
+        assert sleeps == ([pytest.approx(1)] * 9 if limiter._bucket else [])
+
+
+def test__limits__async_cancelled_waiter():
+    limiter = ProviderLimiter(rate=1, burst=1, max_concurrency=1)
+
+    async def run():
+        async with limiter:
+            pass
+
+        # both the slot and the token lock are held by the first waiter
+        waiter = asyncio.create_task(limiter.__aenter__())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+
+        semaphore, bucket_lock = limiter._get_loop_limits()
+        assert not semaphore.locked() and not bucket_lock.locked()
+
+    asyncio.run(run())
+
+
+def test__limits__no_limits():
+    limiter = ProviderLimiter()
+    for _ in range(1000):
+        with limiter:
+            pass
+
+
+def test__limits__provider_limiter_from_settings(settings, paddle):
+    settings.SUBSCRIPTIONS_PROVIDER_LIMITS = {
+        'paddle': {'rate': 5, 'burst': 10, 'max_concurrency': 3},
+    }
+    get_provider_limiter.cache_clear()
+
+    limiter = get_provider_limiter('paddle')
+    assert limiter == ProviderLimiter(rate=5, burst=10, max_concurrency=3)
+    assert get_provider_limiter('paddle') is limiter
+    assert get_provider_limiter('dummy') == ProviderLimiter()
+
+    get_provider_limiter.cache_clear()
+
+
+def test__limits__paddle_requests_are_limited():
+    limiter = ProviderLimiter(rate=1)
+    api = Paddle(vendor_id=1, vendor_auth_code='secret', limiter=limiter)
+
+    response = Response()
+    response.status_code = 429
+    with mock.patch.object(api._session, 'request', return_value=response) as request, \
+         mock.patch.object(limiter._bucket, 'acquire') as acquire, \
+         mock.patch.object(limiter, 'throttled') as throttled, \
+         mock.patch('tenacity.nap.time.sleep'):
+        with pytest.raises(RetryError):
+            api.request('get', '/subscription/plans')
+
+    assert request.call_count == acquire.call_count == throttled.call_count == 10
@@ -1,12 +1,14 @@
+import asyncio
 import json
 import re
-from datetime import date, timedelta
+from datetime import date, timedelta, timezone
 from unittest import mock
 from urllib import parse
 
 import pytest
 import requests
 from dateutil.relativedelta import relativedelta
+from django.db import DatabaseError
 from django.test.client import MULTIPART_CONTENT
 from django.utils.timezone import now
 from djmoney.money import Money
@@ -16,12 +18,15 @@ from requests import Response
 from tenacity import Retrying, TryAgain, stop_after_attempt, wait_incrementing
 
 from subscriptions.exceptions import BadReferencePayment, PaymentError
-from subscriptions.models import Plan, Subscription, SubscriptionPayment
+from subscriptions.models import Plan, Subscription, SubscriptionPayment, WebhookHistoryCursor
 from subscriptions.providers import get_provider
 from subscriptions.providers.paddle import PaddleProvider
+from subscriptions.providers.paddle.api import WEBHOOK_HISTORY_TIME_FORMAT
 from subscriptions.tasks import check_unfinished_payments
 from subscriptions.utils import fromisoformat
 
+from .helpers import usd
+
 
 def automate_payment(url: str, card: str, email: str):
     """
@@ -566,3 +571,111 @@ def test__paddle__subscription_charge_offline__error(paddle, user, paddle_paymen
     with mock.patch.object(paddle._api, 'request', lambda *args, **kwargs: response):
         with pytest.raises(PaymentError):
             subscription.charge_offline()
+
+
+@pytest.mark.django_db(transaction=True, databases=['actual_db'])
+def test__paddle__acheck_payments(paddle, paddle_server, paddle_unconfirmed_payment, paddle_webhook_payload):
+    other_alert = {**paddle_webhook_payload, 'passthrough': '{"subscription_payment_id": "unknown"}'}
+    paddle_server.alerts = [
+        {'id': 1, 'alert_name': other_alert['alert_name'], 'fields': other_alert},
+        {'id': 2, 'alert_name': paddle_webhook_payload['alert_name'], 'fields': paddle_webhook_payload},
+        {'id': 2, 'alert_name': paddle_webhook_payload['alert_name'], 'fields': paddle_webhook_payload},
+    ]
+    paddle_server.alerts_per_page = 1
+
+    asyncio.run(paddle.acheck_payments(SubscriptionPayment.objects.filter(pk=paddle_unconfirmed_payment.pk)))
+
+    # all pages are fetched
+    assert sorted(payload['page'] for path, payload in paddle_server.requests) == [1, 2, 3]
+
+    paddle_unconfirmed_payment.refresh_from_db()
+    assert paddle_unconfirmed_payment.status == SubscriptionPayment.Status.COMPLETED
+    assert paddle_unconfirmed_payment.provider_transaction_id == str(paddle_webhook_payload['subscription_payment_id'])
+
+
+def webhook_history_alert(id_: int, payload: dict, created) -> dict:
+    return {
+        'id': id_,
+        'alert_name': payload['alert_name'],
+        'created_at': created.astimezone(timezone.utc).strftime(WEBHOOK_HISTORY_TIME_FORMAT),
+        'fields': payload,
+    }
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__paddle__check_payments__incremental_webhook_history(
+    paddle, paddle_server, monkeypatch, user, plan, paddle_unconfirmed_payment, paddle_webhook_payload,
+):
+    monkeypatch.setattr(paddle, 'INCREMENTAL_WEBHOOK_HISTORY', True)
+    other_payment = SubscriptionPayment.objects.create(user=user, plan=plan, provider_codename=paddle.codename, amount=usd(100))
+    SubscriptionPayment.objects.update(created=now() - timedelta(hours=1))
+    payment = SubscriptionPayment.objects.get(pk=paddle_unconfirmed_payment.pk)
+    other_payload = {**paddle_webhook_payload, 'passthrough': json.dumps({'subscription_payment_id': str(other_payment.id)})}
+
+    unknown_payload = {**paddle_webhook_payload, 'passthrough': '{"subscription_payment_id": "unknown"}'}
+    paddle_server.alerts = [
+        webhook_history_alert(1, unknown_payload, now() - timedelta(minutes=50)),
+        webhook_history_alert(2, paddle_webhook_payload, now() - timedelta(minutes=40)),
+    ]
+    paddle_server.alerts_per_page = 1
+
+    # no cursor yet -> all alerts since oldest payment are fetched
+    paddle.check_payments([payment])
+    assert sorted(payload['page'] for path, payload in paddle_server.requests) == [1, 2]
+    payment.refresh_from_db()
+    assert payment.status == SubscriptionPayment.Status.COMPLETED
+
+    cursor = WebhookHistoryCursor.objects.get(provider_codename=paddle.codename)
+    assert cursor.alert_id == 2
+    assert cursor.alert_created.strftime(WEBHOOK_HISTORY_TIME_FORMAT) == paddle_server.alerts[1]['created_at']
+
+    # alerts are applied to all pending payments, not only to checked ones
+    SubscriptionPayment.objects.filter(pk=payment.pk).update(status=SubscriptionPayment.Status.PENDING)
+    paddle_server.alerts.append(webhook_history_alert(3, other_payload, now() - timedelta(minutes=20)))
+    paddle_server.requests.clear()
+
+    paddle.check_payments([payment])
+    assert {payload['query_tail'] for path, payload in paddle_server.requests} == {cursor.alert_created.strftime(WEBHOOK_HISTORY_TIME_FORMAT)}
+
+    # already applied alert is fetched again (same second as the cursor) but skipped
+    payment.refresh_from_db()
+    assert payment.status == SubscriptionPayment.Status.PENDING
+    other_payment.refresh_from_db()
+    assert other_payment.status == SubscriptionPayment.Status.COMPLETED
+    assert WebhookHistoryCursor.objects.get(provider_codename=paddle.codename).alert_id == 3
+
+    # nothing new -> cursor is not moved
+    paddle.check_payments([payment])
+    assert WebhookHistoryCursor.objects.get(provider_codename=paddle.codename).alert_id == 3
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__paddle__check_payments__incremental_webhook_history__failed_alert(
+    paddle, paddle_server, monkeypatch, user, plan, paddle_unconfirmed_payment, paddle_webhook_payload,
+):
+    monkeypatch.setattr(paddle, 'INCREMENTAL_WEBHOOK_HISTORY', True)
+    other_payment = SubscriptionPayment.objects.create(user=user, plan=plan, provider_codename=paddle.codename, amount=usd(100))
+    SubscriptionPayment.objects.update(created=now() - timedelta(hours=1))
+    payment = SubscriptionPayment.objects.get(pk=paddle_unconfirmed_payment.pk)
+    other_payload = {**paddle_webhook_payload, 'passthrough': json.dumps({'subscription_payment_id': str(other_payment.id)})}
+
+    paddle_server.alerts = [
+        webhook_history_alert(1, other_payload, now() - timedelta(minutes=40)),
+        webhook_history_alert(2, paddle_webhook_payload, now() - timedelta(minutes=30)),
+        webhook_history_alert(3, other_payload, now() - timedelta(minutes=20)),
+    ]
+
+    # second alert fails to apply, e.g. because of a transient database error
+    with mock.patch.object(paddle, 'webhook', side_effect=[None, DatabaseError('connection lost'), None]):
+        paddle.check_payments([payment])
+
+    payment.refresh_from_db()
+    assert payment.status == SubscriptionPayment.Status.PENDING
+    assert WebhookHistoryCursor.objects.get(provider_codename=paddle.codename).alert_id == 1
+
+    # failed alert is fetched and applied again by the next check
+    paddle.check_payments([payment])
+
+    payment.refresh_from_db()
+    assert payment.status == SubscriptionPayment.Status.COMPLETED
+    assert WebhookHistoryCursor.objects.get(provider_codename=paddle.codename).alert_id == 3
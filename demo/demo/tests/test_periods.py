@@ -0,0 +1,94 @@
+import pickle
+import random
+from datetime import datetime, timedelta, timezone
+from itertools import count
+
+import pytest
+from dateutil.relativedelta import relativedelta
+
+from subscriptions.models import Plan
+from subscriptions.periods import Period, as_period
+
+
+def random_period() -> relativedelta:
+    return relativedelta(**random.choice([
+        {'days': random.randint(1, 40)},
+        {'hours': random.randint(1, 100), 'microseconds': random.randint(0, 10)},
+        {'months': random.randint(1, 14)},
+        {'years': random.randint(1, 3)},
+        {'months': random.randint(1, 5), 'days': random.randint(0, 3), 'seconds': random.randint(0, 100)},
+        {'weeks': random.randint(1, 5)},
+    ]))
+
+
+def random_datetime() -> datetime:
+    return datetime(2000, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=random.randrange(10 ** 9), microseconds=random.randrange(10 ** 6))
+
+
+def test__periods__nth_boundary():
+    random.seed(0)
+    for _ in range(2000):
+        period, start, index = random_period(), random_datetime(), random.randrange(300)
+        assert as_period(period).nth_boundary(start, index) == start + index * period
+
+
+def test__periods__index_at():
+    random.seed(1)
+    for _ in range(2000):
+        period, start = random_period(), random_datetime()
+        at = start + random.randrange(-3, 300) * period + random.choice([timedelta(0), timedelta(microseconds=1), -timedelta(microseconds=1)])
+
+        # first boundary not earlier than `at`, found step by step
+        expected = next(i for i in count() if start + i * period >= at)
+        assert as_period(period).index_at(start, at) == expected
+
+
+def test__periods__month_end():
+    start = datetime(2024, 1, 31, tzinfo=timezone.utc)
+    period = as_period(relativedelta(months=1))
+    assert [period.nth_boundary(start, i) for i in range(4)] == [
+        start,
+        datetime(2024, 2, 29, tzinfo=timezone.utc),
+        datetime(2024, 3, 31, tzinfo=timezone.utc),
+        datetime(2024, 4, 30, tzinfo=timezone.utc),
+    ]
+    assert period.index_at(start, datetime(2024, 3, 1, tzinfo=timezone.utc)) == 2
+
+
+def test__periods__mixed_signs():
+    period = relativedelta(months=1, days=-1)
+    start = datetime(2024, 1, 31, tzinfo=timezone.utc)
+    for at in (start + 5 * period, start + 5 * period + timedelta(microseconds=1), start + 100 * period - timedelta(days=3)):
+        expected = next(i for i in count() if start + i * period >= at)
+        assert as_period(period).index_at(start, at) == expected
+
+
+def test__periods__not_compiled():
+    start = datetime(2024, 1, 15, tzinfo=timezone.utc)
+    for period in (relativedelta(months=1, day=31), relativedelta(days=1.5)):
+        assert as_period(period).nth_boundary(start, 5) == start + 5 * period
+        assert as_period(period).index_at(start, start + 5 * period) == 5
+
+
+def test__periods__interning():
+    period = as_period(relativedelta(months=1))
+    assert period is as_period({'months': 1}) is as_period(relativedelta(months=1)) is as_period(period)
+    assert as_period(timedelta(days=7)) is as_period(relativedelta(weeks=1))
+    assert period == relativedelta(months=1)
+    assert isinstance(2 * period, Period) and 2 * period == relativedelta(months=2)
+
+    with pytest.raises(AttributeError):
+        period.months = 2
+
+    assert pickle.loads(pickle.dumps(period)) == period
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__periods__field(plan):
+    plan.charge_period = relativedelta(months=1)
+    plan.save()
+
+    first, second = Plan.objects.get(pk=plan.pk), Plan.objects.get(pk=plan.pk)
+    assert first.charge_period == relativedelta(months=1)
+    assert first.charge_period is second.charge_period
+    assert first.max_duration is second.max_duration
@@ -1,19 +1,35 @@
-from collections import Counter
-from datetime import timedelta
-
+import csv
+import json
+from collections import Counter, defaultdict
+from datetime import datetime, time, timedelta, timezone
+from decimal import Decimal
+from io import StringIO
+
+from dateutil.relativedelta import relativedelta
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connections
 from django.utils.timezone import now
+from djmoney.money import Money
 from freezegun import freeze_time
 from more_itertools import partition
 import pytest
 
-from subscriptions.models import SubscriptionPayment
+from subscriptions.models import PaymentsSnapshot, Plan, Subscription, SubscriptionPayment
 from subscriptions.reports import (
+    DAILY,
     MONTHLY,
     NO_MONEY,
     WEEKLY,
+    CohortReport,
     SubscriptionsReport,
+    SubscriptionsSeries,
     TransactionsReport,
+    export_report,
+    generate_reports,
+    project_recurring_charges,
 )
+from subscriptions.tasks import update_report_snapshots
 
 from .helpers import days, usd
 
@@ -191,6 +207,58 @@ def test__reports__subscriptions__active__users_count(reports_subscriptions):
         assert SubscriptionsReport(now_+days(7), now_+days(32)).get_active_users_count() == 1
 
 
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__subscriptions__active__users_count__approximate(reports_subscriptions):
+    now_ = reports_subscriptions[0].start
+
+    for since, until in [(now_-days(1), now_-timedelta(seconds=1)), (now_, now_+days(2)), (now_+days(31), now_+days(36))]:
+        report = SubscriptionsReport(since, until)
+        assert report.get_active_users_count(approximate=True) == report.get_active_users_count()
+
+    with freeze_time(now_+days(45)):
+        update_report_snapshots(since=now_.date())
+        since = datetime.combine(now_.date(), time.min, tzinfo=timezone.utc)
+        reports = list(SubscriptionsReport.iter_periods(DAILY, since=since, until=since+days(40)))
+        assert all(report.get_snapshot().active_users_sketch for report in reports)
+
+        # users active on at least one of the days
+        merged = SubscriptionsReport.merge_active_users_sketches(reports)
+        assert merged.count() == len({subscription.user_id for subscription in reports_subscriptions})
+
+        for report in reports:
+            report._snapshot = None
+        assert SubscriptionsReport.merge_active_users_sketches(reports) == merged
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__subscriptions__evaluate(reports_subscriptions, django_assert_max_num_queries):
+    now_ = reports_subscriptions[0].start
+    getters = [
+        'get_new_count', 'get_new_datetimes', 'get_ended_count', 'get_ended_datetimes', 'get_active_count',
+        'get_active_users_count', 'get_active_plans_and_quantities', 'get_active_plans_total',
+    ]
+    sorted_getters = ['get_ended_or_ending_ages', 'get_active_ages']
+
+    for as_of in [now_, now_+days(32), None]:
+        for since, until in [(now_-days(1), now_-timedelta(seconds=1)), (now_, now_+days(2)), (now_+days(7), now_+days(32)), (now_, now_+days(60))]:
+            live = SubscriptionsReport(since=since, until=until, as_of=as_of)
+            expected = {getter: getattr(live, getter)() for getter in getters}
+            expected.update({getter: sorted(getattr(live, getter)()) for getter in sorted_getters})
+
+            report = SubscriptionsReport(since=since, until=until, as_of=as_of)
+            with django_assert_max_num_queries(2, connection=connections['actual_db']):  # subscriptions and their plans
+                data = report.evaluate()
+                assert {
+                    **{getter: getattr(report, getter)() for getter in getters},
+                    **{getter: sorted(getattr(report, getter)()) for getter in sorted_getters},
+                } == expected
+            assert data.as_of == (as_of or data.as_of)
+
+    # same as freezing time in test__reports__subscriptions__active__users_count
+    assert SubscriptionsReport(now_+days(7), now_+days(32), as_of=now_).evaluate().active_users_count == 2
+    assert SubscriptionsReport(now_+days(7), now_+days(32), as_of=now_+days(32)).evaluate().active_users_count == 1
+
+
 @pytest.mark.django_db(databases=['actual_db'])
 def test__reports__subscriptions__active__ages(reports_subscriptions):
     now_ = reports_subscriptions[0].start
@@ -201,6 +269,34 @@ def test__reports__subscriptions__active__ages(reports_subscriptions):
         assert sorted(SubscriptionsReport(now_+days(31), now_+days(40)).get_active_ages()) == [timedelta(days=30)]
 
 
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__subscriptions__ages_distribution(reports_subscriptions, django_assert_num_queries):
+    now_ = reports_subscriptions[0].start
+    report = SubscriptionsReport(now_+days(7), now_+days(17))
+
+    with django_assert_num_queries(1, connection=connections['actual_db']):
+        distribution = report.get_active_ages_distribution(edges=[timedelta(days=10), timedelta(days=12)], percentiles=[0, 0.25, 0.5, 1])
+
+    # ages are 10, 17 and 17 days
+    assert distribution.counts == [0, 1, 2]
+    assert distribution.total == report.get_active_count()
+    assert distribution.percentiles == {
+        0: timedelta(days=10),
+        0.25: timedelta(days=13, hours=12),  # interpolated
+        0.5: timedelta(days=17),
+        1: timedelta(days=17),
+    }
+
+    with freeze_time(now_):
+        distribution = SubscriptionsReport(now_, now_+days(32)).get_ended_or_ending_ages_distribution(edges=[timedelta(days=20)])
+    assert distribution.counts == [1, 1]  # 14 and 30 days
+    assert distribution.percentiles[0.5] == timedelta(days=22)
+
+    distribution = SubscriptionsReport(now_-days(2), now_-days(1)).get_active_ages_distribution(edges=[timedelta(days=1)])
+    assert distribution.counts == [0, 0]
+    assert distribution.percentiles == {0.5: None, 0.9: None, 0.99: None}
+
+
 @pytest.mark.django_db(databases=['actual_db'])
 def test__reports__subscriptions__active__plans__quantities(reports_subscriptions, plan, bigger_plan, recharge_plan):
     now_ = reports_subscriptions[0].start
@@ -215,6 +311,30 @@ def test__reports__subscriptions__active__plans__total(reports_subscriptions, pl
     assert SubscriptionsReport(now_+days(7), now_+days(17)).get_active_plans_total() == Counter({plan: 3, bigger_plan: 1})
 
 
+@pytest.mark.django_db(databases=['actual_db'])
+@pytest.mark.parametrize('frequency', [DAILY, WEEKLY, MONTHLY])
+@pytest.mark.parametrize('include_until', [False, True])
+def test__reports__subscriptions__series(reports_subscriptions, frequency, include_until, django_assert_num_queries):
+    now_ = reports_subscriptions[0].start
+    since, until = now_ - days(2), now_ + days(45)
+
+    reports = list(SubscriptionsReport.iter_periods(frequency, since=since, until=until, include_until=include_until))
+    expected = SubscriptionsSeries(
+        since=[report.since for report in reports],
+        until=[report.until for report in reports],
+        new_count=[report.get_new_count() for report in reports],
+        ended_count=[report.get_ended_count() for report in reports],
+        active_count=[report.get_active_count() for report in reports],
+        active_users_count=[report.get_active_users_count() for report in reports],
+    )
+
+    with django_assert_num_queries(1, connection=connections['actual_db']):
+        series = SubscriptionsReport.get_series(frequency, since=since, until=until, include_until=include_until)
+    assert series == expected
+    bounds = list(SubscriptionsReport.iter_period_bounds(frequency, since, until))
+    assert SubscriptionsReport._get_series_in_python(bounds, include_until=include_until) == expected
+
+
 @pytest.mark.django_db(databases=['actual_db'])
 def test__reports__transactions__payments__query(reports_payments, paddle):
     now_ = reports_payments[0].created
@@ -323,6 +443,30 @@ def test__reports__transactions__refunds__total(reports_payments, paddle):
     assert TransactionsReport(provider_codename=paddle.codename, since=now_, until=now_+days(20)).get_refunds_total() == usd(250)
 
 
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__transactions__multiple_currencies(reports_payments, paddle, user, plan):
+    now_ = reports_payments[0].created
+    for amount, quantity in [(10, 1), (20, 2), (Decimal('0.15'), 1), (Decimal('0.20'), 1)]:
+        SubscriptionPayment.objects.create(
+            created=now_+days(5), user=user, plan=plan, status=SubscriptionPayment.Status.COMPLETED,
+            quantity=quantity, amount=Money(amount, 'EUR'), provider_codename=paddle.codename,
+        )
+
+    report = TransactionsReport(provider_codename=paddle.codename, since=now_, until=now_+days(30))
+    assert report.get_completed_payments_total_by_currency() == {
+        'EUR': Money('50.35', 'EUR'),
+        'USD': usd(680),
+    }
+    assert report.get_completed_payments_average_by_currency() == {
+        'EUR': Money('5.10', 'EUR'),
+        'USD': usd(170),
+    }
+    assert report.get_incompleted_payments_total_by_currency() == {'USD': usd(800)}
+
+    with pytest.raises(ValueError):
+        report.get_completed_payments_total()
+
+
 @pytest.mark.django_db(databases=['actual_db'])
 def test__reports__transactions__estimated_recurring_charge__by_time(reports_subscriptions, paddle, eps):
     now_ = reports_subscriptions[0].start
@@ -346,6 +490,32 @@ def test__reports__transactions__estimated_recurring_charge__by_time(reports_sub
     }
 
 
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__transactions__project_recurring_charges(user, plan):
+    monthly_plan = Plan.objects.create(codename='monthly', name='Monthly', charge_amount=Money(15, 'EUR'), charge_period=relativedelta(months=1))
+    other_monthly_plan = Plan.objects.create(codename='monthly-2', name='Monthly 2', charge_amount=Money(5, 'EUR'), charge_period=relativedelta(months=1))
+    start = datetime(2023, 1, 31, 12, tzinfo=timezone.utc)
+    for i, offset in enumerate([relativedelta(), days(3), relativedelta(months=2)]):
+        # subscriptions charged at the same moments are projected together, even if plans differ
+        Subscription.objects.create(user=user, plan=monthly_plan, start=start + days(11 * i), initial_charge_offset=offset, quantity=i + 1)
+        Subscription.objects.create(user=user, plan=monthly_plan, start=start + days(11 * i), initial_charge_offset=offset)
+        Subscription.objects.create(user=user, plan=other_monthly_plan, start=start + days(11 * i), initial_charge_offset=offset)
+        Subscription.objects.create(user=user, plan=plan, start=start - days(100 * i) + timedelta(hours=1), initial_charge_offset=offset)
+
+    subscriptions = Subscription.objects.all()
+    for since, until in [
+        (start - days(1), start + days(400)),
+        (start + days(500), start + days(900)),
+        (start + relativedelta(months=1), start + relativedelta(months=1)),
+    ]:
+        expected = defaultdict(int)
+        for subscription in subscriptions:
+            for charge_date in subscription.iter_charge_dates(since, until):
+                expected[charge_date] += subscription.plan.charge_amount * subscription.quantity
+
+        assert project_recurring_charges(subscriptions, since, until) == expected
+
+
 @pytest.mark.django_db(databases=['actual_db'])
 def test__reports__transactions__estimated_recurring_charge__total(reports_subscriptions, paddle, eps):
     now_ = reports_subscriptions[0].start
@@ -355,3 +525,224 @@ def test__reports__transactions__estimated_recurring_charge__total(reports_subsc
     assert TransactionsReport(provider_codename=paddle.codename, since=now_, until=now_+days(7)+eps).get_estimated_recurring_charge_total() == usd(500)
     assert TransactionsReport(provider_codename=paddle.codename, since=now_+days(3), until=now_+days(7)+eps).get_estimated_recurring_charge_total() == usd(200)
     assert TransactionsReport(provider_codename=paddle.codename, since=now_-days(1), until=now_+days(40)).get_estimated_recurring_charge_total() == usd(1000)
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__snapshots(reports_subscriptions, reports_payments, paddle, django_assert_num_queries):
+    start = reports_subscriptions[0].start
+    first_day = start.astimezone(timezone.utc).date() - timedelta(days=1)
+
+    with freeze_time(start + days(45)):
+        snapshotted_days = update_report_snapshots(since=first_day)
+        assert snapshotted_days[0] == first_day
+        assert snapshotted_days[-1] == now().date() - timedelta(days=1)
+
+        # last period is not closed yet, so it is computed live
+        since = datetime.combine(first_day, time.min, tzinfo=timezone.utc)
+        until = now().replace(microsecond=0)
+        with django_assert_num_queries(1, connection=connections['actual_db']):
+            reports = list(SubscriptionsReport.iter_periods(DAILY, since=since, until=until))
+            counts = [(report.get_new_count(), report.get_ended_count(), report.get_active_count()) for report in reports[:-1]]
+        assert reports[-1].get_snapshot() is None
+
+        for report, snapshot_counts in zip(reports, counts):
+            live_report = SubscriptionsReport(since=report.since, until=report.until)
+            live_report._snapshot = None
+            assert snapshot_counts == (live_report.get_new_count(), live_report.get_ended_count(), live_report.get_active_count())
+            assert report.get_active_users_count() == live_report.get_active_users_count()
+            assert report.get_active_plans_total() == live_report.get_active_plans_total()
+
+        assert sum(report.get_new_count() for report in reports) == Subscription.objects.count()
+
+        for report in TransactionsReport.iter_periods(DAILY, since=since, until=until, provider_codename=paddle.codename):
+            live_report = TransactionsReport(provider_codename=paddle.codename, since=report.since, until=report.until)
+            live_report._snapshot = None
+            assert report.get_payments_count_by_status() == live_report.get_payments_count_by_status()
+            assert report.get_completed_payments_total_by_currency() == live_report.get_completed_payments_total_by_currency()
+            assert report.get_incompleted_payments_total_by_currency() == live_report.get_incompleted_payments_total_by_currency()
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__snapshots__refresh(reports_payments, paddle):
+    payment = reports_payments[3]  # completed, 30 days after the first one
+    payment_day = payment.created.astimezone(timezone.utc).date()
+
+    with freeze_time(payment.created + days(3)):
+        assert update_report_snapshots()[0] == reports_payments[0].created.astimezone(timezone.utc).date()
+        num_snapshots = PaymentsSnapshot.objects.count()
+
+        SubscriptionPayment.objects.filter(pk=payment.pk).update(status=SubscriptionPayment.Status.ERROR)
+
+        # only recent days are recomputed
+        assert update_report_snapshots(refresh_period=timedelta(days=5))[0] == payment_day - timedelta(days=3)
+        assert PaymentsSnapshot.objects.count() == num_snapshots
+        report = TransactionsReport(
+            provider_codename=paddle.codename,
+            since=datetime.combine(payment_day, time.min, tzinfo=timezone.utc),
+            until=datetime.combine(payment_day, time.min, tzinfo=timezone.utc) + days(1),
+        )
+        assert report.get_snapshot()
+        assert report.get_payments_count_by_status() == {SubscriptionPayment.Status.ERROR: 1}
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__export(reports_subscriptions, reports_payments, paddle, django_assert_num_queries):
+    since = reports_payments[0].created - days(1)
+    until = since + days(60)
+
+    # nothing is fetched until lines are consumed
+    with django_assert_num_queries(0, connection=connections['actual_db']):
+        lines = export_report('subscriptions', 'new', since=since, until=until, chunk_size=2)
+
+    header, *rows = csv.reader(lines)
+    assert header == ['uid', 'user_id', 'plan_id', 'quantity', 'auto_prolong', 'start', 'end', 'age']
+    report = SubscriptionsReport(since=since, until=until)
+    assert [row[5] for row in rows] == [str(start) for start in report.get_new_datetimes()]
+
+    report = TransactionsReport(provider_codename=paddle.codename, since=since, until=until)
+    rows = [json.loads(line) for line in report.export('completed', format='ndjson')]
+    assert [
+        Money(row['amount'], row['amount_currency']) * row['quantity'] if row['amount'] is not None else None
+        for row in rows
+    ] == report.get_completed_payments_amounts()
+    assert {row['status'] for row in rows} == {SubscriptionPayment.Status.COMPLETED}
+
+    with pytest.raises(ValueError):
+        export_report('transactions', 'completed', since=since, until=until)
+
+    with pytest.raises(ValueError):
+        export_report('subscriptions', 'completed', since=since, until=until)
+
+    stdout = StringIO()
+    call_command(
+        'export_report', 'transactions', 'refunds', f'--provider={paddle.codename}', '--format=ndjson',
+        f'--since={since.isoformat()}', f'--until={until.isoformat()}', stdout=stdout,
+    )
+    rows = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert [
+        Money(row['amount'], row['amount_currency']) if row['amount'] is not None else None
+        for row in rows
+    ] == report.get_refunds_amounts()
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__export__view(client, user, reports_payments, paddle):
+    since = reports_payments[0].created - days(1)
+    params = {
+        'report': 'transactions',
+        'kind': 'payments',
+        'provider': paddle.codename,
+        'since': since.isoformat(),
+        'until': (since + days(60)).isoformat(),
+    }
+
+    client.force_login(user)
+    assert client.get('/subscribe/reports/export/', params).status_code == 403
+
+    user.is_staff = True
+    user.save()
+
+    response = client.get('/subscribe/reports/export/', params)
+    assert response.status_code == 200
+    assert response.streaming
+    assert response['Content-Type'] == 'text/csv'
+    header, *rows = csv.reader(line.decode() for line in response.streaming_content)
+    assert header[0] == 'uid'
+    assert len(rows) == SubscriptionPayment.objects.filter(provider_codename=paddle.codename).count()
+
+    response = client.get('/subscribe/reports/export/', {**params, 'format': 'xml'})
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__cohorts(user, other_user, plan, django_assert_num_queries):
+    third_user = get_user_model().objects.create(username='third')
+    free_plan = Plan.objects.create(codename='free', name='Free')
+
+    def utc(month: int, day: int, year: int = 2024) -> datetime:
+        return datetime(year, month, day, tzinfo=timezone.utc)
+
+    Subscription.objects.bulk_create([
+        # cohort of January, active in January - April
+        Subscription(user=user, plan=plan, start=utc(1, 5), end=utc(2, 4), auto_prolong=False),
+        Subscription(user=user, plan=plan, start=utc(3, 10), end=utc(4, 9), auto_prolong=False),
+        # cohort of February (free subscriptions are ignored), subscription ends right at March start
+        Subscription(user=other_user, plan=free_plan, start=utc(12, 1, year=2023), end=utc(2, 1), auto_prolong=False),
+        Subscription(user=other_user, plan=plan, start=utc(2, 1), end=utc(3, 1), auto_prolong=False),
+        # first paid subscription is before selected period
+        Subscription(user=third_user, plan=plan, start=utc(12, 1, year=2023), end=utc(1, 10), auto_prolong=False),
+        Subscription(user=third_user, plan=plan, start=utc(1, 20), end=utc(7, 1), auto_prolong=True),
+    ])
+
+    with freeze_time(utc(5, 15)), django_assert_num_queries(1, connection=connections['actual_db']):
+        cohorts = CohortReport(since=utc(1, 1), until=utc(4, 1), frequency=MONTHLY).get_cohorts()
+
+    assert cohorts.periods == [utc(1, 1), utc(2, 1), utc(3, 1)]
+    assert cohorts.sizes == [1, 1, 0]
+    assert [list(row) for row in cohorts.retained] == [
+        [1, 1, 1, 1, 0],
+        [1, 0, 0, 0],
+        [0, 0, 0],
+    ]
+    assert cohorts.get_retention_rates()[:2] == [[1., 1., 1., 1., 0.], [1., 0., 0., 0.]]
+
+
+@pytest.mark.parametrize('processes', [False, True])
+@pytest.mark.django_db(databases=['actual_db'], transaction=True)
+def test__reports__generate_reports(reports_subscriptions, reports_payments, paddle, processes):
+    since = reports_subscriptions[0].start - days(1)
+    periods = list(SubscriptionsReport.iter_period_bounds(DAILY, since=since, until=since + days(40)))
+    methods = ['get_new_count', 'get_active_count', 'get_active_users_count', 'get_active_plans_total']
+
+    expected = list(generate_reports(SubscriptionsReport, periods, methods))
+    assert [report for report, _ in expected] == list(SubscriptionsReport.iter_periods(DAILY, since=since, until=since + days(40)))
+    assert expected[1][1] == {method: getattr(expected[1][0], method)() for method in methods}
+
+    results = list(generate_reports(SubscriptionsReport, periods, methods, workers=4, processes=processes, batch_size=3))
+    assert results == expected
+
+    methods = ['get_payments_count_by_status', 'get_completed_payments_total_by_currency']
+    results = list(generate_reports(TransactionsReport, periods, methods, workers=3, processes=processes, provider_codename=paddle.codename))
+    assert results == list(generate_reports(TransactionsReport, periods, methods, provider_codename=paddle.codename))
+    assert any(values['get_completed_payments_total_by_currency'] for _, values in results)
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__reports__cache(settings, cache_backend, reports_subscriptions, paddle, django_assert_num_queries):
+    now_ = reports_subscriptions[0].start
+
+    def assert_num_queries(num: int):
+        return django_assert_num_queries(num, connection=connections['actual_db'])
+
+    # disabled by default
+    report = SubscriptionsReport(since=now_, until=now_+days(2))
+    with assert_num_queries(2):
+        assert report.get_new_count() == report.get_new_count() == 2
+
+    settings.SUBSCRIPTIONS_REPORT_CACHE = {'enabled': True, 'ttl': timedelta(minutes=5)}
+
+    # recent period is cached for a short time
+    with freeze_time(now_+days(2)+timedelta(hours=1)):
+        with assert_num_queries(1):
+            assert SubscriptionsReport(since=now_, until=now_+days(2)).get_new_count() == 2
+            assert SubscriptionsReport(since=now_, until=now_+days(2)).get_new_count() == 2
+
+        # different arguments or report fields are cached separately
+        with assert_num_queries(2):
+            assert SubscriptionsReport(since=now_, until=now_+days(2), include_until=True).get_new_count() == 2
+            assert TransactionsReport(provider_codename=paddle.codename, since=now_, until=now_+days(2)).get_refunds_count() == 0
+
+    with freeze_time(now_+days(2)+timedelta(hours=1, minutes=6)), assert_num_queries(1):
+        assert SubscriptionsReport(since=now_, until=now_+days(2)).get_new_count() == 2
+
+    # settled period is cached forever
+    with freeze_time(now_+days(3)+timedelta(hours=1)), assert_num_queries(1):
+        assert SubscriptionsReport(since=now_, until=now_+days(2)).get_new_count() == 2
+
+    Subscription.objects.filter(pk=reports_subscriptions[0].pk).update(start=now_+days(5))
+    with freeze_time(now_+days(30)), assert_num_queries(0):
+        assert SubscriptionsReport(since=now_, until=now_+days(2)).get_new_count() == 2
+
+    settings.SUBSCRIPTIONS_REPORT_CACHE = {'enabled': True, 'version': 2}
+    with assert_num_queries(1):
+        assert SubscriptionsReport(since=now_, until=now_+days(2)).get_new_count() == 1
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.utils.timezone import now
+
+from subscriptions.models import Subscription
+from subscriptions.sketches import HyperLogLog, build_sketch
+
+
+def test__sketches__hyperloglog__error_bounds():
+    random.seed(42)
+    for num_values in (0, 1, 10, 1000, 50000):
+        sketch = HyperLogLog()
+        values = random.sample(range(10 ** 9), num_values)
+        sketch.update(values)
+        sketch.update(values[:num_values // 2])  # duplicates are not counted
+        assert abs(sketch.count() - num_values) <= max(1, 3 * sketch.standard_error * num_values)
+
+
+def test__sketches__hyperloglog__merge():
+    first, second = HyperLogLog(), HyperLogLog()
+    first.update(range(0, 3000))
+    second.update(range(2000, 5000))
+
+    merged = first | second
+    assert abs(merged.count() - 5000) <= 3 * merged.standard_error * 5000
+    assert merged == HyperLogLog.from_bytes(first.to_bytes()) | HyperLogLog.from_bytes(second.to_bytes())
+
+    first.merge(second)
+    assert first == merged
+
+    with pytest.raises(ValueError):
+        first.merge(HyperLogLog(precision=10))
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__sketches__build_sketch(plan):
+    users = get_user_model().objects.bulk_create(get_user_model()(username=f'user{i}') for i in range(2000))
+    now_ = now()
+    Subscription.objects.bulk_create(
+        Subscription(user=user, plan=plan, start=now_, end=now_, auto_prolong=False)
+        for user in users + users[:500]
+    )
+
+    sketch = build_sketch(Subscription.objects.all(), 'user')
+    assert abs(sketch.count() - 2000) <= 3 * sketch.standard_error * 2000
+
+    # registers are the same as if database hashes were added in Python
+    with connections['actual_db'].cursor() as cursor:
+        cursor.execute('SELECT hashtextextended(id::text, 0) FROM auth_user WHERE id = ANY(%s)', [[user.id for user in users]])
+        hashes = [value % 2 ** 64 for value, in cursor.fetchall()]
+
+    expected = HyperLogLog()
+    for value in hashes:
+        expected.add_hash(value)
+    assert sketch == expected
@@ -1,24 +1,41 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+from threading import Event
 from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from unittest import mock
+from uuid import uuid4
 
 import pytest
+from django.db import DatabaseError
 from django.utils.timezone import now
 from freezegun import freeze_time
 from more_itertools import spy
 
-from subscriptions.exceptions import PaymentError
-from subscriptions.models import Subscription, SubscriptionPayment
+from subscriptions.exceptions import PaymentError, ProviderUnavailable
+from subscriptions.models import ChargeRun, Subscription, SubscriptionPayment
+from subscriptions.providers import get_provider, get_providers
+from subscriptions.providers.circuit_breakers import CircuitState
 from subscriptions.tasks import (
+    CHARGE_PLACEHOLDER_METADATA_KEY,
+    ChargeOutcome,
+    ChargeResult,
+    _ChargeRunProgress,
+    _after_key,
+    _lock_charge_candidate,
+    acharge_recurring_subscriptions,
     charge_recurring_subscriptions,
+    SkipReason,
+    check_unfinished_payments,
+    get_resumable_charge_run,
+    plan_recurring_charges,
     notify_stuck_pending_payments,
 )
 from subscriptions.utils import HardDBLock
 
-from .helpers import days
+from .helpers import days, usd
 
 
 def middle(period: list[timedelta]) -> timedelta:
@@ -280,6 +297,411 @@ def test__tasks__charge_expiring__payment_failure(
             assert SubscriptionPayment.objects.count() == 2
 
 
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__charge_expiring__only_eligible_subscriptions_reach_worker(
+    subscription,
+    payment,
+    charge_schedule,
+):
+    charge_period = charge_schedule[1:3]
+
+    already_charged_subscription = Subscription.objects.get(pk=subscription.pk)
+    already_charged_subscription.pk = None
+    already_charged_subscription.save()
+    SubscriptionPayment.objects.create(
+        user=subscription.user,
+        plan=subscription.plan,
+        subscription=already_charged_subscription,
+        status=SubscriptionPayment.Status.ERROR,
+        created=already_charged_subscription.end + charge_period[0],
+    )
+
+    pending_subscription = Subscription.objects.get(pk=subscription.pk)
+    pending_subscription.pk = None
+    pending_subscription.save()
+    with freeze_time(subscription.start):
+        SubscriptionPayment.objects.create(
+            user=subscription.user,
+            plan=subscription.plan,
+            subscription=pending_subscription,
+            status=SubscriptionPayment.Status.PENDING,
+        )
+
+    with freeze_time(subscription.end + middle(charge_period)):
+        with mock.patch('subscriptions.tasks._charge_recurring_subscription') as charge:
+            charge_recurring_subscriptions(schedule=charge_schedule, num_threads=1)
+
+        assert [call.args[0] for call in charge.call_args_list] == [subscription]
+        candidate = charge.call_args.args[0]
+        assert candidate.charge_period_start == subscription.end + charge_period[0]
+        assert candidate.charge_period_end == subscription.end + charge_period[1]
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__charge_expiring__attempts_made_after_selection(
+    subscription,
+    payment,
+    charge_schedule,
+    caplog,
+):
+    charge_period = charge_schedule[1:3]
+
+    def make_attempts_and_lock(subscription, *args, **kwargs):
+        # someone else charged the subscription (twice) after it was selected as a candidate,
+        # but its end didn't move; status is updated, because saving a completed payment prolongs it
+        for _ in range(2):
+            attempt = SubscriptionPayment.objects.create(
+                user=subscription.user,
+                plan=subscription.plan,
+                subscription=subscription,
+                status=SubscriptionPayment.Status.ERROR,
+            )
+        SubscriptionPayment.objects.filter(pk=attempt.pk).update(status=SubscriptionPayment.Status.COMPLETED)
+        return _lock_charge_candidate(subscription, *args, **kwargs)
+
+    with freeze_time(subscription.end + middle(charge_period)):
+        with mock.patch('subscriptions.tasks._lock_charge_candidate', make_attempts_and_lock), \
+             caplog.at_level(logging.WARNING):
+            summary = charge_recurring_subscriptions(schedule=charge_schedule, num_threads=1)
+
+    assert summary.get_counts()[ChargeOutcome.SKIPPED] == 1
+    assert [record.message.split(':')[0] for record in caplog.records] == [
+        'Multiple payment attempts detected (should be at most 1 attempt)',
+        'Previous payment attempt was successful but subscription end is still approaching',
+    ]
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__charge_expiring__outside_of_schedule_not_reaching_worker(
+    subscription,
+    payment,
+    charge_schedule,
+):
+    with freeze_time(subscription.end + charge_schedule[-1]):
+        with mock.patch('subscriptions.tasks._charge_recurring_subscription') as charge:
+            charge_recurring_subscriptions(schedule=charge_schedule, num_threads=1)
+
+        assert not charge.called
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__charge_expiring__summary(
+    subscription,
+    payment,
+    charge_schedule,
+    dummy,
+):
+    failing_subscription = Subscription.objects.get(pk=subscription.pk)
+    failing_subscription.pk = None
+    failing_subscription.save()
+
+    original_charge_offline = Subscription.charge_offline
+
+    def charge_offline(self):
+        if self.pk == failing_subscription.pk:
+            raise PaymentError('Something went wrong')
+        return original_charge_offline(self)
+
+    with freeze_time(subscription.end + charge_schedule[-2]):
+        with mock.patch.object(Subscription, 'charge_offline', charge_offline):
+            summary = charge_recurring_subscriptions(schedule=charge_schedule, num_threads=1)
+
+    assert summary.get_counts() == {
+        ChargeOutcome.CHARGED: 1,
+        ChargeOutcome.SKIPPED: 0,
+        ChargeOutcome.DEFERRED: 0,
+        ChargeOutcome.FAILED: 1,
+    }
+    assert {result.subscription_uid: result.outcome for result in summary.results} == {
+        subscription.uid: ChargeOutcome.CHARGED,
+        failing_subscription.uid: ChargeOutcome.FAILED,
+    }
+    assert summary.duration is not None
+
+
+@pytest.mark.django_db(transaction=True, databases=['actual_db'])
+def test__tasks__charge_expiring__multiple_threads__bounded_queue(
+    user,
+    plan,
+    charge_schedule,
+    dummy,
+):
+    subscriptions = []
+    for _ in range(10):
+        subscription = Subscription.objects.create(user=user, plan=plan)
+        SubscriptionPayment.objects.create(
+            user=user,
+            plan=plan,
+            subscription=subscription,
+            provider_codename=dummy.codename,
+            amount=plan.charge_amount,
+            status=SubscriptionPayment.Status.COMPLETED,
+            created=subscription.start,
+        )
+        subscriptions.append(subscription)
+
+    def raise_unexpected_error(self):
+        if self.pk == subscriptions[0].pk:
+            raise ValueError('Unexpected error')
+        return SubscriptionPayment.objects.create(
+            user=self.user,
+            plan=self.plan,
+            subscription=self,
+            provider_codename=dummy.codename,
+        )
+
+    with freeze_time(subscriptions[-1].end + charge_schedule[-2]):
+        with mock.patch.object(Subscription, 'charge_offline', raise_unexpected_error):
+            summary = charge_recurring_subscriptions(
+                schedule=charge_schedule,
+                num_threads=3,
+                chunk_size=2,
+                max_in_flight=1,
+            )
+
+    assert summary.get_counts() == {
+        ChargeOutcome.CHARGED: 9,
+        ChargeOutcome.SKIPPED: 0,
+        ChargeOutcome.DEFERRED: 0,
+        ChargeOutcome.FAILED: 1,
+    }
+    assert {
+        result.subscription_uid for result in summary.results
+        if result.outcome == ChargeOutcome.FAILED
+    } == {subscriptions[0].uid}
+    assert SubscriptionPayment.objects.count() == 10 + 9
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__charge_expiring__provider_unavailable(
+    subscription,
+    payment,
+    charge_schedule,
+    dummy,
+):
+    def raise_provider_unavailable(*args, **kwargs):
+        raise ProviderUnavailable('Circuit breaker is open')
+
+    with freeze_time(subscription.end + charge_schedule[-2]):
+        with mock.patch.object(dummy, 'charge_offline', raise_provider_unavailable):
+            summary = charge_recurring_subscriptions(schedule=charge_schedule, num_threads=1)
+
+        assert summary.get_counts()[ChargeOutcome.DEFERRED] == 1
+        assert SubscriptionPayment.objects.count() == 1
+
+        # provider recovered -> subscription is charged within same charge period
+        summary = charge_recurring_subscriptions(schedule=charge_schedule, num_threads=1)
+        assert summary.get_counts()[ChargeOutcome.CHARGED] == 1
+        assert SubscriptionPayment.objects.count() == 2
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__charge_expiring__run_is_recorded(
+    subscription,
+    payment,
+    charge_schedule,
+    dummy,
+):
+    with freeze_time(subscription.end + charge_schedule[-2]):
+        summary = charge_recurring_subscriptions(schedule=charge_schedule, num_threads=1)
+
+    run = ChargeRun.objects.get()
+    assert summary.run == run
+    assert run.started == summary.started
+    assert run.finished == summary.finished
+    assert (run.num_charged, run.num_skipped, run.num_deferred, run.num_failed) == (1, 0, 0, 0)
+    assert (run.cursor_end, run.cursor_uid) == (subscription.end, subscription.uid)
+    assert get_resumable_charge_run() is None
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__charge_expiring__resume(
+    user,
+    plan,
+    charge_schedule,
+):
+    subscriptions = sorted(
+        (Subscription.objects.create(user=user, plan=plan) for _ in range(10)),
+        key=lambda subscription: (subscription.end, subscription.uid),
+    )
+
+    charged = []
+
+    def crash_on_fifth(subscription, **kwargs):
+        if len(charged) == 4:
+            raise SystemExit()
+        charged.append(subscription.uid)
+        return ChargeOutcome.CHARGED
+
+    with freeze_time(subscriptions[-1].end + charge_schedule[-2]):
+        with mock.patch('subscriptions.tasks._charge_recurring_subscription', crash_on_fifth):
+            with pytest.raises(SystemExit):
+                charge_recurring_subscriptions(schedule=charge_schedule, num_threads=1, checkpoint_every=3)
+
+        crashed_run = get_resumable_charge_run()
+        assert crashed_run.finished is None
+        assert crashed_run.num_charged == 4
+        assert (crashed_run.cursor_end, crashed_run.cursor_uid) == (subscriptions[3].end, subscriptions[3].uid)
+
+    # candidates are selected as of crashed run's start, no matter when it is resumed
+    with freeze_time(subscriptions[-1].end + charge_schedule[-2] + timedelta(hours=1)):
+        with mock.patch('subscriptions.tasks._charge_recurring_subscription') as charge:
+            charge.return_value = ChargeOutcome.CHARGED
+            summary = charge_recurring_subscriptions(schedule=charge_schedule, num_threads=1, resume=crashed_run)
+
+    assert [call.args[0] for call in charge.call_args_list] == subscriptions[4:]
+    assert {call.kwargs['at'] for call in charge.call_args_list} == {crashed_run.started}
+    assert summary.run.started > crashed_run.started
+    assert summary.run.resumed_from == crashed_run
+    assert summary.run.num_charged == 6
+    assert get_resumable_charge_run() is None
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__charge_run_progress__out_of_order():
+    run = ChargeRun.objects.create()
+    results = []
+    progress = _ChargeRunProgress(run, results, checkpoint_every=1)
+
+    keys = [progress.dispatch(Subscription(uid=uuid4(), end=now() + days(i))) for i in range(3)]
+
+    # last subscription finished first -> cursor doesn't move
+    results.append(ChargeResult(subscription_uid=keys[2][1], outcome=ChargeOutcome.CHARGED, duration=timedelta()))
+    progress.checkpoint()
+    run.refresh_from_db()
+    assert run.cursor_uid is None
+    assert run.num_charged == 1
+
+    results.append(ChargeResult(subscription_uid=keys[0][1], outcome=ChargeOutcome.FAILED, duration=timedelta()))
+    progress.checkpoint()
+    run.refresh_from_db()
+    assert run.cursor_uid == keys[0][1]
+
+    results.append(ChargeResult(subscription_uid=keys[1][1], outcome=ChargeOutcome.SKIPPED, duration=timedelta()))
+    progress.checkpoint()
+    run.refresh_from_db()
+    assert (run.cursor_end, run.cursor_uid) == keys[2]
+    assert (run.num_charged, run.num_skipped, run.num_failed) == (1, 1, 1)
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__plan_recurring_charges(
+    user,
+    plan,
+    subscription,
+    payment,
+    charge_schedule,
+    dummy,
+):
+    no_reference_payment = Subscription.objects.get(pk=subscription.pk)
+    no_reference_payment.pk = None
+    no_reference_payment.save()
+
+    _ = Subscription.objects.create(  # ends at max duration
+        user=user,
+        plan=plan,
+        start=subscription.end - plan.max_duration,
+        end=subscription.end,
+    )
+
+    def snapshot() -> list:
+        return [
+            list(SubscriptionPayment.objects.order_by('uid').values_list('uid', 'status')),
+            list(Subscription.objects.order_by('uid').values_list('uid', 'end', 'auto_prolong')),
+        ]
+
+    initial_state = snapshot()
+
+    with freeze_time(subscription.end + charge_schedule[-2]):
+        charges = plan_recurring_charges(schedule=charge_schedule)
+
+    assert charges.get_counts() == {
+        ChargeOutcome.CHARGED: 1,
+        ChargeOutcome.SKIPPED: 1,
+        ChargeOutcome.DEFERRED: 0,
+        ChargeOutcome.FAILED: 1,
+    }
+    assert charges.skip_reasons == {
+        SkipReason.PROLONGATION_IMPOSSIBLE: 1,
+        SkipReason.NO_REFERENCE_PAYMENT: 1,
+    }
+    assert charges.provider_calls == {dummy.codename: 1}
+    assert charges.amounts == {'USD': usd(100) * subscription.quantity}
+
+    # nothing changed
+    assert snapshot() == initial_state
+    assert not ChargeRun.objects.exists()
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__plan_recurring_charges__provider_unavailable(
+    subscription,
+    payment,
+    charge_schedule,
+    dummy,
+):
+    with freeze_time(subscription.end + charge_schedule[-2]):
+        with mock.patch.object(type(dummy.circuit_breaker), 'state', CircuitState.OPEN):
+            charges = plan_recurring_charges(schedule=charge_schedule)
+
+    assert charges.get_counts()[ChargeOutcome.DEFERRED] == 1
+    assert charges.skip_reasons == {SkipReason.PROVIDER_UNAVAILABLE: 1}
+    assert not charges.provider_calls
+
+
+@pytest.mark.django_db(databases=['actual_db'])
+def test__tasks__check_unfinished_payments__batches(user, plan, dummy):
+    for _ in range(5):
+        SubscriptionPayment.objects.create(user=user, plan=plan, provider_codename=dummy.codename)
+
+    batch_sizes = []
+
+    def check_payments(payments):
+        batch_sizes.append(len(payments))
+        # only first payment of each batch is resolved
+        SubscriptionPayment.objects.filter(pk=payments[0].pk).update(status=SubscriptionPayment.Status.COMPLETED)
+
+    with mock.patch.object(dummy, 'check_payments', check_payments):
+        results = check_unfinished_payments(batch_size=2)
+
+    assert batch_sizes == [2, 2, 1]
+    result = results[dummy.codename]
+    assert (result.num_payments, result.num_batches, result.num_still_pending, result.error) == (5, 3, 2, None)
+
+
+@pytest.mark.django_db(transaction=True, databases=['actual_db'])
+def test__tasks__check_unfinished_payments__providers_are_independent(user, plan, settings):
+    settings.SUBSCRIPTIONS_PAYMENT_PROVIDERS = [
+        'subscriptions.providers.dummy.DummyProvider',
+        'subscriptions.providers.paddle.PaddleProvider',
+    ]
+    get_provider.cache_clear()
+    get_providers.cache_clear()
+    dummy, paddle = get_provider('dummy'), get_provider('paddle')
+
+    for provider in (dummy, paddle):
+        SubscriptionPayment.objects.create(user=user, plan=plan, provider_codename=provider.codename)
+
+    dummy_checked = Event()
+
+    def slow_paddle_check(payments):
+        # paddle is still being checked while dummy is done
+        assert dummy_checked.wait(timeout=5)
+        raise ProviderUnavailable('Paddle is down')
+
+    with mock.patch.object(dummy, 'check_payments', lambda payments: dummy_checked.set()), \
+         mock.patch.object(paddle, 'check_payments', slow_paddle_check):
+        results = check_unfinished_payments()
+
+    assert results['dummy'].error is None
+    assert results['dummy'].num_batches == 1
+    assert results['paddle'].error.startswith('Paddle is down')
+    assert results['paddle'].num_batches == 0
+
+    get_provider.cache_clear()
+    get_providers.cache_clear()
+
+
 @pytest.mark.django_db(databases=['actual_db'])
 def test__tasks__notify_stuck_pending_payments(subscription, user, caplog):
     min_age = days(3)
@@ -328,3 +750,127 @@ def test__tasks__notify_stuck_pending_payments(subscription, user, caplog):
         assert len(caplog.records) == 2
         assert caplog.records[0].message == f'Payment stuck in pending state: {very_old_payment}'
         assert caplog.records[1].message == f'Payment stuck in pending state: {slightly_old_payment}'
+
+
+@pytest.fixture
+def paddle_expiring_subscriptions(paddle, user, plan) -> list[Subscription]:
+    """ Subscriptions which expired 2 days ago and were paid with paddle. """
+
+    subscriptions = []
+    for i in range(5):
+        end = now() - days(2) - timedelta(minutes=i)
+        subscription = Subscription.objects.create(user=user, plan=plan, start=end - plan.charge_period, end=end)
+        SubscriptionPayment.objects.create(
+            user=user,
+            plan=plan,
+            subscription=subscription,
+            provider_codename=paddle.codename,
+            amount=usd(100),
+            status=SubscriptionPayment.Status.COMPLETED,
+            subscription_start=subscription.start,
+            subscription_end=subscription.end,
+            metadata={'subscription_id': str(1000 + i)},
+            created=subscription.start,
+        )
+        subscriptions.append(subscription)
+
+    return subscriptions
+
+
+@pytest.mark.django_db(transaction=True, databases=['actual_db'])
+def test__tasks__acharge_recurring_subscriptions(paddle_server, paddle_expiring_subscriptions, charge_schedule):
+    summary = asyncio.run(acharge_recurring_subscriptions(schedule=charge_schedule, chunk_size=2, max_in_flight=3))
+    assert summary.get_counts() == {
+        ChargeOutcome.CHARGED: 5,
+        ChargeOutcome.SKIPPED: 0,
+        ChargeOutcome.DEFERRED: 0,
+        ChargeOutcome.FAILED: 0,
+    }
+    assert sorted(path for path, _ in paddle_server.requests) == [f'/subscription/{1000 + i}/charge' for i in range(5)]
+
+    for subscription in paddle_expiring_subscriptions:
+        initial_end = subscription.end
+        subscription.refresh_from_db()
+        assert subscription.end == initial_end + subscription.plan.charge_period
+
+    # no placeholders are left
+    assert not SubscriptionPayment.objects.filter(status=SubscriptionPayment.Status.PENDING).exists()
+
+    # subsequent run doesn't charge again
+    summary = asyncio.run(acharge_recurring_subscriptions(schedule=charge_schedule))
+    assert summary.results == []
+    assert len(paddle_server.requests) == 5
+
+
+@pytest.mark.django_db(transaction=True, databases=['actual_db'])
+def test__tasks__acharge_recurring_subscriptions__fetch_error(paddle_server, paddle_expiring_subscriptions, charge_schedule):
+    paddle_server.charge_delay = 0.2
+
+    def fail_second_fetch(candidates, after):
+        if after != (None, None):
+            raise DatabaseError('connection lost')
+        return _after_key(candidates, after)
+
+    # first chunk is being charged when fetching the second one fails
+    with mock.patch('subscriptions.tasks._after_key', fail_second_fetch):
+        with pytest.raises(DatabaseError):
+            asyncio.run(acharge_recurring_subscriptions(schedule=charge_schedule, chunk_size=2))
+
+    # charges in flight are completed and saved to the checkpoint
+    assert len(paddle_server.requests) == 2
+    assert not SubscriptionPayment.objects.filter(status=SubscriptionPayment.Status.PENDING).exists()
+    run = ChargeRun.objects.get()
+    assert run.num_charged == 2
+    assert run.finished is None
+
+
+@pytest.mark.django_db(transaction=True, databases=['actual_db'])
+def test__tasks__acharge_recurring_subscriptions__pending(paddle_server, paddle_expiring_subscriptions, charge_schedule):
+    paddle_server.charge_status = 'pending'
+
+    summary = asyncio.run(acharge_recurring_subscriptions(schedule=charge_schedule))
+    assert summary.get_counts()[ChargeOutcome.CHARGED] == 5
+
+    pending = SubscriptionPayment.objects.filter(status=SubscriptionPayment.Status.PENDING)
+    assert pending.count() == 5
+    assert all(payment.metadata['status'] == 'pending' for payment in pending)
+
+
+@pytest.mark.django_db(transaction=True, databases=['actual_db'])
+def test__tasks__acharge_recurring_subscriptions__provider_unavailable(paddle, paddle_server, paddle_expiring_subscriptions, charge_schedule):
+    num_payments = SubscriptionPayment.objects.count()
+
+    with mock.patch.object(paddle.circuit_breaker, 'before_call', side_effect=ProviderUnavailable('down')):
+        summary = asyncio.run(acharge_recurring_subscriptions(schedule=charge_schedule))
+
+    assert summary.get_counts()[ChargeOutcome.DEFERRED] == 5
+    assert not paddle_server.requests
+    assert SubscriptionPayment.objects.count() == num_payments
+
+
+@pytest.mark.django_db(transaction=True, databases=['actual_db'])
+def test__tasks__acharge_recurring_subscriptions__placeholders(paddle_server, paddle_expiring_subscriptions, charge_schedule, caplog):
+    # placeholders left by a crashed run, and by a run which is still in flight
+    stale_subscription, in_flight_subscription = paddle_expiring_subscriptions[:2]
+    for subscription, created in [(stale_subscription, now() - timedelta(hours=2)), (in_flight_subscription, now())]:
+        SubscriptionPayment.objects.create(
+            provider_codename='',
+            status=SubscriptionPayment.Status.PENDING,
+            user=subscription.user,
+            plan=subscription.plan,
+            subscription=subscription,
+            metadata={CHARGE_PLACEHOLDER_METADATA_KEY: True},
+            created=created,
+        )
+
+    # placeholders are not real payments
+    assert check_unfinished_payments(within=timedelta(days=1)) == {}
+    with caplog.at_level(logging.ERROR):
+        notify_stuck_pending_payments(older_than=timedelta(0))
+    assert not caplog.records
+
+    # stale placeholder is deleted, so its subscription is charged; in-flight one is left alone
+    summary = asyncio.run(acharge_recurring_subscriptions(schedule=charge_schedule))
+    charged = {result.subscription_uid for result in summary.results if result.outcome == ChargeOutcome.CHARGED}
+    assert charged == {subscription.uid for subscription in paddle_expiring_subscriptions} - {in_flight_subscription.uid}
+    assert list(SubscriptionPayment.objects.filter(metadata__has_key=CHARGE_PLACEHOLDER_METADATA_KEY).values_list('subscription', flat=True)) == [in_flight_subscription.pk]
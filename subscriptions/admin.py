@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Plan, Quota, Resource, Subscription, SubscriptionPayment, SubscriptionPaymentRefund, Tax, Usage, Tier, Feature
+from .models import ChargeRun, Plan, Quota, Resource, Subscription, SubscriptionPayment, SubscriptionPaymentRefund, Tax, Usage, Tier, Feature, WebhookHistoryCursor, SubscriptionsSnapshot, PaymentsSnapshot
 
 
 class QuotaInline(admin.TabularInline):
@@ -121,3 +121,28 @@ class TaxAdmin(admin.ModelAdmin):
     search_fields = 'subscription_payment__user__email',
     queryset = Tax.objects.select_related('subscription_payment')
     ordering = '-pk',
+
+
+@admin.register(ChargeRun)
+class ChargeRunAdmin(admin.ModelAdmin):
+    list_display = 'uid', 'started', 'finished', 'num_charged', 'num_skipped', 'num_deferred', 'num_failed', 'throughput',
+    readonly_fields = 'resumed_from', 'started', 'updated', 'finished', 'cursor_end', 'cursor_uid',
+    ordering = '-started',
+
+
+@admin.register(WebhookHistoryCursor)
+class WebhookHistoryCursorAdmin(admin.ModelAdmin):
+    list_display = 'provider_codename', 'alert_id', 'alert_created', 'updated',
+
+
+@admin.register(SubscriptionsSnapshot)
+class SubscriptionsSnapshotAdmin(admin.ModelAdmin):
+    list_display = 'date', 'new_count', 'ended_count', 'active_count', 'active_users_count', 'updated',
+    ordering = '-date',
+
+
+@admin.register(PaymentsSnapshot)
+class PaymentsSnapshotAdmin(admin.ModelAdmin):
+    list_display = 'date', 'provider_codename', 'status', 'currency', 'count', 'total', 'updated',
+    list_filter = 'provider_codename', 'status', 'currency',
+    ordering = '-date',
@@ -28,3 +28,34 @@ DEFAULT_SUBSCRIPTIONS_CACHE_NAME = 'subscriptions'
 DEFAULT_SUBSCRIPTIONS_CURRENCY = 'USD'
 DEFAULT_SUBSCRIPTIONS_TRIAL_PERIOD = relativedelta(seconds=0)
 DEFAULT_NOTIFY_PENDING_PAYMENTS_AFTER = timedelta(days=1)
+
+# report snapshots of this many last days are recomputed on every update, so that
+# late changes (e.g. payment status updates or prolongation after the end) are picked up
+DEFAULT_SUBSCRIPTIONS_REPORT_SNAPSHOTS_REFRESH_PERIOD = timedelta(days=7)
+
+# results of report methods are cached in `SUBSCRIPTIONS_CACHE_NAME` cache: forever if report
+# period ended more than `settle_delay` ago, and for `ttl` otherwise; bump `version` to drop cached results
+DEFAULT_SUBSCRIPTIONS_REPORT_CACHE = {
+    'enabled': False,
+    'settle_delay': timedelta(days=1),
+    'ttl': timedelta(minutes=5),
+    'version': 1,
+}
+
+# usages buffered by `UsageBuffer` are inserted when there are `max_size` of them, or the oldest is `max_delay` old
+DEFAULT_SUBSCRIPTIONS_USAGE_BUFFER = {
+    'max_size': 1000,
+    'max_delay': timedelta(seconds=1),
+}
+
+# provider codename -> {'rate': <requests per second>, 'burst': <requests>, 'max_concurrency': <requests>}
+DEFAULT_SUBSCRIPTIONS_PROVIDER_LIMITS: dict[str, dict] = {}
+
+# may be overridden per provider codename with `SUBSCRIPTIONS_PROVIDER_CIRCUIT_BREAKERS` setting
+DEFAULT_SUBSCRIPTIONS_PROVIDER_CIRCUIT_BREAKER = {
+    'enabled': True,
+    'failure_rate': 0.5,
+    'min_calls': 10,
+    'window': timedelta(minutes=1),
+    'reset_timeout': timedelta(seconds=30),
+}
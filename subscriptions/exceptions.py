@@ -45,5 +45,9 @@ class BadReferencePayment(PaymentError):
     pass
 
 
+class ProviderUnavailable(PaymentError):
+    pass
+
+
 class InvalidOperation(Exception):
     pass
@@ -1,24 +1,31 @@
 from __future__ import annotations
 
+import atexit
+import threading
+from collections import Counter
 from contextlib import contextmanager, suppress
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from functools import cached_property
-from itertools import chain
+from itertools import chain, count, takewhile
 from logging import getLogger
 from operator import attrgetter
 from typing import Callable, Iterable, Iterator
+from uuid import uuid4
+from weakref import WeakValueDictionary
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser
 from django.core.cache import InvalidCacheBackendError, caches
 from django.core.cache.backends.base import BaseCache
-from django.db import transaction
-from django.db.models import Prefetch
+from django.db import connections, router, transaction
+from django.db.models import Prefetch, QuerySet
 from django.utils.timezone import now
-from more_itertools import spy
+from dateutil.relativedelta import relativedelta
+from more_itertools import chunked, peekable, spy
 
-from .defaults import DEFAULT_SUBSCRIPTIONS_CACHE_NAME
+from .defaults import DEFAULT_SUBSCRIPTIONS_CACHE_NAME, DEFAULT_SUBSCRIPTIONS_USAGE_BUFFER
 from .exceptions import InconsistentQuotaCache, QuotaLimitExceeded
 from .models import (
     MAX_DATETIME,
@@ -32,13 +39,14 @@ from .models import (
     Tier,
     Usage,
 )
+from .periods import as_period
 from .utils import HardDBLock, merge_iter
 
 log = getLogger(__name__)
 
 
-def iter_subscriptions_involved(user: AbstractUser, at: datetime) -> Iterator['Subscription']:
-    subscriptions = (
+def get_subscriptions_with_quotas(user: AbstractUser) -> QuerySet:
+    return (
         Subscription.objects
         .select_related('plan')
         .prefetch_related(Prefetch(
@@ -46,6 +54,12 @@ def iter_subscriptions_involved(user: AbstractUser, at: datetime) -> Iterator['S
             queryset=Quota.objects.select_related('resource'),
         ))
         .filter(user=user)
+    )
+
+
+def iter_subscriptions_involved(user: AbstractUser, at: datetime) -> Iterator['Subscription']:
+    subscriptions = (
+        get_subscriptions_with_quotas(user)
         .exclude(start__gt=at)
         .order_by('-end')
     )
@@ -78,6 +92,30 @@ def iter_subscriptions_quota_chunks(
     )
 
 
+def consume_chunks(chunks: Iterable[QuotaChunk], date: datetime, resource_id: int, amount: int):
+    """ Consume `amount` of resource used at `date` from `chunks`, starting from chunks which end first. """
+
+    # select & sort chunks to consume from
+    chunks_to_consume = sorted(
+        (chunk for chunk in chunks if chunk.start <= date < chunk.end and chunk.resource.id == resource_id),
+        key=attrgetter('end'),
+    )
+
+    # consume chunks
+    for chunk in chunks_to_consume:
+        if amount <= chunk.remains:
+            chunk.remains -= amount
+            amount = 0
+            break
+        else:
+            amount -= chunk.remains
+            chunk.remains = 0
+
+    # check whether limit was exceeded (== amount was fully covered by chunks consumed)
+    if amount:
+        log.error('Quota limit exceeded: usage date=%s overused=%s', date, amount)
+
+
 def get_remaining_chunks(
     user: AbstractUser,
     at: datetime | None = None,
@@ -137,25 +175,7 @@ def get_remaining_chunks(
         # remove stale chunks
         active_chunks = [chunk for chunk in active_chunks if chunk.end >= date]
 
-        # select & sort chunks to consume from
-        chunks_to_consume = sorted(
-            (chunk for chunk in active_chunks if chunk.start <= date < chunk.end and chunk.resource.id == resource_id),
-            key=attrgetter('end'),
-        )
-
-        # consume chunks
-        for chunk in chunks_to_consume:
-            if amount <= chunk.remains:
-                chunk.remains -= amount
-                amount = 0
-                break
-            else:
-                amount -= chunk.remains
-                chunk.remains = 0
-
-        # check whether limit was exceeded (== amount was fully covered by chunks consumed)
-        if amount:
-            log.error('Quota limit exceeded: usage date=%s overused=%s', date, amount)
+        consume_chunks(active_chunks, date, resource_id, amount)
 
     # ---- now calculate remaining amount at `at` ----
 
@@ -213,6 +233,69 @@ def get_remaining_amount(
     return amount
 
 
+def iter_remaining_amounts(
+    user: AbstractUser,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    step: timedelta | relativedelta | None = None,
+    points: Iterable[datetime] | None = None,
+) -> Iterator[tuple[datetime, dict[Resource, int]]]:
+    """
+    Remaining amount of resources at each of `points` (in ascending order), or at each `step`
+    from `since` to `until` inclusive. Same as `get_remaining_amount(user, at=point)` for every
+    point, but quota chunks and usages are swept only once, so it takes O(chunks + usages + points).
+    """
+
+    if points is None:
+        assert since and until and step, 'Provide either `points` or `since`, `until` and `step`'
+        points = takewhile(lambda point: point <= until, (since + i * step for i in count()))
+
+    points = list(points)
+    if not points:
+        return
+    assert points == sorted(points), 'Points should be in ascending order'
+    first, last = points[0], points[-1]
+
+    # subscriptions before `first` affect the result only if they are chained with a subscription active at `first`
+    chain_start = min((subscription.start for subscription in iter_subscriptions_involved(user=user, at=first)), default=first)
+    subscriptions = get_subscriptions_with_quotas(user).filter(start__lte=last, end__gt=chain_start)
+    quota_chunks = peekable(iter_subscriptions_quota_chunks(subscriptions, since=None, until=last, sort_by=attrgetter('start', 'end')))
+
+    if not quota_chunks:
+        for point in points:
+            yield point, {}
+        return
+
+    usages = peekable(
+        Usage.objects
+        .filter(user=user, datetime__gte=quota_chunks.peek().start, datetime__lte=last)
+        .order_by('datetime')
+        .values_list('datetime', 'resource', 'amount')
+        .iterator()
+    )
+
+    active_chunks = []
+
+    def add_started_chunks(date: datetime):
+        while quota_chunks and quota_chunks.peek().start <= date:
+            active_chunks.append(next(quota_chunks))
+
+    for point in points:
+        while usages and usages.peek()[0] <= point:
+            date, resource_id, amount = next(usages)
+            add_started_chunks(date)
+            active_chunks = [chunk for chunk in active_chunks if chunk.end >= date]
+            consume_chunks(active_chunks, date, resource_id, amount)
+
+        add_started_chunks(point)
+        active_chunks = [chunk for chunk in active_chunks if chunk.end > point]  # later usages can't consume ended chunks
+
+        amount = {}
+        for chunk in active_chunks:
+            amount[chunk.resource] = amount.setdefault(chunk.resource, 0) + chunk.remains
+        yield point, amount
+
+
 @contextmanager
 def use_resource(user: AbstractUser, resource: Resource, amount: int = 1, raises: bool = True) -> int:
     with HardDBLock('use_resource', f'{user.id}00{resource.id}'):
@@ -220,6 +303,8 @@ def use_resource(user: AbstractUser, resource: Resource, amount: int = 1, raises
         # Lock value will be a string-integer, for user id 12 and resource id 30 it will be 120030.
 
         available = get_remaining_amount(user).get(resource, 0)
+        if _usage_buffer:
+            available -= _usage_buffer.get_pending_amount(user.pk, resource.pk)
         remains = available - amount
 
         if remains < 0 and raises:
@@ -233,6 +318,151 @@ def use_resource(user: AbstractUser, resource: Resource, amount: int = 1, raises
         yield remains
 
 
+def record_usages(usages: Iterable[Usage], batch_size: int = 1000) -> int:
+    """
+    Insert usages with `bulk_create` in batches of `batch_size`, e.g. when importing usage
+    from logs. Quotas are not checked; usages without `datetime` are recorded at current time.
+    All batches are inserted in a single transaction, so either all usages are recorded or none.
+    Returns number of usages inserted.
+    """
+
+    now_ = now()
+    user_ids = set()
+    num_usages = 0
+    with transaction.atomic(using=router.db_for_write(Usage)):
+        for batch in chunked(usages, batch_size):
+            for usage in batch:
+                usage.datetime = usage.datetime or now_
+                user_ids.add(usage.user_id)
+            Usage.objects.bulk_create(batch)
+            num_usages += len(batch)
+
+    # cached remaining chunks don't include usages older than cache, so they are dropped
+    if user_ids and (cache := get_cache_or_none(get_cache_name())):
+        cache.delete_many(list(user_ids))
+
+    return num_usages
+
+
+class UsageBuffer:
+    """
+    In-process buffer of usages, which are inserted with `record_usages` when `max_size` of them
+    are buffered, or when the oldest of them is `max_delay` old. Quota checks of `use_resource`
+    take buffered usages into account, but only within this process: other processes see them
+    only after they are flushed.
+    """
+
+    def __init__(self, max_size: int = 1000, max_delay: timedelta = timedelta(seconds=1)):
+        self.max_size = max_size
+        self.max_delay = max_delay
+
+        self._lock = threading.Lock()
+        self._usages: list[Usage] = []
+        self._pending: Counter[tuple[int, int]] = Counter()  # (user id, resource id) -> buffered amount
+        self._resource_locks: WeakValueDictionary[tuple[int, int], threading.Lock] = WeakValueDictionary()
+        self._timer: threading.Timer | None = None
+
+    def get_pending_amount(self, user_id: int, resource_id: int) -> int:
+        with self._lock:
+            return self._pending[(user_id, resource_id)]
+
+    @contextmanager
+    def use_resource(self, user: AbstractUser, resource: Resource, amount: int = 1, raises: bool = True) -> int:
+        """
+        Same as `use_resource`, but usage is buffered; operations are blocked per user and resource
+        within this process only. Usage is buffered only if the block exits without an exception.
+        """
+
+        key = (user.pk, resource.pk)
+        with self._lock:
+            resource_lock = self._resource_locks.setdefault(key, threading.Lock())
+
+        with resource_lock:
+            available = get_remaining_amount(user).get(resource, 0) - self.get_pending_amount(*key)
+            remains = available - amount
+
+            if remains < 0 and raises:
+                raise QuotaLimitExceeded(f'Not enough {resource}: tried to use {amount}, but only {available} is available')
+
+            used_at = now()
+            yield remains
+            self.add(Usage(user=user, resource=resource, amount=amount, datetime=used_at))
+
+    def add(self, usage: Usage):
+        with self._lock:
+            self._usages.append(usage)
+            self._pending[(usage.user_id, usage.resource_id)] += usage.amount
+
+            is_full = len(self._usages) >= self.max_size or now() - self._usages[0].datetime >= self.max_delay
+            if not is_full:
+                self._schedule_flush()
+
+        if is_full:
+            self.flush()
+
+    def flush(self) -> int:
+        """ Insert all buffered usages; returns number of usages inserted. """
+
+        with self._lock:
+            usages, self._usages = self._usages, []
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+
+        if not usages:
+            return 0
+
+        try:
+            record_usages(usages, batch_size=self.max_size)
+        except Exception:
+            # nothing was inserted, so usages (and their pending amounts) are kept to retry with next flush
+            with self._lock:
+                self._usages[:0] = usages
+                self._schedule_flush()
+            raise
+
+        with self._lock:
+            for usage in usages:
+                self._pending[(usage.user_id, usage.resource_id)] -= usage.amount
+            self._pending = +self._pending  # drop zero amounts
+
+        return len(usages)
+
+    def _schedule_flush(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self.max_delay.total_seconds(), self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            log.exception('Could not flush %s buffered usages', len(self._usages))
+        finally:
+            connections.close_all()  # timer thread's connections
+
+
+_usage_buffer: UsageBuffer | None = None
+_usage_buffer_lock = threading.Lock()
+
+
+def get_usage_buffer() -> UsageBuffer:
+    """ Process-wide `UsageBuffer` configured with `SUBSCRIPTIONS_USAGE_BUFFER` setting; it is flushed on exit. """
+
+    global _usage_buffer
+
+    with _usage_buffer_lock:
+        if _usage_buffer is None:
+            _usage_buffer = UsageBuffer(**{
+                **DEFAULT_SUBSCRIPTIONS_USAGE_BUFFER,
+                **getattr(settings, 'SUBSCRIPTIONS_USAGE_BUFFER', {}),
+            })
+            atexit.register(_usage_buffer.flush)
+
+    return _usage_buffer
+
+
 def merge_feature_sets(*feature_sets: Iterable[Feature]) -> set[Feature]:
     """
     Merge features from different subscriptions in human-meaningful way.
@@ -344,6 +574,45 @@ def add_default_plan_to_users():
         )
 
 
+REFRESH_MOMENTS_CACHE_KEY = 'refresh_moments:{user_id}:{assume_subscription_refresh:d}'
+REFRESH_MOMENTS_CATALOG_KEY = 'refresh_moments:catalog'
+
+
+@dataclass
+class RefreshMomentsCache:
+    """ Refresh moments computed at `since`, which stay the same until `until` (inclusive). """
+
+    catalog: str | None
+    since: datetime
+    until: datetime
+    moments: dict[Resource, datetime]
+
+    def is_valid(self, at: datetime, catalog: str | None) -> bool:
+        return catalog == self.catalog and self.since <= at <= self.until
+
+
+def get_configured_cache() -> BaseCache | None:
+    """ Same as `get_cache_or_none`, but missing cache is not logged; used on every save. """
+
+    if (cache_name := get_cache_name()) in settings.CACHES:
+        return caches[cache_name]
+
+
+def drop_refresh_moments_cache(user_id: int):
+    if cache := get_configured_cache():
+        cache.delete_many([
+            REFRESH_MOMENTS_CACHE_KEY.format(user_id=user_id, assume_subscription_refresh=assume_subscription_refresh)
+            for assume_subscription_refresh in (False, True)
+        ])
+
+
+def drop_refresh_moments_catalog_cache():
+    """ Invalidate refresh moments of all users, e.g. after plans or quotas were changed. """
+
+    if cache := get_configured_cache():
+        cache.set(REFRESH_MOMENTS_CATALOG_KEY, uuid4().hex, timeout=None)
+
+
 def get_resource_refresh_moments(
     user: AbstractUser,
     at: datetime | None = None,
@@ -355,17 +624,34 @@ def get_resource_refresh_moments(
 
     If `assume_subscription_refresh` is set to `True` we allow
     the recharge moments to be beyond the current subscription end.
+
+    Result is cached per user and reused until the earliest refresh moment, or until any of user's
+    subscriptions starts or ends; it is dropped when user's subscriptions, plans or quotas are saved.
     """
     at = at or now()
+
+    cache = get_cache_or_none(get_cache_name())
+    if cache:
+        key = REFRESH_MOMENTS_CACHE_KEY.format(user_id=user.pk, assume_subscription_refresh=assume_subscription_refresh)
+        cached = cache.get_many([key, REFRESH_MOMENTS_CATALOG_KEY])
+        catalog = cached.get(REFRESH_MOMENTS_CATALOG_KEY)
+        if (refresh_moments_cache := cached.get(key)) and refresh_moments_cache.is_valid(at, catalog):
+            return dict(refresh_moments_cache.moments)
+
     result = {}
     datetime_max = datetime.max.replace(tzinfo=timezone.utc)
+    # set of involved subscriptions changes only when one of them ends, or a new one starts
+    changes_at = []
+    if cache and (next_start := Subscription.objects.filter(user=user, start__gt=at).order_by('start').values_list('start', flat=True).first()):
+        changes_at.append(next_start)
 
     for subscription in iter_subscriptions_involved(user, at):
+        if subscription.end > at:
+            changes_at.append(subscription.end)
         for quota in subscription.plan.quotas.all():
             # Find first moment after `at` that will be a recharge.
-            recharge_moment = subscription.start
-            while recharge_moment < at:
-                recharge_moment += quota.recharge_period
+            recharge_period = as_period(quota.recharge_period)
+            recharge_moment = recharge_period.nth_boundary(subscription.start, recharge_period.index_at(subscription.start, at))
             # If we get a recharge after the subscription will end, it is of no use.
             if recharge_moment >= subscription.end and not assume_subscription_refresh:
                 continue
@@ -373,4 +659,12 @@ def get_resource_refresh_moments(
             # point at the one that happens earliest.
             result[quota.resource] = min(result.get(quota.resource, datetime_max), recharge_moment)
 
+    if cache:
+        cache.set(key, RefreshMomentsCache(
+            catalog=catalog,
+            since=at,
+            until=min([*result.values(), *(moment - timedelta(microseconds=1) for moment in changes_at)], default=datetime_max),
+            moments=result,
+        ))
+
     return result
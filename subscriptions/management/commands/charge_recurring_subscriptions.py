@@ -1,11 +1,66 @@
+import asyncio
 import logging
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from ...tasks import charge_recurring_subscriptions
+from ...tasks import (
+    acharge_recurring_subscriptions,
+    charge_recurring_subscriptions,
+    get_resumable_charge_run,
+    plan_recurring_charges,
+)
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=None)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--max-in-flight', type=int, default=None)
+        parser.add_argument('--async', action='store_true', dest='use_async', help='Use asyncio instead of threads')
+        parser.add_argument('--resume', action='store_true', help='Continue latest run which did not finish')
+        parser.add_argument('--checkpoint-every', type=int, default=100)
+        parser.add_argument('--dry-run', action='store_true', help='Only show what would be charged')
+
     def handle(self, *args, **options):
         logging.basicConfig(level=logging.DEBUG)
-        charge_recurring_subscriptions()
+
+        if options['dry_run']:
+            plan = plan_recurring_charges(chunk_size=options['chunk_size'])
+            for outcome, count in plan.get_counts().items():
+                self.stdout.write(f'{outcome.value}: {count}')
+            for reason, count in plan.skip_reasons.items():
+                self.stdout.write(f'{reason.value}: {count}')
+            for codename, count in plan.provider_calls.items():
+                self.stdout.write(f'provider calls ({codename}): {count}')
+            for currency, amount in plan.amounts.items():
+                self.stdout.write(f'amount ({currency}): {amount.amount}')
+            self.stdout.write(f'duration: {plan.duration}')
+            return
+
+        resume = None
+        if options['resume']:
+            if not (resume := get_resumable_charge_run()):
+                raise CommandError('There is no unfinished run to resume')
+            self.stdout.write(f'resuming run {resume}')
+
+        if options['use_async']:
+            summary = asyncio.run(acharge_recurring_subscriptions(
+                chunk_size=options['chunk_size'],
+                max_in_flight=options['max_in_flight'] or 1000,
+                resume=resume,
+                checkpoint_every=options['checkpoint_every'],
+            ))
+        else:
+            summary = charge_recurring_subscriptions(
+                num_threads=options['threads'],
+                chunk_size=options['chunk_size'],
+                max_in_flight=options['max_in_flight'],
+                resume=resume,
+                checkpoint_every=options['checkpoint_every'],
+            )
+        for outcome, count in summary.get_counts().items():
+            self.stdout.write(f'{outcome.value}: {count}')
+        self.stdout.write(f'duration: {summary.duration}')
+        if summary.run:
+            self.stdout.write(f'run: {summary.run.uid}')
+            self.stdout.write(f'throughput: {summary.run.throughput or 0:.1f} subscriptions/s')
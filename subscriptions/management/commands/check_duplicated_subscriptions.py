@@ -1,8 +1,15 @@
 from django.core.management.base import BaseCommand
 
 from ...tasks import check_duplicated_payments
+from ...utils import fromisoformat
 
 
 class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', type=fromisoformat, default=None,
+            help='Only check transaction IDs with payments created since this ISO datetime',
+        )
+
     def handle(self, *args, **options):
-        check_duplicated_payments()
+        check_duplicated_payments(since=options['since'])
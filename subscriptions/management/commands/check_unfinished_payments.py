@@ -8,6 +8,16 @@ from ...tasks import check_unfinished_payments
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--within', type=int, default=24)
+        parser.add_argument('--batch-size', type=int, default=100)
 
     def handle(self, *args, **options):
-        check_unfinished_payments(within=timedelta(hours=options['within']))
+        results = check_unfinished_payments(
+            within=timedelta(hours=options['within']),
+            batch_size=options['batch_size'],
+        )
+        for result in results.values():
+            error = f', error: {result.error}' if result.error else ''
+            self.stdout.write(
+                f'{result.codename}: {result.num_payments} payments, {result.num_still_pending} still pending, '
+                f'{result.num_batches} batches, duration: {result.duration}{error}'
+            )
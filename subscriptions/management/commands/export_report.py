@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+
+from ...reports import EXPORT_FORMATS, export_report
+from ...utils import fromisoformat
+
+
+class Command(BaseCommand):
+    help = 'Stream report rows within [since, until) period as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('report', choices=['subscriptions', 'transactions'])
+        parser.add_argument('kind', help='subscriptions: new, ended, active; transactions: payments, completed, incompleted, refunds')
+        parser.add_argument('--since', type=fromisoformat, required=True, help='ISO datetime')
+        parser.add_argument('--until', type=fromisoformat, default=None, help='ISO datetime, now by default')
+        parser.add_argument('--provider', default='', help='Provider codename, required for transactions')
+        parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csv')
+        parser.add_argument('--output', default=None, help='Output file, stdout by default')
+
+    def handle(self, *args, **options):
+        try:
+            lines = export_report(
+                report=options['report'],
+                kind=options['kind'],
+                since=options['since'],
+                until=options['until'] or now(),
+                format=options['format'],
+                provider_codename=options['provider'],
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as file:
+                file.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,17 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from ...tasks import update_report_snapshots
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since', type=date.fromisoformat, default=None,
+            help='First day (YYYY-MM-DD) to snapshot; by default, continues after the latest snapshot',
+        )
+
+    def handle(self, *args, **options):
+        days = update_report_snapshots(since=options['since'])
+        self.stdout.write(f'Snapshotted {len(days)} days' + (f': {days[0]} - {days[-1]}' if days else ''))
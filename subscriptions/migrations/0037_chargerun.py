@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-19 10:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0036_auto_20230711_0614'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChargeRun',
+            fields=[
+                ('uid', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('cursor_end', models.DateTimeField(blank=True, null=True)),
+                ('cursor_uid', models.UUIDField(blank=True, null=True)),
+                ('num_charged', models.PositiveIntegerField(default=0)),
+                ('num_skipped', models.PositiveIntegerField(default=0)),
+                ('num_deferred', models.PositiveIntegerField(default=0)),
+                ('num_failed', models.PositiveIntegerField(default=0)),
+                ('resumed_from', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='resumed_by', to='subscriptions.chargerun')),
+            ],
+            options={
+                'get_latest_by': 'started',
+            },
+        ),
+    ]
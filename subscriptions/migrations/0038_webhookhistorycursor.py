@@ -0,0 +1,22 @@
+# Generated by Django 4.2 on 2026-10-19 12:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0037_chargerun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookHistoryCursor',
+            fields=[
+                ('provider_codename', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('alert_id', models.BigIntegerField()),
+                ('alert_created', models.DateTimeField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2 on 2026-10-19 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0038_webhookhistorycursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionsSnapshot',
+            fields=[
+                ('date', models.DateField(primary_key=True, serialize=False)),
+                ('new_count', models.PositiveIntegerField()),
+                ('ended_count', models.PositiveIntegerField()),
+                ('active_count', models.PositiveIntegerField()),
+                ('active_users_count', models.PositiveIntegerField()),
+                ('active_plan_quantities', models.JSONField(default=dict)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'get_latest_by': 'date',
+            },
+        ),
+        migrations.CreateModel(
+            name='PaymentsSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('provider_codename', models.CharField(max_length=255)),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Preauth'), (2, 'Completed'), (3, 'Cancelled'), (4, 'Error')])),
+                ('currency', models.CharField(blank=True, max_length=3)),
+                ('count', models.PositiveIntegerField()),
+                ('total', models.DecimalField(blank=True, decimal_places=2, max_digits=20, null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='paymentssnapshot',
+            constraint=models.UniqueConstraint(fields=('date', 'provider_codename', 'status', 'currency'), name='unique_payments_snapshot'),
+        ),
+    ]
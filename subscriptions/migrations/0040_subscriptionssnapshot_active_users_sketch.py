@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-19 16:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0039_subscriptionssnapshot_paymentssnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='subscriptionssnapshot',
+            name='active_users_sketch',
+            field=models.BinaryField(blank=True, default=bytes),
+        ),
+    ]
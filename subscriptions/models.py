@@ -7,24 +7,31 @@ from datetime import datetime, timedelta, timezone
 from itertools import count, islice
 from logging import getLogger
 from operator import attrgetter
-from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Sequence
 from uuid import uuid4
 
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.db import models
 from django.db.models import (
+    Case,
     DateTimeField,
+    DurationField,
+    Exists,
     ExpressionWrapper,
     F,
     Index,
+    OuterRef,
     Q,
     QuerySet,
     UniqueConstraint,
+    Value,
+    When,
 )
 from django.db.models.functions import Least
 from django.urls import reverse
 from django.utils.timezone import now
+from more_itertools import pairwise
 from pydantic import BaseModel
 
 from .exceptions import (
@@ -34,14 +41,15 @@ from .exceptions import (
     ProviderNotFound,
 )
 from .fields import MoneyField, RelativeDurationField
-from .utils import merge_iter, AdvancedJSONEncoder
+from .periods import Period, as_period
+from .utils import merge_iter, AdvancedJSONEncoder, database_sync_to_async
 
 log = getLogger(__name__)
 
 if TYPE_CHECKING:
     from .providers import Provider
 
-INFINITY = relativedelta(days=365 * 1000)
+INFINITY = Period(days=365 * 1000)
 MAX_DATETIME = datetime.max.replace(tzinfo=timezone.utc)
 
 
@@ -178,18 +186,59 @@ class SubscriptionQuerySet(models.QuerySet):
         since = since or now()
         return self.filter(end__gte=since, end__lte=since + within)
 
+    def with_charge_period(self, schedule: Sequence[timedelta], at: datetime | None = None) -> QuerySet:
+        """
+        Annotate subscriptions with `charge_period_start` and `charge_period_end` -- boundaries
+        of offline charge attempt period (defined by `schedule` relative to subscription end)
+        which `at` falls within. If `at` doesn't fall within any period, NULLs are annotated.
+        """
+        at = at or now()
+        charge_periods = list(pairwise(sorted(schedule)))
+
+        def get_boundary(index: int) -> Case:
+            # `end + period[0] <= at < end + period[1]` <=> `at - period[1] < end <= at - period[0]`
+            return Case(
+                *(
+                    When(end__gt=at - period[1], end__lte=at - period[0], then=F('end') + Value(period[index]))
+                    for period in charge_periods
+                ),
+                default=None,
+                output_field=DateTimeField(),
+            )
+
+        return self.annotate(
+            charge_period_start=get_boundary(0),
+            charge_period_end=get_boundary(1),
+        )
+
+    def without_charge_attempts(self) -> QuerySet:
+        """
+        Leave only subscriptions which are within charge period (see `with_charge_period`)
+        and have neither a charge attempt in this period, nor any pending payment.
+        """
+        in_this_period = Q(created__gte=OuterRef('charge_period_start'), created__lt=OuterRef('charge_period_end'))
+        is_pending = Q(status=SubscriptionPayment.Status.PENDING)
+        charge_attempts = SubscriptionPayment.objects.filter(
+            in_this_period | is_pending,
+            subscription=OuterRef('pk'),
+        )
+        return self.filter(charge_period_start__isnull=False).filter(~Exists(charge_attempts))
+
     def recurring(self, predicate: bool = True) -> QuerySet:
         subscriptions = self.select_related('plan')
         return subscriptions.exclude(plan__charge_period=INFINITY) if predicate else subscriptions.filter(plan__charge_period=INFINITY)
 
+    def paid(self) -> QuerySet:
+        return self.filter(plan__charge_amount__gt=0)
+
     def with_ages(self, at: datetime | None = None) -> QuerySet:
         return self.annotate(
-            age=ExpressionWrapper(Least(at or now(), F('end')) - F('start'), output_field=DateTimeField()),
+            age=ExpressionWrapper(Least(at or now(), F('end')) - F('start'), output_field=DurationField()),
         )
 
-    def ended_or_ending(self) -> QuerySet:
-        now_ = now()
-        return self.filter(Q(end__lte=now_) | Q(end__gt=now_, auto_prolong=False))
+    def ended_or_ending(self, at: datetime | None = None) -> QuerySet:
+        at = at or now()
+        return self.filter(Q(end__lte=at) | Q(end__gt=at, auto_prolong=False))
 
     def new(self, since: datetime, until: datetime) -> QuerySet:
         """ Newly created subscriptions within selected period. """
@@ -287,11 +336,9 @@ class Subscription(models.Model):
         min_start_time = max(since - quota.burns_in + epsilon, self.start) if since else self.start  # quota chunks starting after this are OK
         until = min(until, self.end) if until else self.end
 
-        for i in count(start=0):
-            start = self.start + i * quota.recharge_period
-            if start < min_start_time:
-                continue
-
+        recharge_period = as_period(quota.recharge_period)
+        for i in count(start=recharge_period.index_at(self.start, min_start_time)):
+            start = recharge_period.nth_boundary(self.start, i)
             if start > until:
                 return
 
@@ -311,14 +358,12 @@ class Subscription(models.Model):
     ) -> Iterator[datetime]:
         """ Including first charge """
 
-        charge_period = self.plan.charge_period
+        charge_period = as_period(self.plan.charge_period)
+        anchor = self.start + self.initial_charge_offset
         since = since or self.start
 
-        for i in count(start=0):
-            charge_date = self.start + self.initial_charge_offset + charge_period * i
-
-            if charge_date < since:
-                continue
+        for i in count(start=charge_period.index_at(anchor, since)):
+            charge_date = charge_period.nth_boundary(anchor, i)
 
             if until and charge_date > until:
                 return
@@ -332,6 +377,16 @@ class Subscription(models.Model):
         return self.payments.filter(status=SubscriptionPayment.Status.COMPLETED).latest()
 
     def charge_offline(self) -> SubscriptionPayment:
+        provider, charge_kwargs = self.prepare_offline_charge()
+        return provider.charge_offline(**charge_kwargs)
+
+    async def acharge_offline(self) -> SubscriptionPayment:
+        provider, charge_kwargs = await database_sync_to_async(self.prepare_offline_charge)()
+        return await provider.acharge_offline(**charge_kwargs)
+
+    def prepare_offline_charge(self) -> tuple[Provider, dict]:
+        """ Find provider to charge this subscription with and arguments for its `charge_offline`. """
+
         from .providers import get_provider
 
         try:
@@ -345,7 +400,7 @@ class Subscription(models.Model):
         except ProviderNotFound as exc:
             raise PaymentError(f'Could not retrieve provider "{provider_codename}"') from exc
 
-        return provider.charge_offline(
+        return provider, dict(
             user=self.user,
             plan=self.plan,
             subscription=self,
@@ -604,4 +659,96 @@ class Tax(models.Model):
         return f'{self.id} {self.amount}'
 
 
+class ChargeRun(models.Model):
+    """ Progress of a single `charge_recurring_subscriptions` run. """
+
+    uid = models.UUIDField(primary_key=True, default=uuid4)
+    resumed_from = models.OneToOneField('self', on_delete=models.SET_NULL, blank=True, null=True, related_name='resumed_by')
+    started = models.DateTimeField(default=now)
+    updated = models.DateTimeField(auto_now=True)  # last checkpoint
+    finished = models.DateTimeField(blank=True, null=True)  # not set if run crashed or was interrupted
+
+    # Charge candidates are processed in (end, uid) order; all candidates up to
+    # this key (inclusive) were processed, so resumed run starts right after it.
+    cursor_end = models.DateTimeField(blank=True, null=True)
+    cursor_uid = models.UUIDField(blank=True, null=True)
+
+    num_charged = models.PositiveIntegerField(default=0)
+    num_skipped = models.PositiveIntegerField(default=0)
+    num_deferred = models.PositiveIntegerField(default=0)
+    num_failed = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        get_latest_by = 'started'
+
+    def __str__(self) -> str:
+        return f'{str(self.uid)[:8]} started={self.started} finished={self.finished} processed={self.num_processed}'
+
+    @property
+    def num_processed(self) -> int:
+        return self.num_charged + self.num_skipped + self.num_deferred + self.num_failed
+
+    @property
+    def duration(self) -> timedelta:
+        return (self.finished or self.updated) - self.started
+
+    @property
+    def throughput(self) -> float | None:
+        """ Processed subscriptions per second. """
+
+        if seconds := self.duration.total_seconds():
+            return self.num_processed / seconds
+
+
+class WebhookHistoryCursor(models.Model):
+    """ Last processed alert of provider's webhook history; older alerts are not fetched again. """
+
+    provider_codename = models.CharField(max_length=255, primary_key=True)
+    alert_id = models.BigIntegerField()
+    alert_created = models.DateTimeField()
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self) -> str:
+        return f'{self.provider_codename} alert={self.alert_id} created={self.alert_created}'
+
+
+class SubscriptionsSnapshot(models.Model):
+    """ `SubscriptionsReport` counts for a single closed UTC day, see `tasks.update_report_snapshots`. """
+
+    date = models.DateField(primary_key=True)
+    new_count = models.PositiveIntegerField()
+    ended_count = models.PositiveIntegerField()
+    active_count = models.PositiveIntegerField()
+    active_users_count = models.PositiveIntegerField()
+    active_plan_quantities = models.JSONField(default=dict)  # plan id -> total quantity of active subscriptions
+    active_users_sketch = models.BinaryField(blank=True, default=bytes)  # HyperLogLog registers of active users' ids, see `sketches`
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        get_latest_by = 'date'
+
+    def __str__(self) -> str:
+        return f'{self.date} new={self.new_count} ended={self.ended_count} active={self.active_count}'
+
+
+class PaymentsSnapshot(models.Model):
+    """ Number and total amount of `SubscriptionPayment`s for a single closed UTC day, per provider, status and currency. """
+
+    date = models.DateField()
+    provider_codename = models.CharField(max_length=255)
+    status = models.PositiveSmallIntegerField(choices=SubscriptionPayment.Status.choices)
+    currency = models.CharField(max_length=3, blank=True)  # empty if payments have no amount
+    count = models.PositiveIntegerField()
+    total = models.DecimalField(max_digits=20, decimal_places=2, blank=True, null=True)  # null if payments have no amount
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['date', 'provider_codename', 'status', 'currency'], name='unique_payments_snapshot'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.date} {self.provider_codename} {self.get_status_display()} {self.currency} count={self.count} total={self.total}'
+
+
 from .signals import create_default_subscription_for_new_user  # noqa
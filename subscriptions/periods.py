@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+from calendar import monthrange
+from datetime import datetime, timedelta
+from functools import lru_cache
+from math import ceil
+
+from dateutil.relativedelta import relativedelta
+
+AVERAGE_MONTH = timedelta(days=365.2425 / 12)
+RELATIVE_FIELDS = 'years', 'months', 'days', 'hours', 'minutes', 'seconds', 'microseconds'
+ABSOLUTE_FIELDS = 'year', 'month', 'day', 'weekday', 'hour', 'minute', 'second', 'microsecond'
+
+
+def relativedelta_to_dict(value: relativedelta) -> dict:
+    return {k: v for k, v in value.__dict__.items() if not k.startswith('_') and v}
+
+
+class Period(relativedelta):
+    """
+    Immutable `relativedelta` with fast boundaries `start + i * period`.
+
+    Period is compiled into a number of months and a fixed `timedelta`, so that boundaries
+    are computed without building intermediate `relativedelta`s, and index of a boundary
+    is found in O(1). Results are the same as of `relativedelta` arithmetic; periods with
+    absolute (`day=31`) or non-integer components fall back to it. Use `as_period`
+    to get a shared instance instead of creating new ones.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        is_integer = all(isinstance(getattr(self, name), int) for name in RELATIVE_FIELDS)
+        is_relative = all(getattr(self, name) is None for name in ABSOLUTE_FIELDS)
+        self._is_compiled = is_integer and is_relative and not self.leapdays
+        self._months = self.years * 12 + self.months if self._is_compiled else None
+        self._delta = timedelta(
+            days=self.days,
+            hours=self.hours,
+            minutes=self.minutes,
+            seconds=self.seconds,
+            microseconds=self.microseconds,
+        ) if self._is_compiled else None
+        self._is_frozen = True
+
+    def __setattr__(self, name, value):
+        # instances are shared between model instances, see `as_period`
+        if getattr(self, '_is_frozen', False):
+            raise AttributeError(f'{self.__class__.__name__} is immutable')
+        super().__setattr__(name, value)
+
+    def nth_boundary(self, start: datetime, index: int) -> datetime:
+        """ Same as `start + index * self`. """
+
+        if not self._is_compiled:
+            return start + index * self
+
+        if self._months:
+            months = start.month - 1 + self._months * index
+            year, month = start.year + months // 12, months % 12 + 1
+            start = start.replace(year=year, month=month, day=min(start.day, monthrange(year, month)[1]))
+
+        return start + self._delta * index
+
+    def index_at(self, start: datetime, at: datetime) -> int:
+        """
+        Smallest `index >= 0` such that `nth_boundary(start, index) >= at`, i.e. number
+        of boundaries earlier than `at`. Period should be positive.
+        """
+
+        if at <= start:
+            return 0
+
+        # mixed-sign periods like `relativedelta(months=1, days=-1)` have no simple estimate
+        if not self._is_compiled or self._months < 0 or self._delta < timedelta(0):
+            index = 0
+            while self.nth_boundary(start, index) < at:
+                index += 1
+            return index
+
+        if not self._months:
+            return -((start - at) // self._delta)
+
+        # month lengths vary, but month boundaries are never more than a few days
+        # away from average ones, so the estimate is off by a few steps at most
+        index = ceil((at - start) / (self._months * AVERAGE_MONTH + self._delta))
+        while index > 0 and self.nth_boundary(start, index - 1) >= at:
+            index -= 1
+        while self.nth_boundary(start, index) < at:
+            index += 1
+
+        return index
+
+
+@lru_cache(maxsize=1024)
+def _intern_period(items: tuple[tuple[str, int], ...]) -> Period:
+    return Period(**dict(items))
+
+
+def as_period(value: Period | relativedelta | timedelta | dict) -> Period:
+    """ Shared `Period` instance equal to `value`. """
+
+    if isinstance(value, Period):
+        return value
+
+    if isinstance(value, timedelta):
+        value = relativedelta(days=value.days, seconds=value.seconds, microseconds=value.microseconds)
+
+    if isinstance(value, relativedelta):
+        value = relativedelta_to_dict(value)
+
+    return _intern_period(tuple(sorted(value.items())))
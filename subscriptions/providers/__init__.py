@@ -19,6 +19,9 @@ from rest_framework.response import Response
 from ..defaults import DEFAULT_SUBSCRIPTIONS_PAYMENT_PROVIDERS
 from ..exceptions import ProviderNotFound
 from ..models import Plan, Subscription, SubscriptionPayment
+from ..utils import database_sync_to_async
+from .circuit_breakers import CircuitBreaker, get_provider_circuit_breaker
+from .limits import ProviderLimiter, get_provider_limiter
 
 log = getLogger(__name__)
 
@@ -31,6 +34,16 @@ class Provider:
     form: ClassVar[Form | None] = None
     metadata_class: ClassVar[BaseModel] = BaseModel
 
+    @property
+    def limiter(self) -> ProviderLimiter:
+        """ Rate & concurrency limits which should be respected by every call to provider API. """
+        return get_provider_limiter(self.codename)
+
+    @property
+    def circuit_breaker(self) -> CircuitBreaker:
+        """ Rejects calls to provider API while it is degraded. """
+        return get_provider_circuit_breaker(self.codename)
+
     def get_amount(self, user: AbstractBaseUser, plan: Plan) -> Money:
         return plan.charge_amount
 
@@ -64,6 +77,33 @@ class Provider:
     def check_payments(self, payments: Iterable[SubscriptionPayment]):
         raise NotImplementedError()
 
+    # Asyncio interface. By default, blocking methods are run in worker threads;
+    # providers with async API client should override these to avoid occupying a thread per call.
+
+    async def acharge_offline(
+        self,
+        user: AbstractBaseUser,
+        plan: Plan,
+        subscription: Subscription | None = None,
+        amount: Money | None = None,
+        quantity: int = 1,
+        reference_payment: SubscriptionPayment | None = None,
+    ) -> SubscriptionPayment:
+        return await database_sync_to_async(self.charge_offline)(
+            user=user,
+            plan=plan,
+            subscription=subscription,
+            amount=amount,
+            quantity=quantity,
+            reference_payment=reference_payment,
+        )
+
+    async def acheck_payments(self, payments: Iterable[SubscriptionPayment]):
+        await database_sync_to_async(self.check_payments)(payments)
+
+    async def aclose(self):
+        """ Release resources (i.e. pooled connections) held for current event loop. """
+
 
 @lru_cache
 def get_providers() -> list[Provider]:
@@ -70,7 +70,11 @@ class AppleInAppProvider(Provider):
     metadata_class = AppleInAppMetadata
 
     def __post_init__(self):
-        self.api = AppleAppStoreAPI(settings.APPLE_SHARED_SECRET)
+        self.api = AppleAppStoreAPI(
+            settings.APPLE_SHARED_SECRET,
+            limiter=self.limiter,
+            circuit_breaker=self.circuit_breaker,
+        )
         # Check whether the Apple certificate is provided and is a valid certificate.
         get_original_apple_certificate()
 
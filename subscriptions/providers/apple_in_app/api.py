@@ -14,6 +14,8 @@ from pydantic import (
 )
 from requests import HTTPError
 
+from ..circuit_breakers import CircuitBreaker, is_server_error
+from ..limits import ProviderLimiter
 from .enums import (
     AppleEnvironment,
     AppleValidationStatus,
@@ -117,9 +119,16 @@ class AppleAppStoreAPI:
     SANDBOX_ENDPOINT: ClassVar[str] = 'https://sandbox.itunes.apple.com/verifyReceipt'
     TIMEOUT_S: ClassVar[float] = 30.0
 
-    def __init__(self, apple_shared_secret: str):
+    def __init__(
+        self,
+        apple_shared_secret: str,
+        limiter: ProviderLimiter | None = None,
+        circuit_breaker: CircuitBreaker | None = None,
+    ):
         self._session = requests.Session()
         self._shared_secret = apple_shared_secret
+        self._limiter = limiter or ProviderLimiter()
+        self._circuit_breaker = circuit_breaker or CircuitBreaker()
 
     def fetch_receipt_data(self, receipt_data: str) -> AppleVerifyReceiptResponse:
         # https://developer.apple.com/documentation/appstorereceipts/verifyreceipt
@@ -141,7 +150,13 @@ class AppleAppStoreAPI:
             'password': self._shared_secret,
         }
 
-        response = self._session.post(endpoint, json=payload, timeout=self.TIMEOUT_S)
+        response = self._circuit_breaker.call(
+            self._limiter.limit(self._session.post),
+            endpoint,
+            json=payload,
+            timeout=self.TIMEOUT_S,
+            is_failure=is_server_error,
+        )
         if not response.ok:
             logger.warning('Apple service returned response %s with data "%s" to payload "%s".',
                            response.status_code, response.text, payload)
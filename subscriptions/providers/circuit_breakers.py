@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import timedelta
+from enum import Enum
+from functools import lru_cache, wraps
+from logging import getLogger
+from threading import Lock
+from time import monotonic
+from typing import Any, Awaitable, Callable
+
+import requests
+from django.conf import settings
+
+from ..defaults import DEFAULT_SUBSCRIPTIONS_PROVIDER_CIRCUIT_BREAKER
+from ..exceptions import ProviderUnavailable
+
+log = getLogger(__name__)
+
+
+def is_server_error(response: requests.Response) -> bool:
+    return response.status_code in range(500, 600)
+
+
+class CircuitState(str, Enum):
+    CLOSED = 'closed'  # calls pass through
+    OPEN = 'open'  # calls are rejected
+    HALF_OPEN = 'half_open'  # limited number of trial calls pass through
+
+
+@dataclass
+class CircuitBreaker:
+    """
+    Stop calling provider API when it is degraded.
+
+    If at least `min_calls` calls were made within last `window`, and at least
+    `failure_rate` of them failed, circuit opens and all calls are rejected
+    with `ProviderUnavailable` for `reset_timeout`. After that, circuit becomes
+    half-open and lets `half_open_calls` trial calls through: if they succeed,
+    circuit closes; otherwise it opens again.
+    """
+
+    name: str = ''
+    enabled: bool = True
+    failure_rate: float = 0.5
+    min_calls: int = 10
+    window: timedelta = timedelta(minutes=1)
+    reset_timeout: timedelta = timedelta(seconds=30)
+    half_open_calls: int = 1
+    clock: Callable[[], float] = field(default=monotonic, compare=False)
+
+    def __post_init__(self):
+        assert 0 < self.failure_rate <= 1, 'Failure rate should be within (0, 1]'
+        self._lock = Lock()
+        self._calls: deque[tuple[float, bool]] = deque()  # (time, is_success)
+        self._num_failures = 0
+        self._state = CircuitState.CLOSED
+        self._opened_at = 0.
+        self._num_trial_calls = 0
+
+    def _update_state(self) -> CircuitState:
+        if self._state == CircuitState.OPEN and self.clock() - self._opened_at >= self.reset_timeout.total_seconds():
+            log.info('Circuit breaker "%s" is half-open', self.name)
+            self._state = CircuitState.HALF_OPEN
+            self._num_trial_calls = 0
+        return self._state
+
+    def _open(self):
+        log.warning('Circuit breaker "%s" is open, calls are rejected for %s', self.name, self.reset_timeout)
+        self._state = CircuitState.OPEN
+        self._opened_at = self.clock()
+
+    def _close(self):
+        log.info('Circuit breaker "%s" is closed', self.name)
+        self._state = CircuitState.CLOSED
+        self._calls.clear()
+        self._num_failures = 0
+
+    @property
+    def state(self) -> CircuitState:
+        with self._lock:
+            return self._update_state()
+
+    def before_call(self):
+        """ Raise `ProviderUnavailable` if the call should not be made. """
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            state = self._update_state()
+
+            if state == CircuitState.HALF_OPEN and self._num_trial_calls < self.half_open_calls:
+                self._num_trial_calls += 1
+                return
+
+            if state != CircuitState.CLOSED:
+                raise ProviderUnavailable(
+                    f'Circuit breaker "{self.name}" is {state.value}',
+                    user_message='Payment provider is temporarily unavailable, please try again later',
+                )
+
+    def record(self, is_success: bool):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            state = self._update_state()
+
+            if state == CircuitState.HALF_OPEN:
+                if is_success:
+                    self._close()
+                else:
+                    self._open()
+                return
+
+            if state == CircuitState.OPEN:
+                return  # this call was started before circuit opened
+
+            now_ = self.clock()
+            self._calls.append((now_, is_success))
+            self._num_failures += not is_success
+
+            window_start = now_ - self.window.total_seconds()
+            while self._calls[0][0] < window_start:
+                _, was_success = self._calls.popleft()
+                self._num_failures -= not was_success
+
+            if len(self._calls) >= self.min_calls and self._num_failures >= self.failure_rate * len(self._calls):
+                self._open()
+
+    def release(self):
+        """ Give back trial slot of a call which was interrupted (e.g. cancelled), so that its outcome is unknown. """
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            if self._update_state() == CircuitState.HALF_OPEN and self._num_trial_calls:
+                self._num_trial_calls -= 1
+
+    def call(self, fn: Callable, *args, is_failure: Callable[[Any], bool] = lambda result: False, **kwargs) -> Any:
+        """ Call `fn`; exception or result satisfying `is_failure` are recorded as failures. """
+
+        self.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record(is_success=False)
+            raise
+        except BaseException:
+            # e.g. `asyncio.CancelledError` or `KeyboardInterrupt`
+            self.release()
+            raise
+
+        self.record(is_success=not is_failure(result))
+        return result
+
+    async def acall(self, fn: Callable[..., Awaitable], *args, is_failure: Callable[[Any], bool] = lambda result: False, **kwargs) -> Any:
+        """ Same as `call`, but for coroutine functions. """
+
+        self.before_call()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception:
+            self.record(is_success=False)
+            raise
+        except BaseException:
+            # e.g. `asyncio.CancelledError` or `KeyboardInterrupt`
+            self.release()
+            raise
+
+        self.record(is_success=not is_failure(result))
+        return result
+
+    def wrap(self, fn: Callable, is_failure: Callable[[Any], bool] = lambda result: False) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            return self.call(fn, *args, is_failure=is_failure, **kwargs)
+
+        return wrapper
+
+
+@lru_cache
+def get_provider_circuit_breaker(codename: str) -> CircuitBreaker:
+    """ Circuit breaker shared by all API calls to provider with `codename` within current process. """
+
+    config = getattr(settings, 'SUBSCRIPTIONS_PROVIDER_CIRCUIT_BREAKERS', {}).get(codename, {})
+    return CircuitBreaker(name=codename, **{**DEFAULT_SUBSCRIPTIONS_PROVIDER_CIRCUIT_BREAKER, **config})
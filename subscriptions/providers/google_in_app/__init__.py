@@ -71,6 +71,11 @@ class GoogleInAppProvider(Provider):
 
         http = httplib2.Http()
         http = credentials.authorize(http)
+        # every Google API call goes through this http object
+        http.request = self.circuit_breaker.wrap(
+            self.limiter.limit(http.request),
+            is_failure=lambda result: result[0].status >= 500,  # result = (response, content)
+        )
 
         # https://googleapis.github.io/google-api-python-client/docs/dyn/androidpublisher_v3.html
         self.api = build('androidpublisher', 'v3', http=http)
@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from functools import lru_cache, wraps
+from logging import getLogger
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep
+from typing import Callable
+from weakref import WeakKeyDictionary
+
+from django.conf import settings
+
+from ..defaults import DEFAULT_SUBSCRIPTIONS_PROVIDER_LIMITS
+
+log = getLogger(__name__)
+
+
+@dataclass
+class TokenBucket:
+    """
+    Bucket which is refilled with `rate` tokens per second and holds at most `capacity` tokens.
+    Each request takes a token; if there are no tokens left, request waits until the bucket is refilled.
+    """
+
+    rate: float
+    capacity: float
+    clock: Callable[[], float] = monotonic
+    sleep: Callable[[float], None] = sleep
+
+    def __post_init__(self):
+        assert self.rate > 0, 'Rate should be positive'
+        assert self.capacity >= 1, 'Capacity should be at least 1'
+        self._tokens = self.capacity
+        self._updated = self.clock()
+        self._lock = Lock()
+
+    def _refill(self):
+        now_ = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now_ - self._updated) * self.rate)
+        self._updated = now_
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """ Take `tokens` and return 0 if they are available, otherwise return seconds to wait. """
+
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1):
+        while (delay := self.try_acquire(tokens)) > 0:
+            self.sleep(delay)
+
+    def drain(self):
+        """ Empty the bucket, so that subsequent requests wait for refill. """
+
+        with self._lock:
+            self._refill()
+            self._tokens = 0
+
+
+@dataclass
+class ProviderLimiter:
+    """
+    Limit requests to provider API: at most `rate` requests per second (with bursts
+    of up to `burst` requests) and at most `max_concurrency` requests at the same time.
+    Limits are applied within a single process; concurrency of async requests is limited
+    separately for each event loop. Unset limits are not enforced.
+
+    Usage:
+        with limiter:
+            response = session.get(...)
+
+        async with limiter:
+            response = await client.get(...)
+    """
+
+    rate: float | None = None
+    burst: int | None = None
+    max_concurrency: int | None = None
+
+    _bucket: TokenBucket | None = field(default=None, init=False, repr=False, compare=False)
+    _semaphore: BoundedSemaphore | None = field(default=None, init=False, repr=False, compare=False)
+    _loop_limits: WeakKeyDictionary = field(default_factory=WeakKeyDictionary, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.rate:
+            self._bucket = TokenBucket(rate=self.rate, capacity=self.burst or max(self.rate, 1))
+
+        if self.max_concurrency:
+            self._semaphore = BoundedSemaphore(self.max_concurrency)
+
+    def __enter__(self):
+        # first wait for a free slot and only then for a token, so that request
+        # is sent right after the token is taken
+        if self._semaphore:
+            self._semaphore.acquire()
+
+        if self._bucket:
+            try:
+                self._bucket.acquire()
+            except BaseException:
+                if self._semaphore:
+                    self._semaphore.release()
+                raise
+
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        if self._semaphore:
+            self._semaphore.release()
+
+    def _get_loop_limits(self) -> tuple[asyncio.BoundedSemaphore | None, asyncio.Lock]:
+        # asyncio primitives can't be shared between event loops
+        loop = asyncio.get_running_loop()
+        if (limits := self._loop_limits.get(loop)) is None:
+            semaphore = asyncio.BoundedSemaphore(self.max_concurrency) if self.max_concurrency else None
+            limits = self._loop_limits[loop] = semaphore, asyncio.Lock()
+        return limits
+
+    async def __aenter__(self):
+        # same as `__enter__`, but waiting doesn't block the event loop; waiters
+        # are woken one by one in order of arrival instead of polling
+        semaphore, bucket_lock = self._get_loop_limits()
+        if semaphore:
+            await semaphore.acquire()
+
+        if self._bucket:
+            try:
+                # only the first waiter sleeps until a token is available
+                async with bucket_lock:
+                    while (delay := self._bucket.try_acquire()) > 0:
+                        await asyncio.sleep(delay)
+            except BaseException:
+                if semaphore:
+                    semaphore.release()
+                raise
+
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        semaphore, _ = self._get_loop_limits()
+        if semaphore:
+            semaphore.release()
+
+    def limit(self, fn: Callable) -> Callable:
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self:
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    def throttled(self):
+        """ Notify limiter that provider responded with "too many requests". """
+
+        log.warning('Provider API is throttling requests (limiter %s)', self)
+        if self._bucket:
+            self._bucket.drain()
+
+
+@lru_cache
+def get_provider_limiter(codename: str) -> ProviderLimiter:
+    """ Limiter shared by all API calls to provider with `codename` within current process. """
+
+    limits = getattr(settings, 'SUBSCRIPTIONS_PROVIDER_LIMITS', DEFAULT_SUBSCRIPTIONS_PROVIDER_LIMITS)
+    return ProviderLimiter(**limits.get(codename, {}))
@@ -7,7 +7,7 @@ from decimal import Decimal
 from functools import cached_property
 from logging import getLogger
 from operator import itemgetter
-from typing import ClassVar, Iterable
+from typing import TYPE_CHECKING, ClassVar, Iterable
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser
@@ -20,11 +20,15 @@ from rest_framework.response import Response
 from rest_framework.status import HTTP_200_OK
 
 from ...exceptions import BadReferencePayment, PaymentError
-from ...models import Plan, Subscription, SubscriptionPayment
+from ...models import Plan, Subscription, SubscriptionPayment, WebhookHistoryCursor
+from ...utils import database_sync_to_async
 from .. import Provider
-from .api import Paddle, PaddleError
+from .api import Paddle, PaddleError, parse_alert_time
 from .schemas import Alert, Passthrough
 
+if TYPE_CHECKING:
+    from .async_api import AsyncPaddle
+
 log = getLogger(__name__)
 
 
@@ -42,6 +46,10 @@ class PaddleProvider(Provider):
     # we assume that first webhook will arrive within this period after payment
     WEBHOOK_LOOKUP_PERIOD = timedelta(hours=6)
 
+    # fetch only webhook history alerts newer than the last processed one
+    # (see `WebhookHistoryCursor`) instead of the whole lookup period
+    INCREMENTAL_WEBHOOK_HISTORY = False
+
     # if user already created a SubscriptionPayment within this period, reuse it
     ONLINE_CHARGE_DUPLICATE_LOOKUP_TIME = timedelta(hours=1)
 
@@ -53,6 +61,21 @@ class PaddleProvider(Provider):
             vendor_id=self.vendor_id,
             vendor_auth_code=self.vendor_auth_code,
             endpoint=self.endpoint,
+            limiter=self.limiter,
+            circuit_breaker=self.circuit_breaker,
+        )
+
+    @cached_property
+    def _async_api(self) -> AsyncPaddle:
+        # imported here because async client is an optional dependency
+        from .async_api import AsyncPaddle
+
+        return AsyncPaddle(
+            vendor_id=self.vendor_id,
+            vendor_auth_code=self.vendor_auth_code,
+            endpoint=self.endpoint,
+            limiter=self.limiter,
+            circuit_breaker=self.circuit_breaker,
         )
 
     @cached_property
@@ -136,17 +159,64 @@ class PaddleProvider(Provider):
             amount = self.get_amount(user=user, plan=plan)
 
         if amount is None or amount.amount == 0:
-            return SubscriptionPayment.objects.create(
-                provider_codename=self.codename,
-                provider_transaction_id=None,  # paddle doesn't return anything
-                amount=amount,
-                quantity=quantity,
-                status=SubscriptionPayment.Status.COMPLETED,
-                user=user,
-                plan=plan,
-                subscription=subscription,
-                metadata={},
+            return self._create_offline_payment(user, plan, subscription, amount, quantity, metadata=None)
+
+        subscription_id = self._get_paddle_subscription_id(user, plan, subscription, reference_payment)
+
+        try:
+            metadata = self._api.one_off_charge(
+                subscription_id=subscription_id,
+                amount=amount.amount * quantity,
+                name=plan.name,
             )
+        except PaddleError as exc:
+            raise self._offline_charge_error(exc, user, subscription) from exc
+
+        return self._create_offline_payment(user, plan, subscription, amount, quantity, metadata=metadata)
+
+    async def acharge_offline(
+        self,
+        user: AbstractBaseUser,
+        plan: Plan,
+        subscription: Subscription | None = None,
+        amount: Money | None = None,
+        quantity: int = 1,
+        reference_payment: SubscriptionPayment | None = None,
+    ) -> SubscriptionPayment:
+
+        assert quantity > 0
+
+        if amount is None:
+            amount = self.get_amount(user=user, plan=plan)
+
+        create_payment = database_sync_to_async(self._create_offline_payment)
+
+        if amount is None or amount.amount == 0:
+            return await create_payment(user, plan, subscription, amount, quantity, metadata=None)
+
+        subscription_id = await database_sync_to_async(self._get_paddle_subscription_id)(
+            user, plan, subscription, reference_payment,
+        )
+
+        try:
+            metadata = await self._async_api.one_off_charge(
+                subscription_id=subscription_id,
+                amount=amount.amount * quantity,
+                name=plan.name,
+            )
+        except PaddleError as exc:
+            raise self._offline_charge_error(exc, user, subscription) from exc
+
+        return await create_payment(user, plan, subscription, amount, quantity, metadata=metadata)
+
+    def _get_paddle_subscription_id(
+        self,
+        user: AbstractBaseUser,
+        plan: Plan,
+        subscription: Subscription | None,
+        reference_payment: SubscriptionPayment | None,
+    ) -> int:
+        """ Find paddle subscription to make one-off charge against. """
 
         if not reference_payment and subscription:
             with suppress(SubscriptionPayment.DoesNotExist):
@@ -179,31 +249,42 @@ class PaddleProvider(Provider):
         if reference_payment.subscription.plan.charge_amount.currency != plan.charge_amount.currency:
             raise BadReferencePayment('Reference payment has different currency than current plan')
 
-        try:
-            metadata = self._api.one_off_charge(
-                subscription_id=subscription_id,
-                amount=amount.amount * quantity,
-                name=plan.name,
-            )
-        except PaddleError as exc:
-            raise PaymentError('Failed to offline-charge Paddle', debug_info={
-                'paddle_msg': str(exc),
-                'paddle_code': exc.code,
-                'user': user,
-                'subscription': subscription,
-            }) from exc
-
-        status_mapping = {
-            'success': SubscriptionPayment.Status.COMPLETED,
-            'pending': SubscriptionPayment.Status.PENDING,
-        }
-        paddle_status = metadata.get('status')
+        return subscription_id
 
-        try:
-            status = status_mapping[paddle_status]
-        except KeyError:
-            log.error(f'Paddle one-off charge status "{paddle_status}" is unknown, should be from {set(status_mapping.keys())}')
-            status = SubscriptionPayment.Status.ERROR
+    @staticmethod
+    def _offline_charge_error(exc: PaddleError, user: AbstractBaseUser, subscription: Subscription | None) -> PaymentError:
+        return PaymentError('Failed to offline-charge Paddle', debug_info={
+            'paddle_msg': str(exc),
+            'paddle_code': exc.code,
+            'user': user,
+            'subscription': subscription,
+        })
+
+    def _create_offline_payment(
+        self,
+        user: AbstractBaseUser,
+        plan: Plan,
+        subscription: Subscription | None,
+        amount: Money | None,
+        quantity: int,
+        metadata: dict | None,
+    ) -> SubscriptionPayment:
+        """ Save result of one-off charge; `metadata=None` means that nothing was charged. """
+
+        if metadata is None:
+            status = SubscriptionPayment.Status.COMPLETED
+        else:
+            status_mapping = {
+                'success': SubscriptionPayment.Status.COMPLETED,
+                'pending': SubscriptionPayment.Status.PENDING,
+            }
+            paddle_status = metadata.get('status')
+
+            try:
+                status = status_mapping[paddle_status]
+            except KeyError:
+                log.error(f'Paddle one-off charge status "{paddle_status}" is unknown, should be from {set(status_mapping.keys())}')
+                status = SubscriptionPayment.Status.ERROR
 
         # when status is PENDING, no webhook will come, so we rely on
         # background task to search for payments not in webhook history
@@ -217,7 +298,7 @@ class PaddleProvider(Provider):
             plan=plan,
             subscription=subscription,
             quantity=quantity,
-            metadata=metadata,
+            metadata=metadata or {},
         )
 
     WEBHOOK_ACTION_TO_PAYMENT_STATUS: ClassVar[dict] = {
@@ -259,12 +340,112 @@ class PaddleProvider(Provider):
     #     )
 
     def check_payments_using_webhook_history(self, payments: Iterable[SubscriptionPayment]):
-        payment_ids = {payment.id for payment in payments}
+        if self.INCREMENTAL_WEBHOOK_HISTORY:
+            cursor, start_date, end_date = self._get_webhook_history_window(payments)
+            alerts = self._api.iter_webhook_history(start_date=start_date, end_date=end_date, max_pages=None)
+            self._apply_new_webhook_alerts(cursor, alerts)
+            return
 
         alerts = self._api.iter_webhook_history(
             start_date=min(payment.created for payment in payments),
             end_date=max(payment.created for payment in payments) + self.WEBHOOK_LOOKUP_PERIOD,
         )
+        self._apply_webhook_alerts(payments, alerts)
+
+    async def acheck_payments(self, payments: Iterable[SubscriptionPayment]):
+        payments = await database_sync_to_async(list)(payments)
+        if not payments:
+            return
+
+        if self.INCREMENTAL_WEBHOOK_HISTORY:
+            cursor, start_date, end_date = await database_sync_to_async(self._get_webhook_history_window)(payments)
+            alerts = await self._async_api.get_webhook_alerts(start_date=start_date, end_date=end_date, max_pages=None)
+            await database_sync_to_async(self._apply_new_webhook_alerts)(cursor, alerts)
+            return
+
+        alerts = await self._async_api.get_webhook_alerts(
+            start_date=min(payment.created for payment in payments),
+            end_date=max(payment.created for payment in payments) + self.WEBHOOK_LOOKUP_PERIOD,
+        )
+        await database_sync_to_async(self._apply_webhook_alerts)(payments, alerts)
+
+    def _get_webhook_history_window(
+        self,
+        payments: Iterable[SubscriptionPayment],
+    ) -> tuple[WebhookHistoryCursor | None, datetime, datetime]:
+        """
+        Alerts to fetch in incremental mode: from the last processed alert (or from
+        the oldest payment if there is no cursor yet) up to now. Window is closed,
+        so that alerts created while pages are fetched don't shift the pages.
+        """
+
+        try:
+            cursor = WebhookHistoryCursor.objects.get(provider_codename=self.codename)
+            start_date = cursor.alert_created  # same second may contain unprocessed alerts
+        except WebhookHistoryCursor.DoesNotExist:
+            cursor = None
+            start_date = min(payment.created for payment in payments)
+
+        return cursor, start_date, now()
+
+    def _apply_new_webhook_alerts(self, cursor: WebhookHistoryCursor | None, alerts: Iterable[dict]):
+        """
+        Apply alerts which are newer than `cursor` to all pending payments and move the cursor.
+        Alerts don't depend on checked payments, so they are fetched once no matter
+        how payments are split into batches.
+
+        Cursor stops right before the first alert which failed to apply (e.g. because of
+        a database error), so that it is fetched and applied again by the next check.
+        Paddle alert ids are assumed to increase in order of creation: next check fetches
+        alerts created since the cursor, and skips alerts with ids up to the cursor.
+        """
+
+        alerts = sorted(
+            (alert for alert in alerts if not cursor or alert['id'] > cursor.alert_id),
+            key=itemgetter('id'),
+        )
+        if not alerts:
+            return
+
+        pending_payments = SubscriptionPayment.objects.filter(
+            provider_codename=self.codename,
+            status=SubscriptionPayment.Status.PENDING,
+        ).only('uid')
+        failed_alert_ids = self._apply_webhook_alerts(pending_payments, alerts)
+
+        num_applied = next((i for i, alert in enumerate(alerts) if alert['id'] in failed_alert_ids), len(alerts))
+        if num_applied < len(alerts):
+            log.warning('Webhook history cursor stops before alert %s, which failed to apply', alerts[num_applied]['id'])
+        if not num_applied:
+            return
+
+        last_alert = alerts[num_applied - 1]
+        last_alert_created = parse_alert_time(last_alert['created_at'])
+
+        # if ids don't follow creation order, next window should still include alerts which weren't applied
+        not_applied_created = [parse_alert_time(alert['created_at']) for alert in alerts[num_applied:]]
+        if not_applied_created and min(not_applied_created) < last_alert_created:
+            log.warning('Webhook history alert ids are not in order of creation: %s', [alert['id'] for alert in alerts])
+            last_alert_created = min(not_applied_created)
+
+        with transaction.atomic():
+            cursor, is_new = WebhookHistoryCursor.objects.select_for_update().get_or_create(
+                provider_codename=self.codename,
+                defaults=dict(alert_id=last_alert['id'], alert_created=last_alert_created),
+            )
+            # concurrent check might have moved the cursor further
+            if not is_new and cursor.alert_id < last_alert['id']:
+                cursor.alert_id = last_alert['id']
+                cursor.alert_created = last_alert_created
+                cursor.save()
+
+        log.debug('Applied %s new webhook history alerts, cursor: %s', num_applied, cursor)
+
+    def _apply_webhook_alerts(self, payments: Iterable[SubscriptionPayment], alerts: Iterable[dict]) -> set[int]:
+        """ Apply alerts to `payments`; return ids of alerts which failed to apply. """
+
+        payment_ids = {payment.id for payment in payments}
+        failed_alert_ids = set()
 
         # don't process alerts with same `id`
         for alert_dict in unique_everseen(alerts, key=itemgetter('id')):
@@ -274,7 +455,19 @@ class PaddleProvider(Provider):
                 alert = Alert.parse_obj(alert_dict)
                 if alert.passthrough.subscription_payment_id not in payment_ids:
                     continue
+            except Exception:
+                # retrying won't help
+                log.exception(f'Could not parse alert {alert_dict}')
+                continue
 
+            try:
                 self.webhook(None, alert_dict)
             except Exception:
                 log.exception(f'Could not process alert {alert_dict}')
+                failed_alert_ids.add(alert_dict['id'])
+
+        return failed_alert_ids
+
+    async def aclose(self):
+        if '_async_api' in self.__dict__:
+            await self._async_api.aclose()
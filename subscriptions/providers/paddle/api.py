@@ -1,10 +1,11 @@
 from __future__ import annotations
 
 import json
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import date, datetime, timedelta, timezone
 from decimal import Decimal
-from functools import partialmethod, wraps
+from functools import partial, partialmethod, wraps
 from logging import getLogger
 from typing import Callable, ClassVar, Iterator
 from urllib.parse import urlencode
@@ -20,6 +21,9 @@ from tenacity import (
     wait_incrementing,
 )
 
+from ..circuit_breakers import CircuitBreaker, is_server_error
+from ..limits import ProviderLimiter
+
 log = getLogger(__name__)
 
 
@@ -51,6 +55,16 @@ class PaddleAuth(AuthBase):
         return request
 
 
+# responses with these statuses are retried
+RETRY_STATUS_CODES = frozenset({
+    requests.codes.too_many_requests,
+    requests.codes.internal_server_error,
+    requests.codes.bad_gateway,
+    requests.codes.service_unavailable,
+    requests.codes.gateway_timeout,
+})
+
+
 def paddle_result(fn: Callable) -> Callable:
     @wraps(fn)
     def wrapper(*args, **kwargs):
@@ -70,6 +84,50 @@ def paddle_result(fn: Callable) -> Callable:
     return wrapper
 
 
+def one_off_charge_payload(amount: Decimal, name: str = '') -> dict:
+    if len(name) > 50:
+        log.warning(f'Name exceeds the limit of 50 chars: {name}')
+        name = name[:50]
+
+    return {
+        'amount': str(amount),
+        'charge_name': name,
+    }
+
+
+# format of webhook history dates, both in requests and in alerts; always UTC
+WEBHOOK_HISTORY_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_alert_time(value: str) -> datetime:
+    return datetime.strptime(value, WEBHOOK_HISTORY_TIME_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def webhook_history_payload(
+    page: int | None = None,
+    alerts_per_page: int | None = None,
+    start_date: datetime | None = None,
+    end_date: datetime | None = None,
+) -> dict:
+    params = {}
+
+    if page is not None:
+        assert page > 0
+        params['page'] = page
+
+    if alerts_per_page is not None:
+        assert alerts_per_page > 0
+        params['alerts_per_page'] = alerts_per_page
+
+    if start_date:
+        params['query_tail'] = start_date.astimezone(timezone.utc).strftime(WEBHOOK_HISTORY_TIME_FORMAT)
+
+    if end_date:
+        params['query_head'] = end_date.astimezone(timezone.utc).strftime(WEBHOOK_HISTORY_TIME_FORMAT)
+
+    return params
+
+
 @dataclass
 class Paddle:
     vendor_id: int
@@ -77,19 +135,14 @@ class Paddle:
     endpoint: str = 'https://vendors.paddle.com/api/2.0'
     # TODO: replace response `dict` type with pydantic
 
+    limiter: ProviderLimiter = field(default_factory=ProviderLimiter)
+    circuit_breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+
     _session: requests.Session = None
     TIMEOUT: ClassVar[timedelta] = timedelta(seconds=30)
 
     _retry: retry_base = retry(
-        retry=retry_if_result(
-            lambda response: response.status_code in {
-                requests.codes.too_many_requests,
-                requests.codes.internal_server_error,
-                requests.codes.bad_gateway,
-                requests.codes.service_unavailable,
-                requests.codes.gateway_timeout,
-            },
-        ),
+        retry=retry_if_result(lambda response: response.status_code in RETRY_STATUS_CODES),
         stop=stop_after_attempt(10),
         wait=wait_incrementing(start=1, increment=2),
     )
@@ -102,7 +155,20 @@ class Paddle:
     def request(self, method, endpoint, *args, **kwargs) -> requests.Response:
         assert endpoint.startswith('/')
         kwargs.setdefault('timeout', int(self.TIMEOUT.total_seconds()))
-        return self._session.request(method, self.endpoint + endpoint, *args, **kwargs)
+
+        # limiter is applied to each attempt separately, so that retry
+        # back-off doesn't occupy limiter's concurrency slots
+        def send() -> requests.Response:
+            with self.limiter:
+                return self._session.request(method, self.endpoint + endpoint, *args, **kwargs)
+
+        # when circuit is open, ProviderUnavailable is raised and no retries are made
+        response = self.circuit_breaker.call(send, is_failure=is_server_error)
+
+        if response.status_code == requests.codes.too_many_requests:
+            self.limiter.throttled()
+
+        return response
 
     get = partialmethod(request, 'get')
     post = partialmethod(request, 'post')
@@ -140,14 +206,7 @@ class Paddle:
         amount: Decimal,
         name: str = '',
     ) -> dict:
-        if len(name) > 50:
-            log.warning(f'Name exceeds the limit of 50 chars: {name}')
-            name = name[:50]
-
-        return self.post(f'/subscription/{subscription_id}/charge', json={
-            'amount': str(amount),
-            'charge_name': name,
-        })
+        return self.post(f'/subscription/{subscription_id}/charge', json=one_off_charge_payload(amount, name))
 
     @paddle_result
     def get_payments(
@@ -189,33 +248,26 @@ class Paddle:
         start_date: datetime | None = None,
         end_date: datetime | None = None,
     ) -> dict:
-        params = {}
-
-        if page is not None:
-            assert page > 0
-            params['page'] = page
-
-        if alerts_per_page is not None:
-            assert alerts_per_page > 0
-            params['alerts_per_page'] = alerts_per_page
-
-        if start_date:
-            params['query_tail'] = start_date.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-
-        if end_date:
-            params['query_head'] = end_date.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
-
-        return self.post('/alert/webhooks', json=params)
+        return self.post('/alert/webhooks', json=webhook_history_payload(page, alerts_per_page, start_date, end_date))
 
     def iter_webhook_history(
         self,
         start_date: datetime | None = None,
         end_date: datetime | None = None,
-        max_pages: int = 100,
+        max_pages: int | None = 100,
+        max_workers: int = 4,
     ) -> Iterator[dict]:
+        """ Fetch first page to know number of pages, then fetch the rest concurrently; `max_pages=None` fetches all pages. """
+
+        fetch_page = partial(self.get_webhook_history, start_date=start_date, end_date=end_date)
+
+        first_page = fetch_page(page=1)
+        yield from first_page['data']
+
+        num_pages = first_page['total_pages'] if max_pages is None else min(first_page['total_pages'], max_pages)
+        if num_pages < 2:
+            return
 
-        for page in range(1, max_pages + 1):
-            result = self.get_webhook_history(page=page, start_date=start_date, end_date=end_date)
-            yield from result['data']
-            if page == result['total_pages']:
-                break
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='paddle-webhook-history') as pool:
+            for page in pool.map(lambda number: fetch_page(page=number), range(2, num_pages + 1)):
+                yield from page['data']
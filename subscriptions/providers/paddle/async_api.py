@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import asyncio
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import wraps
+from logging import getLogger
+from typing import Awaitable, Callable, ClassVar
+from weakref import WeakKeyDictionary
+
+import httpx
+from tenacity import (
+    retry,
+    retry_base,
+    retry_if_result,
+    stop_after_attempt,
+    wait_incrementing,
+)
+
+from ..circuit_breakers import CircuitBreaker, is_server_error
+from ..limits import ProviderLimiter
+from .api import (
+    RETRY_STATUS_CODES,
+    PaddleError,
+    one_off_charge_payload,
+    webhook_history_payload,
+)
+
+log = getLogger(__name__)
+
+
+def async_paddle_result(fn: Callable) -> Callable:
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        response = await fn(*args, **kwargs)
+
+        try:
+            result = response.json()
+        except ValueError:
+            assert not response.is_success
+            response.raise_for_status()
+
+        if not result['success']:
+            raise PaddleError(result['error']['message'], code=result['error']['code'])
+
+        return result['response']
+
+    return wrapper
+
+
+@dataclass
+class AsyncPaddle:
+    """
+    Asyncio counterpart of `Paddle` API client. Connections are pooled within
+    each event loop, so that many requests may be in flight at the same time
+    without opening a new connection for each of them.
+    """
+
+    vendor_id: int
+    vendor_auth_code: str
+    endpoint: str = 'https://vendors.paddle.com/api/2.0'
+
+    limiter: ProviderLimiter = field(default_factory=ProviderLimiter)
+    circuit_breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+    max_connections: int = 100
+
+    TIMEOUT: ClassVar[timedelta] = timedelta(seconds=30)
+
+    _retry: retry_base = retry(
+        retry=retry_if_result(lambda response: response.status_code in RETRY_STATUS_CODES),
+        stop=stop_after_attempt(10),
+        wait=wait_incrementing(start=1, increment=2),
+    )
+
+    def __post_init__(self):
+        # http client can't be shared between event loops
+        self._clients: WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = WeakKeyDictionary()
+        self.request = self._retry(self.request)
+
+    @property
+    def _client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if (client := self._clients.get(loop)) is None:
+            client = self._clients[loop] = httpx.AsyncClient(
+                base_url=self.endpoint,
+                timeout=self.TIMEOUT.total_seconds(),
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return client
+
+    async def aclose(self):
+        """ Close pooled connections of current event loop. """
+
+        if (client := self._clients.pop(asyncio.get_running_loop(), None)) is not None:
+            await client.aclose()
+
+    async def request(self, method, endpoint, *args, **kwargs) -> httpx.Response:
+        assert endpoint.startswith('/')
+
+        auth = {
+            'vendor_id': self.vendor_id,
+            'vendor_auth_code': self.vendor_auth_code,
+        }
+        if method.lower() == 'get':
+            kwargs['params'] = {**kwargs.get('params', {}), **auth}
+        else:
+            kwargs['json'] = {**kwargs.get('json', {}), **auth}
+
+        # limiter is applied to each attempt separately, so that retry
+        # back-off doesn't occupy limiter's concurrency slots
+        async def send() -> httpx.Response:
+            async with self.limiter:
+                return await self._client.request(method, endpoint, *args, **kwargs)
+
+        # when circuit is open, ProviderUnavailable is raised and no retries are made
+        response = await self.circuit_breaker.acall(send, is_failure=is_server_error)
+
+        if response.status_code == httpx.codes.TOO_MANY_REQUESTS:
+            self.limiter.throttled()
+
+        return response
+
+    # not using `partialmethod`, so that calls go through retried `self.request`
+    def get(self, *args, **kwargs) -> Awaitable[httpx.Response]:
+        return self.request('get', *args, **kwargs)
+
+    def post(self, *args, **kwargs) -> Awaitable[httpx.Response]:
+        return self.request('post', *args, **kwargs)
+
+    @async_paddle_result
+    async def one_off_charge(
+        self,
+        subscription_id: int,
+        amount: Decimal,
+        name: str = '',
+    ) -> dict:
+        return await self.post(f'/subscription/{subscription_id}/charge', json=one_off_charge_payload(amount, name))
+
+    @async_paddle_result
+    async def get_webhook_history(
+        self,
+        page: int | None = None,
+        alerts_per_page: int | None = None,
+        start_date: datetime | None = None,
+        end_date: datetime | None = None,
+    ) -> dict:
+        return await self.post('/alert/webhooks', json=webhook_history_payload(page, alerts_per_page, start_date, end_date))
+
+    async def get_webhook_alerts(
+        self,
+        start_date: datetime | None = None,
+        end_date: datetime | None = None,
+        max_pages: int | None = 100,
+    ) -> list[dict]:
+        """ Fetch first page to know number of pages, then fetch the rest concurrently; `max_pages=None` fetches all pages. """
+
+        first_page = await self.get_webhook_history(page=1, start_date=start_date, end_date=end_date)
+        num_pages = first_page['total_pages'] if max_pages is None else min(first_page['total_pages'], max_pages)
+
+        pages = await asyncio.gather(*(
+            self.get_webhook_history(page=page, start_date=start_date, end_date=end_date)
+            for page in range(2, num_pages + 1)
+        ))
+
+        return [alert for page in (first_page, *pages) for alert in page['data']]
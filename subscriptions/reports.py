@@ -1,54 +1,464 @@
 from __future__ import annotations
 
+import csv
+import hashlib
+import json
+import multiprocessing
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import Counter, defaultdict
-from dataclasses import dataclass, field
-from datetime import datetime, timedelta
+from dataclasses import dataclass, field, fields
+from datetime import date, datetime, time, timedelta, timezone
 from decimal import Decimal
-from statistics import median
-from typing import Iterator
+from functools import partial, wraps
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, ClassVar, Iterable, Iterator
 
 from djmoney.money import Money
-from django.db.models import Q, QuerySet
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router
+from django.db.models import Aggregate, Count, Expression, F, Min, Q, QuerySet, Sum
 from django.utils.timezone import now
 
 from dateutil.rrule import rrule
-from more_itertools import pairwise
+from more_itertools import chunked, pairwise
 from dateutil.rrule import YEARLY, MONTHLY, WEEKLY, DAILY, HOURLY, MINUTELY, SECONDLY  # noqa
 
-from .models import AbstractTransaction, Plan, Subscription, SubscriptionPayment, \
-    SubscriptionPaymentRefund
+from .defaults import DEFAULT_SUBSCRIPTIONS_REPORT_CACHE
+from .functions import get_cache_name, get_cache_or_none
+from .models import AbstractTransaction, PaymentsSnapshot, Plan, Subscription, SubscriptionPayment, \
+    SubscriptionPaymentRefund, SubscriptionsSnapshot
+from .periods import as_period
+from .sketches import HyperLogLog, build_sketch
 from .utils import NO_MONEY
 
 
-class IterPeriodsMixin:
+_MISSING = object()
 
-    @classmethod
-    def iter_periods(cls, frequency: int, since: datetime, until: datetime, **kwargs) -> Iterator:
+
+def get_report_cache_config() -> dict:
+    return {**DEFAULT_SUBSCRIPTIONS_REPORT_CACHE, **getattr(settings, 'SUBSCRIPTIONS_REPORT_CACHE', {})}
+
+
+def cached_report_method(fn: Callable) -> Callable:
+    """
+    Cache result of report method by report class, method, report fields and arguments.
+    Results for periods which ended more than `settle_delay` ago are cached forever,
+    others only for `ttl` (see `SUBSCRIPTIONS_REPORT_CACHE` setting).
+    """
+
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        config = get_report_cache_config()
+        if not (config['enabled'] and self._use_cache) or not (cache := get_cache_or_none(get_cache_name())):
+            return fn(self, *args, **kwargs)
+
+        key_fields = tuple(getattr(self, field_.name) for field_ in fields(self) if field_.init)
+        key_data = repr((type(self).__name__, fn.__name__, key_fields, args, sorted(kwargs.items())))
+        key = 'subscriptions:report:' + hashlib.sha256(key_data.encode()).hexdigest()
+
+        if (value := cache.get(key, _MISSING, version=config['version'])) is _MISSING:
+            value = fn(self, *args, **kwargs)
+            settled = self.until <= now() - config['settle_delay']
+            cache.set(key, value, timeout=None if settled else config['ttl'].total_seconds(), version=config['version'])
+
+        return value
+
+    return wrapper
+
+
+class Median(Aggregate):
+    """
+    Exact median: mean of two middle values for even number of values, same as
+    `statistics.median` (PostgreSQL only). `percentile_cont` would interpolate
+    in floating point, so middle values are taken with `percentile_disc` instead.
+    """
+
+    function = 'percentile_disc'
+    name = 'Median'
+    template = (
+        '(%(function)s(0.5) WITHIN GROUP (ORDER BY %(expressions)s)'
+        ' + %(function)s(0.5) WITHIN GROUP (ORDER BY %(expressions)s DESC)) / 2'
+    )
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = super().as_sql(compiler, connection, **extra_context)
+        return sql, (*params, *params)  # expressions are used twice
+
+
+class Percentile(Aggregate):
+    """ Continuous percentile (0 <= `fraction` <= 1) of numbers or intervals (PostgreSQL only). """
+
+    function = 'percentile_cont'
+    name = 'Percentile'
+    template = '%(function)s(%(fraction)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+
+    def __init__(self, expression, fraction: float, **extra):
+        assert 0 <= fraction <= 1, 'Fraction should be within [0, 1]'
+        super().__init__(expression, fraction=float(fraction), **extra)
+
+
+DEFAULT_AGE_PERCENTILES = (0.5, 0.9, 0.99)
+
+
+@dataclass
+class AgesDistribution:
+    """
+    Histogram and percentiles of subscription ages.
+
+    `counts` has one bucket more than `edges`: counts[0] is number of ages below edges[0],
+    counts[i] is number of ages within [edges[i-1], edges[i]) and counts[-1] is number
+    of ages from edges[-1] on.
+    """
+
+    edges: list[timedelta]
+    counts: list[int]
+    percentiles: dict[float, timedelta | None]
+
+    @property
+    def total(self) -> int:
+        return sum(self.counts)
+
+
+def get_ages_distribution(
+    queryset: QuerySet,
+    edges: Iterable[timedelta] = (),
+    percentiles: Iterable[float] = DEFAULT_AGE_PERCENTILES,
+) -> AgesDistribution:
+    """ Bin `age` annotation of `queryset` (see `SubscriptionQuerySet.with_ages`) and compute its percentiles in a single query. """
+
+    edges, percentiles = list(edges), list(percentiles)
+    assert edges == sorted(set(edges)), 'Edges should be strictly increasing'
+
+    bounds = [None, *edges, None]
+    aggregates = {
+        f'bucket_{i}': Count('pk', filter=Q(
+            **({'age__gte': lower} if lower is not None else {}),
+            **({'age__lt': upper} if upper is not None else {}),
+        ))
+        for i, (lower, upper) in enumerate(pairwise(bounds))
+    }
+    aggregates.update({
+        f'percentile_{i}': Percentile('age', fraction)
+        for i, fraction in enumerate(percentiles)
+    })
+
+    result = queryset.order_by().aggregate(**aggregates)
+    return AgesDistribution(
+        edges=edges,
+        counts=[result[f'bucket_{i}'] for i in range(len(bounds) - 1)],
+        percentiles={fraction: result[f'percentile_{i}'] for i, fraction in enumerate(percentiles)},
+    )
+
+
+def aggregate_money(queryset: QuerySet, aggregate: type[Aggregate], amount: Expression) -> dict[str, Money]:
+    """ Aggregate `amount` expression of transactions per currency; NULL amounts are ignored. """
+    rows = (
+        queryset
+        .filter(amount__isnull=False)
+        .order_by('amount_currency')
+        .values('amount_currency')
+        .annotate(value=aggregate(amount))
+        .values_list('amount_currency', 'value')
+    )
+    return {currency: Money(value, currency) for currency, value in rows}
+
+
+def get_single_currency(amounts: dict[str, Money], default: Money | None) -> Money | None:
+    if len(amounts) > 1:
+        raise ValueError(f'Amounts are in multiple currencies ({", ".join(amounts)}), use *_by_currency methods instead')
+    return next(iter(amounts.values()), default)
+
+
+def project_recurring_charges(
+    subscriptions: QuerySet,
+    since: datetime,
+    until: datetime,
+    chunk_size: int = 10000,
+) -> dict[datetime, Money]:
+    """
+    Estimated charge amounts by datetime within [since, until], same as summing
+    `plan.charge_amount * quantity` over `iter_charge_dates(since, until)` of every
+    subscription, but without instantiating subscriptions: amounts are summed in the database
+    per charge period, start, initial charge offset and currency, so that charge dates are
+    computed once for all subscriptions which are charged at the same moments, whatever their plans.
+    """
+    totals: defaultdict[tuple[datetime, str], Decimal] = defaultdict(Decimal)
+
+    rows = (
+        subscriptions
+        .filter(plan__charge_amount__isnull=False)
+        .order_by()
+        .values_list('plan__charge_period', 'start', 'initial_charge_offset', 'plan__charge_amount_currency')
+        .annotate(amount=Sum(F('plan__charge_amount') * F('quantity')))
+        .iterator(chunk_size=chunk_size)
+    )
+    for charge_period, start, initial_charge_offset, currency, amount in rows:
+        # one-time (INFINITY) plans have their second charge date 1000 years after the first one
+        charge_period = as_period(charge_period)
+        anchor = start + initial_charge_offset
+        i = charge_period.index_at(anchor, since)
+        while (charge_date := charge_period.nth_boundary(anchor, i)) <= until:
+            totals[(charge_date, currency)] += amount
+            i += 1
+
+    estimated_charges = {}
+    for (charge_date, currency), amount in sorted(totals.items()):
+        money = Money(amount, currency)
+        estimated_charges[charge_date] = estimated_charges[charge_date] + money if charge_date in estimated_charges else money
+    return estimated_charges
+
+
+SNAPSHOT_PERIOD = timedelta(days=1)
+
+
+def get_snapshot_period(day: date) -> tuple[datetime, datetime]:
+    since = datetime.combine(day, time.min, tzinfo=timezone.utc)
+    return since, since + SNAPSHOT_PERIOD
+
+
+def get_snapshot_date(since: datetime, until: datetime) -> date | None:
+    """ Day which [since, until) period is equal to, if it is a whole closed UTC day. """
+    day = since.astimezone(timezone.utc).date()
+    if get_snapshot_period(day) == (since, until) and until <= now():
+        return day
+
+
+class _Echo:
+    """ File-like object which returns written line instead of storing it. """
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def iter_csv_lines(columns: Iterable[str], rows: Iterable[tuple]) -> Iterator[str]:
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_ndjson_lines(columns: Iterable[str], rows: Iterable[tuple]) -> Iterator[str]:
+    columns = tuple(columns)
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+# format -> (lines generator, content type)
+EXPORT_FORMATS: dict[str, tuple[Callable[[Iterable[str], Iterable[tuple]], Iterator[str]], str]] = {
+    'csv': (iter_csv_lines, 'text/csv'),
+    'ndjson': (iter_ndjson_lines, 'application/x-ndjson'),
+}
+EXPORT_CHUNK_SIZE = 2000
+
+
+class ExportMixin:
+    # kind -> (queryset property, exported columns)
+    EXPORTS: ClassVar[dict[str, tuple[str, tuple[str, ...]]]] = {}
+
+    def get_export_queryset(self, kind: str) -> QuerySet:
+        attr, columns = self.EXPORTS[kind]
+        return getattr(self, attr).values_list(*columns)
+
+    def export(self, kind: str, format: str = 'csv', chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[str]:
         """
-        Generate report instances for [since, until) period with desired frequency.
+        Generate CSV or NDJSON lines with rows of `kind` (see `EXPORTS`) within selected period.
 
-        For frequency, use `subscriptions.reports.[YEARLY|MONTHLY|WEEKLY|DAILY|HOURLY|MINUTELY|SECONDLY]`.
+        Rows are fetched with a server-side cursor in chunks of `chunk_size` and written
+        as they come, so memory usage doesn't depend on the period length.
         """
+        _, columns = self.EXPORTS[kind]
+        iter_lines, _ = EXPORT_FORMATS[format]
+        rows = self.get_export_queryset(kind).iterator(chunk_size=chunk_size)
+        return iter_lines(columns, rows)
+
+
+class IterPeriodsMixin:
+
+    @staticmethod
+    def iter_period_bounds(frequency: int, since: datetime, until: datetime) -> Iterator[tuple[datetime, datetime]]:
+        """ Generate (start, end) of consecutive periods covering [since, until) with desired frequency. """
         assert since.microsecond == until.microsecond == 0, \
             "iter_periods would truncate microseconds, use .replace(microsecond=0) for `since` and `until`"
         points_in_time = rrule(frequency, dtstart=since, until=until)
         end = since
         for start, end in pairwise(points_in_time):
-            yield cls(since=start, until=end, **kwargs)
+            yield start, end
 
         if end != until:  # remains if since-until period doesn't match frequency perfectly
-            yield cls(since=end, until=until, **kwargs)
+            yield end, until
+
+    @classmethod
+    def iter_periods(cls, frequency: int, since: datetime, until: datetime, **kwargs) -> Iterator:
+        """
+        Generate report instances for [since, until) period with desired frequency.
+
+        For frequency, use `subscriptions.reports.[YEARLY|MONTHLY|WEEKLY|DAILY|HOURLY|MINUTELY|SECONDLY]`.
+        """
+        reports = [cls(since=start, until=end, **kwargs) for start, end in cls.iter_period_bounds(frequency, since, until)]
+        cls.prefetch_snapshots(reports)
+        yield from reports
+
+    @classmethod
+    def prefetch_snapshots(cls, reports: list) -> None:
+        """ Load snapshots for all `reports` at once instead of a query per report. """
+
+
+@dataclass
+class SubscriptionsSeries:
+    """
+    Columnar counterpart of `SubscriptionsReport` counts for consecutive periods:
+    i-th item of every list belongs to [since[i], until[i]) period.
+    """
+
+    since: list[datetime] = field(default_factory=list)
+    until: list[datetime] = field(default_factory=list)
+    new_count: list[int] = field(default_factory=list)
+    ended_count: list[int] = field(default_factory=list)
+    active_count: list[int] = field(default_factory=list)
+    active_users_count: list[int] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.since)
 
 
 @dataclass
-class SubscriptionsReport(IterPeriodsMixin):
+class SubscriptionsReportData:
+    """ Metrics of `SubscriptionsReport` derived from a single result set, see `SubscriptionsReport.evaluate`. """
+
+    as_of: datetime
+    new_datetimes: list[datetime] = field(default_factory=list)
+    ended_datetimes: list[datetime] = field(default_factory=list)
+    ended_or_ending_ages: list[timedelta] = field(default_factory=list)
+    active_ages: list[timedelta] = field(default_factory=list)
+    active_plans_and_quantities: list[tuple[Plan, int]] = field(default_factory=list)
+    active_users_count: int = 0
+
+    @property
+    def new_count(self) -> int:
+        return len(self.new_datetimes)
+
+    @property
+    def ended_count(self) -> int:
+        return len(self.ended_datetimes)
+
+    @property
+    def active_count(self) -> int:
+        return len(self.active_ages)
+
+    @property
+    def active_plans_total(self) -> Counter[Plan]:
+        counter = Counter()
+        for plan, quantity in self.active_plans_and_quantities:
+            counter[plan] += quantity
+        return counter
+
+
+@dataclass
+class SubscriptionsReport(ExportMixin, IterPeriodsMixin):
     """
     Report for subscriptions. Period's end is excluded: [since, until)
     """
 
+    EXPORTS: ClassVar[dict[str, tuple[str, tuple[str, ...]]]] = {
+        kind: (attr, ('uid', 'user_id', 'plan_id', 'quantity', 'auto_prolong', 'start', 'end', 'age'))
+        for kind, attr in (('new', 'new'), ('ended', 'ended_or_ending'), ('active', 'active'))
+    }
+
     since: datetime
     until: datetime = field(default_factory=now)
     include_until: bool = False
+    # moment at which subscriptions are classified as ended or active (now by default)
+    as_of: datetime | None = None
+
+    # snapshot is used if selected period is a closed day (see `tasks.update_report_snapshots`);
+    # ... means "not fetched yet", None means "compute live"
+    _snapshot: SubscriptionsSnapshot | None = field(default=..., init=False, repr=False, compare=False)
+    # results of getters are cached, see `cached_report_method`
+    _use_cache: bool = field(default=True, init=False, repr=False, compare=False)
+    # set by `evaluate`, getters use it instead of querying
+    _data: SubscriptionsReportData | None = field(default=None, init=False, repr=False, compare=False)
+
+    def _get_snapshot_date(self) -> date | None:
+        if self.include_until or (self.as_of and self.as_of < self.until):
+            return None
+        return get_snapshot_date(self.since, self.until)
+
+    def get_snapshot(self) -> SubscriptionsSnapshot | None:
+        if self._snapshot is ...:
+            day = self._get_snapshot_date()
+            self._snapshot = day and SubscriptionsSnapshot.objects.filter(date=day).first()
+        return self._snapshot
+
+    @classmethod
+    def prefetch_snapshots(cls, reports: list[SubscriptionsReport]) -> None:
+        days = [report._get_snapshot_date() for report in reports]
+        snapshots = SubscriptionsSnapshot.objects.in_bulk([day for day in days if day])
+        for report, day in zip(reports, days):
+            report._snapshot = snapshots.get(day)
+
+    @classmethod
+    def make_snapshot(cls, day: date) -> SubscriptionsSnapshot:
+        """ Compute (but don't save) snapshot of a single day from live data. """
+        since, until = get_snapshot_period(day)
+        report = cls(since=since, until=until)
+        report._snapshot = None
+        report._use_cache = False  # snapshot of a recent day may be refreshed
+
+        active_plan_quantities = Counter()
+        for plan_id, quantity in report.active.values_list('plan', 'quantity'):
+            active_plan_quantities[str(plan_id)] += quantity
+
+        return SubscriptionsSnapshot(
+            date=day,
+            new_count=report.get_new_count(),
+            ended_count=report.get_ended_count(),
+            active_count=report.get_active_count(),
+            active_users_count=report.get_active_users_count(),
+            active_plan_quantities=dict(active_plan_quantities),
+            active_users_sketch=build_sketch(report.active, 'user').to_bytes(),
+        )
+
+    def get_export_queryset(self, kind: str) -> QuerySet:
+        attr, columns = self.EXPORTS[kind]
+        return getattr(self, attr).with_ages(at=self.until).values_list(*columns)
+
+    def evaluate(self) -> SubscriptionsReportData:
+        """
+        Fetch subscriptions overlapping selected period with a single query and derive all
+        metrics from it, classifying subscriptions as ended or active at the same `as_of` moment.
+        Getters of evaluated report return these metrics instead of querying the database.
+        """
+
+        as_of = self.as_of or now()
+        data = SubscriptionsReportData(as_of=as_of)
+
+        rows = list(self.overlapping.order_by('start').values_list('user', 'plan', 'quantity', 'start', 'end', 'auto_prolong'))
+        id_to_plan = Plan.objects.in_bulk({row[1] for row in rows})
+
+        active_users = set()
+        ended = []
+        for user, plan_id, quantity, start, end, auto_prolong in rows:
+            if self.since <= start <= self.until:
+                data.new_datetimes.append(start)
+
+            age = min(self.until, end) - start
+            if self.since <= end <= self.until and (end <= as_of or not auto_prolong):
+                ended.append((end, age))
+            else:
+                data.active_ages.append(age)
+                data.active_plans_and_quantities.append((id_to_plan[plan_id], quantity))
+                active_users.add(user)
+
+        ended.sort(key=lambda end_and_age: end_and_age[0])
+        data.ended_datetimes = [end for end, _ in ended]
+        data.ended_or_ending_ages = [age for _, age in ended]
+        data.active_users_count = len(active_users)
+
+        self._data = data
+        self._use_cache = False
+        return data
 
     @property
     def overlapping(self) -> QuerySet:
@@ -58,12 +468,20 @@ class SubscriptionsReport(IterPeriodsMixin):
     def new(self) -> QuerySet:
         return self.overlapping.new(self.since, self.until).order_by('start')
 
+    @cached_report_method
     def get_new_count(self) -> int:
         """ Number of newly created subscriptions within selected period. """
+        if self._data:
+            return self._data.new_count
+        if snapshot := self.get_snapshot():
+            return snapshot.new_count
         return self.new.count()
 
+    @cached_report_method
     def get_new_datetimes(self) -> list[datetime]:
         """ list of newly created subscriptions' dates within selected period. """
+        if self._data:
+            return self._data.new_datetimes
         return list(self.new.values_list('start', flat=True))
 
     @property
@@ -72,71 +490,295 @@ class SubscriptionsReport(IterPeriodsMixin):
         return (
             self.overlapping
             .filter(end__gte=self.since, end__lte=self.until)
-            .ended_or_ending()
+            .ended_or_ending(at=self.as_of)
             .order_by('end')
         )
 
+    @cached_report_method
     def get_ended_count(self) -> int:
         """ Number of subscriptions ending within selected period. """
+        if self._data:
+            return self._data.ended_count
+        if snapshot := self.get_snapshot():
+            return snapshot.ended_count
         return self.ended_or_ending.count()
 
+    @cached_report_method
     def get_ended_datetimes(self) -> list[datetime]:
         """ list of end dates for subscriptions that end within selected period. """
+        if self._data:
+            return self._data.ended_datetimes
         return list(self.ended_or_ending.values_list('end', flat=True))
 
     def get_ended_or_ending_ages(self) -> list[timedelta]:
         """ list of ages for ended or ending subscriptions."""
+        if self._data:
+            return self._data.ended_or_ending_ages
         return self.ended_or_ending.with_ages(at=self.until).values_list('age', flat=True)
 
+    @cached_report_method
+    def get_ended_or_ending_ages_distribution(
+        self,
+        edges: Iterable[timedelta] = (),
+        percentiles: Iterable[float] = DEFAULT_AGE_PERCENTILES,
+    ) -> AgesDistribution:
+        """ Histogram and percentiles of ages for ended or ending subscriptions, without fetching every age. """
+        return get_ages_distribution(self.ended_or_ending.with_ages(at=self.until), edges=edges, percentiles=percentiles)
+
     @property
     def active(self) -> QuerySet:
         """ Subscriptions that remain active within selected period. """
-        now_ = now()
+        as_of = self.as_of or now()
         return self.overlapping.exclude(
-            Q(end__lte=now_) | Q(end__gt=now_, auto_prolong=False),
+            Q(end__lte=as_of) | Q(end__gt=as_of, auto_prolong=False),
             end__gte=self.since,
             end__lte=self.until,
         ).order_by('start')
 
+    @cached_report_method
     def get_active_count(self) -> int:
         """ Number of subscriptions that remain active within selected period. """
+        if self._data:
+            return self._data.active_count
+        if snapshot := self.get_snapshot():
+            return snapshot.active_count
         return self.active.count()
 
-    def get_active_users_count(self) -> int:
-        """ Number of users that have active subscriptions within selected period. """
+    @cached_report_method
+    def get_active_users_count(self, approximate: bool = False) -> int:
+        """
+        Number of users that have active subscriptions within selected period.
+        With `approximate=True` it is estimated from `get_active_users_sketch` (~1.6% standard error).
+        """
+        if approximate:
+            return self.get_active_users_sketch().count()
+        if self._data:
+            return self._data.active_users_count
+        if snapshot := self.get_snapshot():
+            return snapshot.active_users_count
         return self.active.order_by('user').distinct('user').count()
 
+    @cached_report_method
+    def get_active_users_sketch(self) -> HyperLogLog:
+        """ HyperLogLog sketch of users that have active subscriptions within selected period. """
+        if (snapshot := self.get_snapshot()) and snapshot.active_users_sketch:
+            return HyperLogLog.from_bytes(snapshot.active_users_sketch)
+        return build_sketch(self.active, 'user')
+
+    @classmethod
+    def merge_active_users_sketches(cls, reports: Iterable[SubscriptionsReport]) -> HyperLogLog:
+        """
+        Sketch of users that have active subscriptions within any of `reports`' periods, e.g. merged
+        daily reports of a month estimate number of users who were active on at least one day of it.
+        Closed days are read from snapshots, if `reports` come from `iter_periods`.
+        """
+        sketch = HyperLogLog()
+        for report in reports:
+            sketch.merge(report.get_active_users_sketch())
+        return sketch
+
     def get_active_ages(self) -> list[timedelta]:
         """ list of ages for active subscriptions. """
+        if self._data:
+            return self._data.active_ages
         return self.active.with_ages(at=self.until).values_list('age', flat=True)
 
+    @cached_report_method
+    def get_active_ages_distribution(
+        self,
+        edges: Iterable[timedelta] = (),
+        percentiles: Iterable[float] = DEFAULT_AGE_PERCENTILES,
+    ) -> AgesDistribution:
+        """ Histogram and percentiles of ages for active subscriptions, without fetching every age. """
+        return get_ages_distribution(self.active.with_ages(at=self.until), edges=edges, percentiles=percentiles)
+
+    @cached_report_method
     def get_active_plans_and_quantities(self) -> list[tuple[Plan, int]]:
         """ list of plan & quantity tuples per subscription. """
+        if self._data:
+            return self._data.active_plans_and_quantities
         id_to_plan = {plan.id: plan for plan in Plan.objects.all()}
         return [
             (id_to_plan[plan_id], quantity)
             for plan_id, quantity in self.active.values_list('plan', 'quantity')
         ]
 
+    @cached_report_method
     def get_active_plans_total(self) -> Counter[Plan]:
         """ Overall number of quantities per plan. """
+        if self._data:
+            return self._data.active_plans_total
+        if snapshot := self.get_snapshot():
+            id_to_plan = Plan.objects.in_bulk(map(int, snapshot.active_plan_quantities))
+            return Counter({id_to_plan[int(plan_id)]: quantity for plan_id, quantity in snapshot.active_plan_quantities.items()})
+
         counter = Counter()
         for plan, quantity in self.get_active_plans_and_quantities():
             counter[plan] += quantity
         return counter
 
+    @classmethod
+    def get_series(cls, frequency: int, since: datetime, until: datetime, include_until: bool = False) -> SubscriptionsSeries:
+        """
+        Same as calling `get_new_count`, `get_ended_count`, `get_active_count` and
+        `get_active_users_count` of every report from `iter_periods`, but with
+        a single grouped query (on PostgreSQL) instead of a query per period and count.
+        """
+        bounds = list(cls.iter_period_bounds(frequency, since, until))
+        if not bounds:
+            return SubscriptionsSeries()
+
+        if connections[router.db_for_read(Subscription)].vendor == 'postgresql':
+            return cls._get_series_in_db(bounds, include_until=include_until)
+        return cls._get_series_in_python(bounds, include_until=include_until)
+
+    @staticmethod
+    def _get_series_in_db(bounds: list[tuple[datetime, datetime]], include_until: bool) -> SubscriptionsSeries:
+        connection = connections[router.db_for_read(Subscription)]
+        quote = connection.ops.quote_name
+        start, end, auto_prolong, user_id = (
+            quote(Subscription._meta.get_field(name).column)
+            for name in ('start', 'end', 'auto_prolong', 'user')
+        )
+
+        # periods are joined with subscriptions overlapping them, so that
+        # every count is an aggregate over a single group
+        ended = f's.{end} >= p.since AND s.{end} <= p.until AND (s.{end} <= %(now)s OR NOT s.{auto_prolong})'
+        query = f"""
+            SELECT
+                p.since,
+                p.until,
+                COUNT(s.{start}) FILTER (WHERE s.{start} >= p.since),
+                COUNT(s.{start}) FILTER (WHERE {ended}),
+                COUNT(s.{start}) FILTER (WHERE NOT ({ended})),
+                COUNT(DISTINCT s.{user_id}) FILTER (WHERE NOT ({ended}))
+            FROM unnest(%(since)s::timestamptz[], %(until)s::timestamptz[]) WITH ORDINALITY AS p(since, until, idx)
+            LEFT JOIN {quote(Subscription._meta.db_table)} s
+                ON s.{end} >= p.since AND s.{start} {'<=' if include_until else '<'} p.until
+            GROUP BY p.idx, p.since, p.until
+            ORDER BY p.idx
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(query, {
+                'since': [since for since, _ in bounds],
+                'until': [until for _, until in bounds],
+                'now': now(),
+            })
+            rows = cursor.fetchall()
+
+        return SubscriptionsSeries(*map(list, zip(*rows)))
+
+    @staticmethod
+    def _get_series_in_python(bounds: list[tuple[datetime, datetime]], include_until: bool) -> SubscriptionsSeries:
+        now_ = now()
+        sinces = [since for since, _ in bounds]
+        untils = [until for _, until in bounds]
+        series = SubscriptionsSeries(
+            since=sinces,
+            until=untils,
+            new_count=[0] * len(bounds),
+            ended_count=[0] * len(bounds),
+            active_count=[0] * len(bounds),
+            active_users_count=[0] * len(bounds),
+        )
+        active_users = [set() for _ in bounds]
+
+        subscriptions = (
+            Subscription.objects
+            .overlap(sinces[0], untils[-1], include_until=include_until)
+            .values_list('start', 'end', 'auto_prolong', 'user')
+        )
+        for start, end, auto_prolong, user in subscriptions.iterator():
+            # periods overlapping the subscription: since <= end and start < until (or start <= until)
+            first = (bisect_left if include_until else bisect_right)(untils, start)
+            last = bisect_right(sinces, end)
+            for i in range(first, last):
+                series.new_count[i] += start >= sinces[i]
+                if end <= untils[i] and (end <= now_ or not auto_prolong):
+                    series.ended_count[i] += 1
+                else:
+                    series.active_count[i] += 1
+                    active_users[i].add(user)
+
+        series.active_users_count = [len(users) for users in active_users]
+        return series
+
 
 @dataclass
-class TransactionsReport(IterPeriodsMixin):
+class TransactionsReport(ExportMixin, IterPeriodsMixin):
     """
     Report for transactions. Period's end is excluded: [since, until)
     """
 
+    EXPORTS: ClassVar[dict[str, tuple[str, tuple[str, ...]]]] = {
+        **{
+            kind: (attr, (
+                'uid', 'provider_transaction_id', 'status', 'user_id', 'plan_id', 'subscription_id',
+                'quantity', 'amount', 'amount_currency', 'created',
+            ))
+            for kind, attr in (('payments', 'payments'), ('completed', 'completed_payments'), ('incompleted', 'incompleted_payments'))
+        },
+        'refunds': ('refunds', ('uid', 'provider_transaction_id', 'original_payment_id', 'amount', 'amount_currency', 'created')),
+    }
+
     provider_codename: str
     since: datetime
     until: datetime = field(default_factory=now)
 
-    # TODO: some methods will explode when there are multiple currencies
+    # payments snapshots of selected period, if it is a closed snapshotted day; see `SubscriptionsReport._snapshot`
+    _snapshot: list[PaymentsSnapshot] | None = field(default=..., init=False, repr=False, compare=False)
+    _use_cache: bool = field(default=True, init=False, repr=False, compare=False)
+
+    def get_snapshot(self) -> list[PaymentsSnapshot] | None:
+        if self._snapshot is ...:
+            self.prefetch_snapshots([self])
+        return self._snapshot
+
+    @classmethod
+    def prefetch_snapshots(cls, reports: list[TransactionsReport]) -> None:
+        # day is snapshotted if there is a subscriptions snapshot for it, even if there are no payments
+        days = [get_snapshot_date(report.since, report.until) for report in reports]
+        snapshotted_days = set(SubscriptionsSnapshot.objects.filter(date__in={day for day in days if day}).values_list('date', flat=True))
+
+        rows = defaultdict(list)
+        for row in PaymentsSnapshot.objects.filter(
+            date__in=snapshotted_days,
+            provider_codename__in={report.provider_codename for report in reports},
+        ):
+            rows[(row.date, row.provider_codename)].append(row)
+
+        for report, day in zip(reports, days):
+            report._snapshot = rows[(day, report.provider_codename)] if day in snapshotted_days else None
+
+    @classmethod
+    def make_snapshots(cls, day: date) -> list[PaymentsSnapshot]:
+        """ Compute (but don't save) payments snapshots of a single day for all providers from live data. """
+        since, until = get_snapshot_period(day)
+        rows = (
+            SubscriptionPayment.objects
+            .filter(created__gte=since, created__lte=until)
+            .order_by()
+            .values_list('provider_codename', 'status', 'amount_currency')
+            .annotate(count=Count('*'), total=Sum(F('amount') * F('quantity')))
+        )
+        return [
+            PaymentsSnapshot(
+                date=day,
+                provider_codename=provider_codename,
+                status=status,
+                currency=currency or '',
+                count=count,
+                total=total,
+            )
+            for provider_codename, status, currency, count, total in rows
+        ]
+
+    def _get_snapshot_totals_by_currency(self, snapshot: list[PaymentsSnapshot], completed: bool) -> dict[str, Money]:
+        totals = defaultdict(Decimal)
+        for row in snapshot:
+            if row.total is not None and (row.status == AbstractTransaction.Status.COMPLETED) == completed:
+                totals[row.currency] += row.total
+        return {currency: Money(total, currency) for currency, total in sorted(totals.items())}
 
     @property
     def payments(self) -> QuerySet:
@@ -150,14 +792,26 @@ class TransactionsReport(IterPeriodsMixin):
             .order_by('created')
         )
 
+    @cached_report_method
     def get_payments_count_by_status(self) -> Counter[AbstractTransaction.Status]:
         """ Payments' statuses and their respective counts."""
+        if (snapshot := self.get_snapshot()) is not None:
+            counter = Counter()
+            for row in snapshot:
+                counter[row.status] += row.count
+            return counter
+
         return Counter(self.payments.values_list('status', flat=True))
 
     @property
     def completed_payments(self) -> QuerySet:
         return self.payments.filter(status=AbstractTransaction.Status.COMPLETED)
 
+    @property
+    def incompleted_payments(self) -> QuerySet:
+        return self.payments.exclude(status=AbstractTransaction.Status.COMPLETED)
+
+    @cached_report_method
     def get_completed_payments_amounts(self) -> list[Money | None]:
         """ list of amounts for completed payments. """
         return [
@@ -166,30 +820,45 @@ class TransactionsReport(IterPeriodsMixin):
             in self.completed_payments.values_list('amount', 'amount_currency', 'quantity')
         ]
 
+    @cached_report_method
+    def get_completed_payments_average_by_currency(self) -> dict[str, Money]:
+        """ Median amount for completed payments, per currency. """
+        return aggregate_money(self.completed_payments, Median, F('amount') * F('quantity'))
+
     def get_completed_payments_average(self) -> Money | None:
         """ Median amount for completed payments. """
-        amounts = [amount for amount in self.get_completed_payments_amounts() if amount is not None]
-        if amounts:
-            return median(amounts)
+        return get_single_currency(self.get_completed_payments_average_by_currency(), default=None)
+
+    @cached_report_method
+    def get_completed_payments_total_by_currency(self) -> dict[str, Money]:
+        """ Total amount for completed payments, per currency. """
+        if (snapshot := self.get_snapshot()) is not None:
+            return self._get_snapshot_totals_by_currency(snapshot, completed=True)
+        return aggregate_money(self.completed_payments, Sum, F('amount') * F('quantity'))
 
     def get_completed_payments_total(self) -> Money:
         """ Total amount for completed payments. """
-        amounts = [amount for amount in self.get_completed_payments_amounts() if amount is not None]
-        return sum(amounts) if amounts else NO_MONEY
+        return get_single_currency(self.get_completed_payments_total_by_currency(), default=NO_MONEY)
 
+    @cached_report_method
     def get_incompleted_payments_amounts(self) -> list[Money | None]:
         """ list of amounts for incompleted payments. """
-        incompleted_payments = self.payments.exclude(status=AbstractTransaction.Status.COMPLETED)
         return [
             Money(amount, amount_currency) * quantity if amount is not None else None
             for amount, amount_currency, quantity
-            in incompleted_payments.values_list('amount', 'amount_currency', 'quantity')
+            in self.incompleted_payments.values_list('amount', 'amount_currency', 'quantity')
         ]
 
+    @cached_report_method
+    def get_incompleted_payments_total_by_currency(self) -> dict[str, Money]:
+        """ Total amount for incompleted payments, per currency. """
+        if (snapshot := self.get_snapshot()) is not None:
+            return self._get_snapshot_totals_by_currency(snapshot, completed=False)
+        return aggregate_money(self.incompleted_payments, Sum, F('amount') * F('quantity'))
+
     def get_incompleted_payments_total(self) -> Money:
         """ Total amount for incompleted payments. """
-        amounts = [amount for amount in self.get_incompleted_payments_amounts() if amount is not None]
-        return sum(amounts) if amounts else NO_MONEY
+        return get_single_currency(self.get_incompleted_payments_total_by_currency(), default=NO_MONEY)
 
     @property
     def refunds(self) -> QuerySet:
@@ -203,10 +872,12 @@ class TransactionsReport(IterPeriodsMixin):
             .order_by('created')
         )
 
+    @cached_report_method
     def get_refunds_count(self) -> int:
         """ Total number of refunds."""
         return self.refunds.count()
 
+    @cached_report_method
     def get_refunds_amounts(self) -> list[Money | None]:
         """ list of refunds' amounts. """
         return [
@@ -214,17 +885,25 @@ class TransactionsReport(IterPeriodsMixin):
             for amount, currency in self.refunds.values_list('amount', 'amount_currency')
         ]
 
+    @cached_report_method
+    def get_refunds_average_by_currency(self) -> dict[str, Money]:
+        """ Median amount for refunds, per currency. """
+        return aggregate_money(self.refunds, Median, F('amount'))
+
     def get_refunds_average(self) -> Money | None:
         """ Median amount for refunds. """
-        amounts = [amount for amount in self.get_refunds_amounts() if amount is not None]
-        if amounts:
-            return median(amounts)
+        return get_single_currency(self.get_refunds_average_by_currency(), default=None)
+
+    @cached_report_method
+    def get_refunds_total_by_currency(self) -> dict[str, Money]:
+        """ Total amount for refunds, per currency. """
+        return aggregate_money(self.refunds, Sum, F('amount'))
 
     def get_refunds_total(self) -> Money | None:
         """ Total amount for refunds. """
-        amounts = [amount for amount in self.get_refunds_amounts() if amount is not None]
-        return sum(amounts) if amounts else NO_MONEY
+        return get_single_currency(self.get_refunds_total_by_currency(), default=NO_MONEY)
 
+    @cached_report_method
     def get_estimated_recurring_charge_amounts_by_time(self) -> dict[datetime, Money]:
         """
         Estimated charge amount by datetime.
@@ -232,23 +911,8 @@ class TransactionsReport(IterPeriodsMixin):
         This works even for past periods, so that one can compare difference
         between estimated and real charges.
         """
-        subscriptions = (
-            Subscription.objects
-            .overlap(self.since, self.until)
-            .recurring()
-            .select_related('plan')
-        )
-
-        estimated_charges = defaultdict(int)
-        for subscription in subscriptions:
-            if subscription.plan.charge_amount is None:
-                continue
-
-            amount = subscription.plan.charge_amount * subscription.quantity
-            for charge_date in subscription.iter_charge_dates(self.since, self.until):
-                estimated_charges[charge_date] += amount
-
-        return estimated_charges
+        subscriptions = Subscription.objects.overlap(self.since, self.until).recurring()
+        return project_recurring_charges(subscriptions, self.since, self.until)
 
     def get_estimated_recurring_charge_total(self) -> Money:
         """ Total estimated charge amount. """
@@ -256,3 +920,188 @@ class TransactionsReport(IterPeriodsMixin):
             return sum(amounts_by_time.values())
 
         return NO_MONEY
+
+
+@dataclass
+class Cohorts:
+    """
+    Retention matrix: `retained[i][j]` is number of users of i-th cohort who had a paid subscription
+    within j-th period since the cohort's period (`retained[i][0] == sizes[i]`). Rows get shorter
+    for younger cohorts, as only periods which already started are counted.
+    """
+
+    periods: list[datetime] = field(default_factory=list)  # start of each cohort's period
+    sizes: list[int] = field(default_factory=list)
+    retained: list[array] = field(default_factory=list)
+
+    def __len__(self) -> int:
+        return len(self.periods)
+
+    def get_retention_rates(self) -> list[list[float]]:
+        """ Same as `retained`, but as a fraction of cohort size. """
+        return [[count / size if size else 0. for count in row] for row, size in zip(self.retained, self.sizes)]
+
+
+@dataclass
+class CohortReport:
+    """
+    Users grouped by the period of their first paid subscription's start within [since, until),
+    and their retention in each subsequent period (up to now).
+    """
+
+    since: datetime
+    until: datetime = field(default_factory=now)
+    frequency: int = MONTHLY
+    chunk_size: int = EXPORT_CHUNK_SIZE
+
+    @property
+    def subscriptions(self) -> QuerySet:
+        """ Paid subscriptions of users whose first paid subscription starts within selected period. """
+        paid = Subscription.objects.paid()
+        users = (
+            paid
+            .order_by()
+            .values('user')
+            .annotate(first_start=Min('start'))
+            .filter(first_start__gte=self.since, first_start__lt=min(self.until, now()))
+            .values('user')
+        )
+        return paid.filter(user__in=users)
+
+    def get_cohorts(self) -> Cohorts:
+        """
+        Compute retention matrix in a single pass over subscriptions sorted by user and start:
+        each user's subscriptions are merged into a bit mask of periods, which is then added
+        to the user's cohort row.
+        """
+
+        now_ = now()
+        period_starts = list(rrule(self.frequency, dtstart=self.since, until=max(self.since, now_)))
+        num_cohorts = bisect_left(period_starts, self.until)
+        cohorts = Cohorts(
+            periods=period_starts[:num_cohorts],
+            sizes=[0] * num_cohorts,
+            retained=[array('L', [0]) * (len(period_starts) - i) for i in range(num_cohorts)],
+        )
+
+        def add_user(cohort: int, mask: int):
+            cohorts.sizes[cohort] += 1
+            row = cohorts.retained[cohort]
+            while mask:
+                lowest = mask & -mask
+                row[lowest.bit_length() - 1 - cohort] += 1
+                mask ^= lowest
+
+        last_user, cohort, mask = None, 0, 0
+        rows = self.subscriptions.order_by('user', 'start').values_list('user', 'start', 'end').iterator(chunk_size=self.chunk_size)
+        for user, start, end in rows:
+            if user != last_user:
+                if last_user is not None:
+                    add_user(cohort, mask)
+                last_user, mask = user, 0
+                cohort = bisect_right(period_starts, start) - 1  # first paid subscription
+
+            end = min(end, now_)
+            if end <= start:
+                continue
+
+            first = bisect_right(period_starts, start) - 1
+            last = bisect_left(period_starts, end) - 1  # period of end is excluded if it starts at the very end
+            mask |= ((1 << (last - first + 1)) - 1) << first
+
+        if last_user is not None:
+            add_user(cohort, mask)
+
+        return cohorts
+
+
+def _evaluate_reports(
+    periods: list[tuple[datetime, datetime]],
+    report_cls: type[IterPeriodsMixin],
+    methods: list[str],
+    kwargs: dict,
+    close_connections: bool = False,
+) -> list[dict[str, Any]]:
+    try:
+        reports = [report_cls(since=since, until=until, **kwargs) for since, until in periods]
+        report_cls.prefetch_snapshots(reports)
+        return [{method: getattr(report, method)() for method in methods} for report in reports]
+    finally:
+        if close_connections:
+            # pool threads have their own DB connections, which would stay open after pool is shut down
+            connections.close_all()
+
+
+def generate_reports(
+    report_cls: type[IterPeriodsMixin],
+    periods: Iterable[tuple[datetime, datetime]],
+    methods: Iterable[str],
+    workers: int = 1,
+    processes: bool = False,
+    batch_size: int = 24,
+    **kwargs,
+) -> Iterator[tuple[Any, dict[str, Any]]]:
+    """
+    Call `methods` of `report_cls(since, until, **kwargs)` for every (since, until) of `periods`
+    (e.g. from `report_cls.iter_period_bounds`) and yield `(report, {method: result})` in order.
+
+    Periods are evaluated by `workers` threads (or forked processes, if `processes=True`)
+    in batches of `batch_size` periods; every worker uses its own DB connections.
+    Results of a process pool should be picklable; process pool shouldn't be used
+    within a transaction, as DB connections are closed before forking.
+    """
+
+    batches = list(chunked(periods, batch_size))
+    evaluate = partial(
+        _evaluate_reports,
+        report_cls=report_cls,
+        methods=list(methods),
+        kwargs=kwargs,
+        close_connections=workers > 1 and not processes,
+    )
+
+    pool: Executor | None = None
+    if workers > 1 and processes:
+        connections.close_all()  # forked processes must not share parent's connections
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+    elif workers > 1:
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='generate-reports')
+
+    results = pool.map(evaluate, batches) if pool else map(evaluate, batches)
+
+    try:
+        for batch, batch_results in zip(batches, results):
+            for (since, until), values in zip(batch, batch_results):
+                yield report_cls(since=since, until=until, **kwargs), values
+    finally:
+        if pool:
+            pool.shutdown(cancel_futures=True)
+
+
+def export_report(
+    report: str,
+    kind: str,
+    since: datetime,
+    until: datetime,
+    format: str = 'csv',
+    provider_codename: str = '',
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> Iterator[str]:
+    """ Check export parameters and return lines of `report` ("subscriptions" or "transactions") export. """
+
+    if report == 'subscriptions':
+        report_ = SubscriptionsReport(since=since, until=until)
+    elif report == 'transactions':
+        if not provider_codename:
+            raise ValueError('Provider is required to export transactions')
+        report_ = TransactionsReport(provider_codename=provider_codename, since=since, until=until)
+    else:
+        raise ValueError(f'Unknown report "{report}", choose one of: subscriptions, transactions')
+
+    if kind not in report_.EXPORTS:
+        raise ValueError(f'Unknown {report} export "{kind}", choose one of: {", ".join(report_.EXPORTS)}')
+
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format "{format}", choose one of: {", ".join(EXPORT_FORMATS)}')
+
+    return report_.export(kind, format=format, chunk_size=chunk_size)
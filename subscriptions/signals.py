@@ -3,12 +3,17 @@ from contextlib import suppress
 
 from django.contrib.auth import get_user_model
 from django.db import transaction
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.utils.timezone import now
 
-from .functions import add_default_plan_to_users, get_default_plan
-from .models import MAX_DATETIME, Plan, Subscription
+from .functions import (
+    add_default_plan_to_users,
+    drop_refresh_moments_cache,
+    drop_refresh_moments_catalog_cache,
+    get_default_plan,
+)
+from .models import MAX_DATETIME, Plan, Quota, Subscription
 
 log = logging.getLogger(__name__)
 
@@ -26,6 +31,20 @@ def create_default_subscription_for_new_user(sender, instance, created, **kwargs
             )
 
 
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def drop_user_refresh_moments(sender, instance, **kwargs):
+    drop_refresh_moments_cache(instance.user_id)
+
+
+@receiver(post_save, sender=Plan)
+@receiver(post_delete, sender=Plan)
+@receiver(post_save, sender=Quota)
+@receiver(post_delete, sender=Quota)
+def drop_catalog_refresh_moments(sender, instance, **kwargs):
+    drop_refresh_moments_catalog_cache()
+
+
 with suppress(ImportError):
     from constance.signals import config_updated
 
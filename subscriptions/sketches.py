@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import hashlib
+from dataclasses import dataclass, field
+from math import log
+from typing import Any, Iterable
+
+from django.db import connections
+from django.db.models import QuerySet
+
+# 2**12 registers (4 KiB per sketch); relative standard error is 1.04 / sqrt(2**12) ~ 1.6%
+HYPERLOGLOG_PRECISION = 12
+HASH_BITS = 64
+
+
+@dataclass
+class HyperLogLog:
+    """
+    Approximate distinct counter (HyperLogLog with linear counting for small cardinalities).
+
+    Relative standard error of `count()` is 1.04 / sqrt(2**precision): ~1.6% for default
+    precision, i.e. estimate is within ±3.2% of the exact value in ~95% of cases. Sketches
+    of the same precision may be merged: merged sketch counts distinct values added
+    to any of them, without counting values which are in several sketches twice.
+    """
+
+    precision: int = HYPERLOGLOG_PRECISION
+    registers: bytearray | None = field(default=None, repr=False)
+
+    def __post_init__(self):
+        assert 4 <= self.precision <= 16, 'Precision should be within [4, 16]'
+        if self.registers is None:
+            self.registers = bytearray(self.num_registers)
+        assert len(self.registers) == self.num_registers, 'Number of registers should match precision'
+
+    @property
+    def num_registers(self) -> int:
+        return 1 << self.precision
+
+    @property
+    def standard_error(self) -> float:
+        return 1.04 / self.num_registers ** 0.5
+
+    @classmethod
+    def from_bytes(cls, value: bytes) -> HyperLogLog:
+        return cls(precision=len(value).bit_length() - 1, registers=bytearray(value))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self.registers)
+
+    def add_hash(self, value: int):
+        """ Add 64-bit unsigned hash of a value. """
+        index = value >> (HASH_BITS - self.precision)
+        rest = value & ((1 << (HASH_BITS - self.precision)) - 1)
+        rank = HASH_BITS - self.precision - rest.bit_length() + 1  # position of the leftmost 1-bit
+        self.registers[index] = max(self.registers[index], rank)
+
+    def add(self, value: Any):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=HASH_BITS // 8).digest()
+        self.add_hash(int.from_bytes(digest, 'big'))
+
+    def update(self, values: Iterable[Any]):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other: HyperLogLog):
+        if other.precision != self.precision:
+            raise ValueError(f'Cannot merge sketches of different precision ({self.precision} and {other.precision})')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def __or__(self, other: HyperLogLog) -> HyperLogLog:
+        result = HyperLogLog(precision=self.precision, registers=bytearray(self.registers))
+        result.merge(other)
+        return result
+
+    def count(self) -> int:
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2. ** -register for register in self.registers)
+
+        # 64-bit hashes don't need large range correction
+        if estimate <= 2.5 * m and (num_zeros := self.registers.count(0)):
+            estimate = m * log(m / num_zeros)
+
+        return round(estimate)
+
+
+def build_sketch(queryset: QuerySet, column: str, precision: int = HYPERLOGLOG_PRECISION) -> HyperLogLog:
+    """
+    Build sketch of distinct `column` values of `queryset`.
+
+    On PostgreSQL values are hashed and binned in the database, so that a single query
+    returns at most 2**precision rows. Elsewhere values are streamed and hashed in Python;
+    hashes differ, so sketches built by different databases shouldn't be merged.
+    """
+
+    sketch = HyperLogLog(precision=precision)
+    values = queryset.order_by().values_list(column, flat=True)
+
+    connection = connections[values.db]
+    if connection.vendor != 'postgresql':
+        sketch.update(values.distinct().iterator())
+        return sketch
+
+    subquery, params = values.query.get_compiler(using=values.db).as_sql()
+    sql = f'''
+        SELECT
+            substring(hash FROM 1 FOR {precision})::bit({precision})::integer,
+            MAX(COALESCE(NULLIF(position(B'1' IN substring(hash FROM {precision + 1})), 0), {HASH_BITS - precision + 1}))
+        FROM (
+            SELECT hashtextextended(value::text, 0)::bit({HASH_BITS}) AS hash
+            FROM ({subquery}) AS subquery (value)
+        ) AS hashes
+        GROUP BY 1
+    '''
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        for index, rank in cursor.fetchall():
+            sketch.registers[index] = rank
+
+    return sketch
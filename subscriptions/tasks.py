@@ -1,25 +1,47 @@
 from __future__ import annotations
 
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, wait
-from datetime import datetime, timedelta
-from functools import partial
+import asyncio
+import os
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from enum import Enum
+from functools import partial, reduce
+from itertools import groupby
 from logging import getLogger
-from typing import Iterable
+from operator import attrgetter, or_
+from queue import Queue
+from threading import Thread
+from time import monotonic
+from typing import Awaitable, Callable, Iterable, Iterator
+from uuid import UUID
 
 from django.conf import settings
-from django.db import transaction
-from django.db.models import Q, QuerySet
+from django.db import close_old_connections, connections, transaction
+from django.db.models import Count, Max, Min, OuterRef, Q, QuerySet, Subquery
 from django.utils.timezone import now
-from more_itertools import first, pairwise
+from djmoney.money import Money
+from more_itertools import chunked
 
 from .defaults import (
     DEFAULT_NOTIFY_PENDING_PAYMENTS_AFTER,
+    DEFAULT_SUBSCRIPTIONS_REPORT_SNAPSHOTS_REFRESH_PERIOD,
     DEFAULT_SUBSCRIPTIONS_OFFLINE_CHARGE_ATTEMPTS_SCHEDULE,
 )
-from .exceptions import PaymentError, ProlongationImpossible
-from .models import Subscription, SubscriptionPayment
-from .providers import get_provider
+from .exceptions import (
+    PaymentError,
+    ProlongationImpossible,
+    ProviderNotFound,
+    ProviderUnavailable,
+)
+from .models import ChargeRun, PaymentsSnapshot, Subscription, SubscriptionPayment, SubscriptionsSnapshot
+from .providers import Provider, get_provider, get_providers
+from .providers.circuit_breakers import CircuitState
+from .reports import SubscriptionsReport, TransactionsReport
+from .utils import database_sync_to_async
 
 log = getLogger(__name__)
 
@@ -29,66 +51,180 @@ DEFAULT_CHARGE_ATTEMPTS_SCHEDULE = getattr(
     DEFAULT_SUBSCRIPTIONS_OFFLINE_CHARGE_ATTEMPTS_SCHEDULE,
 )
 
+# PENDING placeholder payments of asyncio charge engine are marked with this metadata key;
+# placeholders older than timeout are left by crashed runs
+CHARGE_PLACEHOLDER_METADATA_KEY = 'charge_in_progress'
+CHARGE_PLACEHOLDER_TIMEOUT = timedelta(hours=1)
 
-@transaction.atomic
-def _charge_recurring_subscription(
-    subscription: Subscription,
-    schedule: Iterable[timedelta],
-    at: datetime,
-    lock: bool = True,
-):
-    if lock:
-        # here we lock specific subscription object, so that we don't try charging it twice
-        # at the same time
-        _ = list(Subscription.objects.filter(pk=subscription.pk).select_for_update(of=('self',)))  # TODO: skip_locked=True?
+DEFAULT_REPORT_SNAPSHOTS_REFRESH_PERIOD = getattr(
+    settings,
+    'SUBSCRIPTIONS_REPORT_SNAPSHOTS_REFRESH_PERIOD',
+    DEFAULT_SUBSCRIPTIONS_REPORT_SNAPSHOTS_REFRESH_PERIOD,
+)
 
-    log.debug('Processing subscription %s', subscription)
 
-    # expiration_date = next(subscription.iter_charge_dates(since=now_))
-    # TODO: what if `subscription.end_date` expiration_date doesn't match `subscription.iter_charge_dates()`?
-    expiration_date = subscription.end
+class ChargeOutcome(str, Enum):
+    CHARGED = 'charged'
+    SKIPPED = 'skipped'
+    DEFERRED = 'deferred'  # provider is unavailable, will try again in next run
+    FAILED = 'failed'
 
-    charge_dates = [expiration_date + delta for delta in schedule]
-    charge_periods = pairwise(charge_dates)
 
-    try:
-        charge_period = first(period for period in charge_periods if period[0] <= at < period[1])
-    except ValueError:
-        log.warning('Current time %s doesn\'t fall within any charge period, skipping', at)
-        return
+@dataclass
+class ChargeResult:
+    subscription_uid: UUID
+    outcome: ChargeOutcome
+    duration: timedelta
 
-    log.debug(
-        'Current time %s falls within period %s (delta: %s)',
-        at,
-        [date.isoformat() for date in charge_period],
-        expiration_date - at,
-    )
 
-    # we don't want to try charging if
-    # 1) there is already ANY charge attempt (successful or not) in this charge period
-    # (so if there was ERROR charge in this period, we will try again only in next period)
-    # 2) there is already any PENDING charge attempt; all charge attempts should end up
-    # being in COMPLETED/ERROR/ABANDONED etc state, and PENDING payments will be garbage-collected
-    # by a separate task
-    previous_payment_attempts = subscription.payments.filter(
-        Q(created__gte=charge_period[0], created__lt=charge_period[1]) |  # any attempt in this period
-        Q(status=SubscriptionPayment.Status.PENDING)  # any pending attempt
+@dataclass
+class ChargeRunSummary:
+    started: datetime
+    finished: datetime | None = None
+    results: list[ChargeResult] = field(default_factory=list)
+    run: ChargeRun | None = None
+
+    @property
+    def duration(self) -> timedelta | None:
+        return self.finished and self.finished - self.started
+
+    def get_counts(self) -> dict[ChargeOutcome, int]:
+        counts = Counter(result.outcome for result in self.results)
+        return {outcome: counts[outcome] for outcome in ChargeOutcome}
+
+
+# key by which charge candidates are ordered: (end, uid)
+CandidateKey = tuple[datetime, UUID]
+
+
+class _ChargeRunProgress:
+    """
+    Save counters and cursor of `run` to DB. Workers finish subscriptions out of order,
+    so cursor only moves over the contiguous prefix of processed subscriptions:
+    everything up to the cursor is guaranteed to be processed.
+    """
+
+    def __init__(self, run: ChargeRun, results: list[ChargeResult], checkpoint_every: int):
+        self.run = run
+        self.results = results  # appended by workers
+        self.checkpoint_every = checkpoint_every
+
+        self._dispatched: deque[CandidateKey] = deque()
+        self._processed: set[UUID] = set()
+        self._counts: Counter[ChargeOutcome] = Counter()
+        self._num_seen = 0
+
+    def dispatch(self, subscription: Subscription) -> CandidateKey:
+        # key is taken before charging, because charge prolongs subscription
+        key = (subscription.end, subscription.uid)
+        self._dispatched.append(key)
+        return key
+
+    def is_due(self) -> bool:
+        return len(self.results) - self._num_seen >= self.checkpoint_every
+
+    def checkpoint(self):
+        new_results = self.results[self._num_seen:]
+        self._num_seen += len(new_results)
+        for result in new_results:
+            self._processed.add(result.subscription_uid)
+            self._counts[result.outcome] += 1
+
+        while self._dispatched and self._dispatched[0][1] in self._processed:
+            self.run.cursor_end, self.run.cursor_uid = self._dispatched.popleft()
+            self._processed.remove(self.run.cursor_uid)
+
+        for outcome in ChargeOutcome:
+            setattr(self.run, f'num_{outcome.value}', self._counts[outcome])
+        self.run.save()
+
+    def finish(self):
+        self.run.finished = now()
+        self.run.save(update_fields=['finished', 'updated'])
+
+
+def _start_charge_run(started: datetime, resume: ChargeRun | None) -> ChargeRun:
+    return ChargeRun.objects.create(
+        started=started,
+        resumed_from=resume,
+        cursor_end=resume.cursor_end if resume else None,
+        cursor_uid=resume.cursor_uid if resume else None,
     )
-    if previous_payment_attempts.exists():
-        previous_payment_attempts = list(previous_payment_attempts)
-        log.debug('Skipping this payment, because of already existing payment attempt(s): %s', previous_payment_attempts)
 
-        if len(previous_payment_attempts) > 1:
-            log.warning('Multiple payment attempts detected (should be at most 1 attempt): %s', previous_payment_attempts)
 
-        if (successful_attempts := [
-            attempt for attempt in previous_payment_attempts
-            if attempt.status == SubscriptionPayment.Status.COMPLETED
-        ]):
-            log.warning('Previous payment attempt was successful but subscription end is still approaching: %s', successful_attempts)
+def _get_charge_time(resume: ChargeRun | None, started: datetime) -> datetime:
+    """
+    Moment at which charge candidates are selected. Resumed run uses the time of the first
+    run it continues, so that it skips exactly what was processed from the same candidates;
+    otherwise subscriptions before the cursor which moved into a new charge window
+    meanwhile would be skipped until the next full run.
+    """
+
+    if resume is None:
+        return started
+
+    while resume.resumed_from_id:
+        resume = resume.resumed_from
+    return resume.started
+
+
+def _after_key(candidates: QuerySet, key: CandidateKey | None) -> QuerySet:
+    if key is None or key[0] is None:
+        return candidates
+
+    end, uid = key
+    return candidates.filter(Q(end__gt=end) | Q(end=end, uid__gt=uid))
+
+
+def get_resumable_charge_run() -> ChargeRun | None:
+    """ Latest charge run which didn't finish and wasn't resumed yet. """
+
+    return ChargeRun.objects.filter(
+        finished__isnull=True,
+        resumed_by__isnull=True,
+    ).order_by('-started').first()
+
 
+def _lock_charge_candidate(subscription: Subscription, schedule: Iterable[timedelta], at: datetime) -> bool:
+    """ Lock subscription until the end of transaction; return False if it shouldn't be charged anymore. """
+
+    # here we lock specific subscription object, so that we don't try charging it twice
+    # at the same time
+    _ = list(Subscription.objects.filter(pk=subscription.pk).select_for_update(of=('self',)))  # TODO: skip_locked=True?
+
+    # the subscription was selected as a charge candidate before the lock was acquired,
+    # so someone else could have made a charge attempt in the meanwhile
+    if not Subscription.objects.filter(pk=subscription.pk).with_charge_period(schedule, at=at).without_charge_attempts().exists():
+        _log_previous_charge_attempts(subscription, schedule, at)
+        return False
+
+    return True
+
+
+def _log_previous_charge_attempts(subscription: Subscription, schedule: Iterable[timedelta], at: datetime):
+    charge_period = Subscription.objects.filter(pk=subscription.pk).with_charge_period(schedule, at=at).values_list(
+        'charge_period_start', 'charge_period_end',
+    ).first()
+    if not charge_period or charge_period[0] is None:
+        log.debug('Skipping subscription %s, because current time %s doesn\'t fall within any charge period anymore', subscription, at)
         return
 
+    previous_payment_attempts = list(subscription.payments.filter(
+        Q(created__gte=charge_period[0], created__lt=charge_period[1]) | Q(status=SubscriptionPayment.Status.PENDING),
+    ))
+    log.debug('Skipping this payment, because of already existing payment attempt(s): %s', previous_payment_attempts)
+
+    if len(previous_payment_attempts) > 1:
+        log.warning('Multiple payment attempts detected (should be at most 1 attempt): %s', previous_payment_attempts)
+
+    if (successful_attempts := [
+        attempt for attempt in previous_payment_attempts
+        if attempt.status == SubscriptionPayment.Status.COMPLETED
+    ]):
+        log.warning('Previous payment attempt was successful but subscription end is still approaching: %s', successful_attempts)
+
+
+def _can_prolong(subscription: Subscription) -> bool:
     log.debug('Trying to prolong subscription %s', subscription)
     try:
         subscription.prolong()  # try extending end date of subscription
@@ -100,74 +236,307 @@ def _charge_recurring_subscription(
         subscription.save()
         log.debug('Turned off auto-prolongation of subscription %s', subscription)
         # TODO: send email to user
-        return
+        return False
+
+    return True
+
+
+def _record_failed_charge(subscription: Subscription, exc: PaymentError, payment: SubscriptionPayment | None = None):
+    log.warning('Failed to offline-charge subscription', extra=exc.debug_info)
+
+    # here we create a failed SubscriptionPayment to indicate that we tried
+    # to charge but something went wrong, so that subsequent task calls
+    # won't try charging and sending email again within same charge_period
+    payment = payment or SubscriptionPayment(
+        user=subscription.user,
+        plan=subscription.plan,
+        subscription=subscription,
+        quantity=subscription.quantity,
+    )
+    payment.provider_codename = ''
+    payment.status = SubscriptionPayment.Status.ERROR
+    payment.metadata = exc.debug_info
+    payment.save()
+
+
+@transaction.atomic
+def _charge_recurring_subscription(
+    subscription: Subscription,
+    schedule: Iterable[timedelta],
+    at: datetime,
+    lock: bool = True,
+) -> ChargeOutcome:
+    """
+    Offline-charge subscription which is expected to be annotated with its
+    current charge period (see `SubscriptionQuerySet.with_charge_period`).
+    """
+
+    log.debug('Processing subscription %s', subscription)
+
+    if lock and not _lock_charge_candidate(subscription, schedule, at):
+        return ChargeOutcome.SKIPPED
+
+    log.debug(
+        'Current time %s falls within period %s (delta: %s)',
+        at,
+        [date.isoformat() for date in (subscription.charge_period_start, subscription.charge_period_end)],
+        subscription.end - at,
+    )
+
+    if not _can_prolong(subscription):
+        return ChargeOutcome.SKIPPED
 
     try:
         log.debug('Offline-charging subscription %s', subscription)
         subscription.charge_offline()
+    except ProviderUnavailable as exc:
+        # don't create a failed SubscriptionPayment, so that charge is retried
+        # in next run (within same charge period) when provider recovers
+        log.debug('Deferring offline charge of subscription %s: %s', subscription, exc)
+        return ChargeOutcome.DEFERRED
     except PaymentError as exc:
-        log.warning('Failed to offline-charge subscription', extra=exc.debug_info)
-
-        # here we create a failed SubscriptionPayment to indicate that we tried
-        # to charge but something went wrong, so that subsequent task calls
-        # won't try charging and sending email again within same charge_period
-        SubscriptionPayment.objects.create(
-            provider_codename='',
-            user=subscription.user,
-            status=SubscriptionPayment.Status.ERROR,
-            plan=subscription.plan,
-            subscription=subscription,
-            quantity=subscription.quantity,
-            metadata=exc.debug_info,
-        )
-        return
+        _record_failed_charge(subscription, exc)
+        return ChargeOutcome.FAILED
 
     log.debug('Offline charge successfully created for subscription %s', subscription)
     # even if offline subscription succeeds, we are not sure about its status,
     # so we don't prolong the subscription here but instead let setting
     # `subscription.status = COMPLETED` (by charge_offline or webhook or whatever)
     # to auto-prolong subscription itself
+    return ChargeOutcome.CHARGED
+
+
+def _charge_and_measure(charge: Callable[[Subscription], ChargeOutcome], subscription: Subscription) -> ChargeResult:
+    started = monotonic()
+    try:
+        outcome = charge(subscription)
+    except Exception:
+        log.exception('Failed to charge subscription %s', subscription)
+        outcome = ChargeOutcome.FAILED
+
+    return ChargeResult(
+        subscription_uid=subscription.uid,
+        outcome=outcome,
+        duration=timedelta(seconds=monotonic() - started),
+    )
+
+
+def _charging_worker(
+    charge: Callable[[Subscription], ChargeOutcome],
+    queue: Queue,
+    results: list[ChargeResult],
+):
+    """ Consume subscriptions from `queue` until `None` is received. """
+
+    try:
+        while (subscription := queue.get()) is not None:
+            # same as for every http request: drop connections which are broken or exceeded CONN_MAX_AGE
+            close_old_connections()
+            results.append(_charge_and_measure(charge, subscription))
+    finally:
+        # each thread has its own DB connections, which won't be reused after thread exits
+        connections.close_all()
+
+
+@dataclass
+class _ChargeClaim:
+    provider: Provider
+    charge_kwargs: dict
+    placeholder: SubscriptionPayment
+
+
+@transaction.atomic
+def _claim_recurring_subscription(
+    subscription: Subscription,
+    schedule: Iterable[timedelta],
+    at: datetime,
+    lock: bool = True,
+) -> ChargeOutcome | _ChargeClaim:
+    """
+    Do all DB work preceding offline charge of a subscription. Lock can't be held while provider
+    is being awaited, so instead a PENDING placeholder payment is created, which makes
+    subscription ineligible for other charging runs (see `without_charge_attempts`).
+    Placeholders are not real payments: they are excluded from payment checks, and
+    placeholders left by crashed runs are deleted by `delete_stale_charge_placeholders`.
+    """
+
+    log.debug('Processing subscription %s', subscription)
+
+    if lock and not _lock_charge_candidate(subscription, schedule, at):
+        return ChargeOutcome.SKIPPED
+
+    if not _can_prolong(subscription):
+        return ChargeOutcome.SKIPPED
+
+    try:
+        provider, charge_kwargs = subscription.prepare_offline_charge()
+    except PaymentError as exc:
+        _record_failed_charge(subscription, exc)
+        return ChargeOutcome.FAILED
+
+    # no provider codename, so that placeholder is never checked with a provider
+    placeholder = SubscriptionPayment.objects.create(
+        provider_codename='',
+        status=SubscriptionPayment.Status.PENDING,
+        user=subscription.user,
+        plan=subscription.plan,
+        subscription=subscription,
+        quantity=subscription.quantity,
+        metadata={CHARGE_PLACEHOLDER_METADATA_KEY: True},
+    )
+    return _ChargeClaim(provider=provider, charge_kwargs=charge_kwargs, placeholder=placeholder)
+
+
+async def _acharge_recurring_subscription(
+    subscription: Subscription,
+    schedule: Iterable[timedelta],
+    at: datetime,
+    lock: bool = True,
+) -> ChargeOutcome:
+    """ Asyncio counterpart of `_charge_recurring_subscription`. """
+
+    claim = await database_sync_to_async(_claim_recurring_subscription)(subscription, schedule, at, lock=lock)
+    if isinstance(claim, ChargeOutcome):
+        return claim
+
+    delete_placeholder = database_sync_to_async(claim.placeholder.delete)
+
+    try:
+        log.debug('Offline-charging subscription %s', subscription)
+        await claim.provider.acharge_offline(**claim.charge_kwargs)
+    except ProviderUnavailable as exc:
+        log.debug('Deferring offline charge of subscription %s: %s', subscription, exc)
+        await delete_placeholder()
+        return ChargeOutcome.DEFERRED
+    except PaymentError as exc:
+        await database_sync_to_async(_record_failed_charge)(subscription, exc, payment=claim.placeholder)
+        return ChargeOutcome.FAILED
+    except Exception:
+        # same as rolled back transaction in synchronous version: charge will be retried in next run
+        await delete_placeholder()
+        raise
+
+    log.debug('Offline charge successfully created for subscription %s', subscription)
+    await delete_placeholder()
+    return ChargeOutcome.CHARGED
+
+
+async def _acharge_and_measure(
+    charge: Callable[[Subscription], Awaitable[ChargeOutcome]],
+    subscription: Subscription,
+) -> ChargeResult:
+    started = monotonic()
+    try:
+        outcome = await charge(subscription)
+    except Exception:
+        log.exception('Failed to charge subscription %s', subscription)
+        outcome = ChargeOutcome.FAILED
+
+    return ChargeResult(
+        subscription_uid=subscription.uid,
+        outcome=outcome,
+        duration=timedelta(seconds=monotonic() - started),
+    )
+
+
+def exclude_charge_placeholders(payments: QuerySet) -> QuerySet:
+    return payments.exclude(metadata__has_key=CHARGE_PLACEHOLDER_METADATA_KEY)
+
+
+def delete_stale_charge_placeholders(older_than: timedelta = CHARGE_PLACEHOLDER_TIMEOUT) -> int:
+    """
+    Delete placeholder payments left by crashed asyncio charge runs, so that their subscriptions
+    may be charged again; same as rolled back transaction of synchronous charge.
+    """
+
+    stale_placeholders = SubscriptionPayment.objects.filter(
+        created__lte=now() - older_than,
+        status=SubscriptionPayment.Status.PENDING,
+        metadata__has_key=CHARGE_PLACEHOLDER_METADATA_KEY,
+    )
+    num_deleted, _ = stale_placeholders.delete()
+    if num_deleted:
+        log.warning('Deleted %s stale charge placeholder payment(s)', num_deleted)
+    return num_deleted
 
 
 def notify_stuck_pending_payments(older_than: timedelta = DEFAULT_NOTIFY_PENDING_PAYMENTS_AFTER):
-    stuck_payments = SubscriptionPayment.objects.filter(
+    stuck_payments = exclude_charge_placeholders(SubscriptionPayment.objects.filter(
         created__lte=now() - older_than,
         status=SubscriptionPayment.Status.PENDING,
         subscription__isnull=False,  # ignore initial payments (abandoned carts)
-    )
+    ))
     for payment in stuck_payments:
         log.error('Payment stuck in pending state: %s', payment)
 
 
+def _get_charge_candidates(subscriptions: QuerySet | None, schedule: list[timedelta], at: datetime) -> QuerySet:
+    # we don't want to try charging if
+    # 1) there is already ANY charge attempt (successful or not) in current charge period
+    # (so if there was ERROR charge in this period, we will try again only in next period)
+    # 2) there is already any PENDING charge attempt; all charge attempts should end up
+    # being in COMPLETED/ERROR/ABANDONED etc state, and PENDING payments will be garbage-collected
+    # by a separate task
+    # (all of this is checked in a single query, so that only relevant subscriptions reach workers)
+    subscriptions = Subscription.objects.all() if subscriptions is None else subscriptions
+    return subscriptions\
+    .filter(  # noqa
+        auto_prolong=True,
+    ).expiring(
+        since=at - schedule[-1],
+        within=schedule[-1] - schedule[0],
+    ).with_charge_period(
+        schedule,
+        at=at,
+    ).without_charge_attempts(
+    ).select_related(
+        'user', 'plan',
+    ).order_by(
+        'end', 'uid',
+    )
+
+
 def charge_recurring_subscriptions(
     subscriptions: QuerySet | None = None,
     schedule: Iterable[timedelta] = DEFAULT_CHARGE_ATTEMPTS_SCHEDULE,
     num_threads: int | None = None,
     lock: bool = True,
-    # TODO: dry-run
-):
-    # TODO: management command
+    chunk_size: int = 1000,
+    max_in_flight: int | None = None,
+    resume: ChargeRun | None = None,
+    checkpoint_every: int = 100,
+) -> ChargeRunSummary:
+    """
+    Charge subscriptions which are due to be charged according to `schedule`.
+
+    Subscriptions are streamed from DB in chunks of `chunk_size` and handed over
+    to `num_threads` worker threads via a queue holding at most `max_in_flight`
+    subscriptions (defaults to twice the number of threads), so that memory
+    usage doesn't depend on the number of subscriptions being charged.
+    If `num_threads` < 2, subscriptions are charged in the calling thread.
+
+    Progress is saved to a `ChargeRun` every `checkpoint_every` subscriptions.
+    If `resume` is set, subscriptions already processed by that (crashed) run are skipped,
+    and candidates are selected as of the time that run started.
+
+    Use `plan_recurring_charges` to see what would be charged without charging anything.
+    """
+
     log.debug('Background charging according to schedule %s', schedule)
+    summary = ChargeRunSummary(started=now())
+
     schedule = sorted(schedule)
     if not schedule:
-        return
-
-    now_ = now()
+        summary.finished = now()
+        return summary
 
-    subscriptions = Subscription.objects.all() if subscriptions is None else subscriptions
-    expiring_subscriptions = subscriptions\
-    .filter(  # noqa
-        auto_prolong=True,
-    ).expiring(
-        since=now_ - schedule[-1],
-        within=schedule[-1] - schedule[0],
-    ).select_related(
-        'user', 'plan',
-    )
+    now_ = _get_charge_time(resume, summary.started)
+    delete_stale_charge_placeholders()
+    summary.run = run = _start_charge_run(summary.started, resume)
+    progress = _ChargeRunProgress(run, summary.results, checkpoint_every)
 
-    if not expiring_subscriptions.exists():
-        log.debug('No subscriptions to charge')
-        return
+    candidates = _after_key(_get_charge_candidates(subscriptions, schedule, now_), (run.cursor_end, run.cursor_uid))
+    expiring_subscriptions = candidates.iterator(chunk_size=chunk_size)
 
     charge = partial(
         _charge_recurring_subscription,
@@ -176,69 +545,426 @@ def charge_recurring_subscriptions(
         lock=lock,
     )
 
-    if num_threads is not None and num_threads < 2:
-        for subscription in expiring_subscriptions:
-            try:
-                charge(subscription)
-            except Exception:
-                log.exception('Failed to charge subscription %s', subscription)
+    if num_threads is None:
+        num_threads = min(32, (os.cpu_count() or 1) + 4)  # same as ThreadPoolExecutor default
+
+    if num_threads < 2:
+        try:
+            for subscription in expiring_subscriptions:
+                progress.dispatch(subscription)
+                summary.results.append(_charge_and_measure(charge, subscription))
+                if progress.is_due():
+                    progress.checkpoint()
+        finally:
+            progress.checkpoint()
     else:
-        with ThreadPoolExecutor(max_workers=num_threads) as pool:
-            wait(
-                pool.submit(charge, subscription)
-                for subscription in expiring_subscriptions
-            )
+        queue: Queue = Queue(maxsize=max_in_flight or 2 * num_threads)
+        workers = [
+            Thread(
+                target=_charging_worker,
+                kwargs={'charge': charge, 'queue': queue, 'results': summary.results},
+                name=f'charge-recurring-subscriptions-{i}',
+                daemon=True,
+            ) for i in range(num_threads)
+        ]
+        for worker in workers:
+            worker.start()
+
+        try:
+            for subscription in expiring_subscriptions:
+                progress.dispatch(subscription)
+                queue.put(subscription)  # blocks if workers are busy
+                if progress.is_due():
+                    progress.checkpoint()
+        finally:
+            for _ in workers:
+                queue.put(None)
+            for worker in workers:
+                worker.join()
+            progress.checkpoint()
+
+    progress.finish()
+    summary.finished = run.finished
+    _log_charge_run(summary)
+    return summary
+
+
+async def acharge_recurring_subscriptions(
+    subscriptions: QuerySet | None = None,
+    schedule: Iterable[timedelta] = DEFAULT_CHARGE_ATTEMPTS_SCHEDULE,
+    lock: bool = True,
+    chunk_size: int = 1000,
+    max_in_flight: int = 1000,
+    resume: ChargeRun | None = None,
+    checkpoint_every: int = 100,
+) -> ChargeRunSummary:
+    """
+    Asyncio counterpart of `charge_recurring_subscriptions`: up to `max_in_flight` subscriptions
+    are charged concurrently within a single thread. DB queries run in worker threads; provider
+    calls use providers' async API (`Provider.acharge_offline`), so that waiting for provider
+    doesn't occupy a thread. Subscriptions are fetched in chunks of `chunk_size`.
+    """
+
+    log.debug('Background charging according to schedule %s', schedule)
+    summary = ChargeRunSummary(started=now())
+
+    schedule = sorted(schedule)
+    if not schedule:
+        summary.finished = now()
+        return summary
+
+    now_ = await database_sync_to_async(_get_charge_time)(resume, summary.started)
+    await database_sync_to_async(delete_stale_charge_placeholders)()
+    summary.run = run = await database_sync_to_async(_start_charge_run)(summary.started, resume)
+    progress = _ChargeRunProgress(run, summary.results, checkpoint_every)
+
+    candidates = _get_charge_candidates(subscriptions, schedule, now_)
+    charge = partial(
+        _acharge_recurring_subscription,
+        schedule=schedule,
+        at=now_,
+        lock=lock,
+    )
+
+    def fetch_chunk(after: CandidateKey) -> list[Subscription]:
+        # keyset pagination, because charged subscriptions drop out of candidates
+        return list(_after_key(candidates, after)[:chunk_size])
+
+    in_flight = asyncio.Semaphore(max_in_flight)
+    tasks: set[asyncio.Task] = set()
+
+    async def charge_and_release(subscription: Subscription):
+        try:
+            summary.results.append(await _acharge_and_measure(charge, subscription))
+        finally:
+            in_flight.release()
+
+    try:
+        last = (run.cursor_end, run.cursor_uid)
+        while chunk := await database_sync_to_async(fetch_chunk)(last):
+            for subscription in chunk:
+                await in_flight.acquire()  # waits if too many subscriptions are being charged
+                last = progress.dispatch(subscription)
+                task = asyncio.create_task(charge_and_release(subscription))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+                if progress.is_due():
+                    await database_sync_to_async(progress.checkpoint)()
+
+            if len(chunk) < chunk_size:
+                break
+
+        await asyncio.gather(*tasks)
+    finally:
+        # if fetching or dispatching failed, let charges in flight complete, so that their
+        # placeholders are replaced and outcomes are saved before providers are closed
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for provider in get_providers():
+            await provider.aclose()
+        await database_sync_to_async(progress.checkpoint)()
+
+    await database_sync_to_async(progress.finish)()
+    summary.finished = run.finished
+    _log_charge_run(summary)
+    return summary
+
+
+def _log_charge_run(summary: ChargeRunSummary):
+    log.info(
+        'Charged recurring subscriptions in %s (%.1f subscriptions/s): %s',
+        summary.duration,
+        summary.run.throughput or 0,
+        {outcome.value: count for outcome, count in summary.get_counts().items()},
+    )
+
 
+class SkipReason(str, Enum):
+    PROLONGATION_IMPOSSIBLE = 'prolongation_impossible'
+    NO_REFERENCE_PAYMENT = 'no_reference_payment'
+    PROVIDER_NOT_FOUND = 'provider_not_found'
+    PROVIDER_UNAVAILABLE = 'provider_unavailable'
 
-def check_unfinished_payments(within: timedelta = timedelta(hours=12)):
+
+@dataclass
+class ChargePlan:
+    """ What `charge_recurring_subscriptions` would do if it was run at `at`. """
+
+    at: datetime
+    outcomes: Counter[ChargeOutcome] = field(default_factory=Counter)
+    skip_reasons: Counter[SkipReason] = field(default_factory=Counter)  # why subscriptions won't be charged
+    provider_calls: Counter[str] = field(default_factory=Counter)  # provider codename -> number of offline charges
+    amounts: dict[str, Money] = field(default_factory=dict)  # currency -> total amount to be charged
+    duration: timedelta | None = None  # time taken to make the plan
+
+    def get_counts(self) -> dict[ChargeOutcome, int]:
+        return {outcome: self.outcomes[outcome] for outcome in ChargeOutcome}
+
+    def add(self, outcome: ChargeOutcome, reason: SkipReason | None = None):
+        self.outcomes[outcome] += 1
+        if reason:
+            self.skip_reasons[reason] += 1
+
+
+def plan_recurring_charges(
+    subscriptions: QuerySet | None = None,
+    schedule: Iterable[timedelta] = DEFAULT_CHARGE_ATTEMPTS_SCHEDULE,
+    at: datetime | None = None,
+    chunk_size: int = 1000,
+) -> ChargePlan:
+    """
+    Dry run of `charge_recurring_subscriptions`: nothing is locked, charged or saved.
+
+    Candidates are fetched in a single streamed query together with their reference
+    payment's provider, so per-subscription work is done in memory. Outcomes are predicted
+    up to the provider call: whether provider accepts the charge is not known in advance,
+    so every subscription reaching the provider is counted as CHARGED.
+    """
+
+    started = monotonic()
+    at = at or now()
+    plan = ChargePlan(at=at)
+
+    schedule = sorted(schedule)
+    if not schedule:
+        plan.duration = timedelta(seconds=monotonic() - started)
+        return plan
+
+    reference_payments = SubscriptionPayment.objects.filter(
+        subscription=OuterRef('pk'),
+        status=SubscriptionPayment.Status.COMPLETED,
+    ).order_by('-created')
+
+    candidates = _get_charge_candidates(subscriptions, schedule, at).annotate(
+        reference_provider_codename=Subquery(reference_payments.values('provider_codename')[:1]),
+    ).iterator(chunk_size=chunk_size)
+
+    amounts: defaultdict[str, Decimal] = defaultdict(Decimal)
+
+    for subscription in candidates:
+        try:
+            subscription.prolong()
+        except ProlongationImpossible:
+            plan.add(ChargeOutcome.SKIPPED, SkipReason.PROLONGATION_IMPOSSIBLE)
+            continue
+
+        if (codename := subscription.reference_provider_codename) is None:
+            plan.add(ChargeOutcome.FAILED, SkipReason.NO_REFERENCE_PAYMENT)
+            continue
+
+        try:
+            provider = get_provider(codename)
+        except ProviderNotFound:
+            plan.add(ChargeOutcome.FAILED, SkipReason.PROVIDER_NOT_FOUND)
+            continue
+
+        if provider.circuit_breaker.state == CircuitState.OPEN:
+            plan.add(ChargeOutcome.DEFERRED, SkipReason.PROVIDER_UNAVAILABLE)
+            continue
+
+        plan.add(ChargeOutcome.CHARGED)
+        plan.provider_calls[codename] += 1
+        if amount := provider.get_amount(user=subscription.user, plan=subscription.plan):
+            amounts[str(amount.currency)] += amount.amount * subscription.quantity
+
+    plan.amounts = {currency: Money(amount, currency) for currency, amount in sorted(amounts.items())}
+    plan.duration = timedelta(seconds=monotonic() - started)
+    log.info(
+        'Planned recurring charges in %s: %s, provider calls: %s, amounts: %s',
+        plan.duration,
+        {outcome.value: count for outcome, count in plan.get_counts().items()},
+        dict(plan.provider_calls),
+        {currency: str(amount) for currency, amount in plan.amounts.items()},
+    )
+    return plan
+
+
+@dataclass
+class PaymentsCheckResult:
+    codename: str
+    num_payments: int = 0  # backlog: unfinished payments when check started
+    num_still_pending: int = 0  # backlog after check
+    num_batches: int = 0
+    duration: timedelta = timedelta(0)
+    error: str | None = None
+
+
+def _check_provider_payments(codename: str, payments: QuerySet, batch_size: int) -> PaymentsCheckResult:
+    """ Check unfinished `payments` of a single provider in batches, oldest first. """
+
+    started = monotonic()
+    result = PaymentsCheckResult(codename=codename)
+    payments = payments.filter(provider_codename=codename).order_by('created', 'uid')
+
+    try:
+        result.num_payments = payments.count()
+        provider = get_provider(codename)
+
+        last = None
+        while batch := list(_after_created(payments, last)[:batch_size]):
+            provider.check_payments(batch)
+            result.num_batches += 1
+            last = (batch[-1].created, batch[-1].uid)
+
+        result.num_still_pending = payments.count()
+    except ProviderUnavailable as exc:
+        log.warning('Skipping check of unfinished payments for provider "%s": %s', codename, exc)
+        result.error = str(exc)
+    except Exception as exc:
+        # don't let one provider break reconciliation of others
+        log.exception('Failed to check unfinished payments for provider "%s"', codename)
+        result.error = str(exc)
+
+    result.duration = timedelta(seconds=monotonic() - started)
+    log.info(
+        'Checked unfinished payments of provider "%s" in %s: %s payments in %s batches, %s still pending',
+        codename, result.duration, result.num_payments, result.num_batches, result.num_still_pending,
+    )
+    return result
+
+
+def _check_provider_payments_in_thread(*args, **kwargs) -> PaymentsCheckResult:
+    try:
+        return _check_provider_payments(*args, **kwargs)
+    finally:
+        # each thread has its own DB connections, which won't be reused after thread exits
+        connections.close_all()
+
+
+def _after_created(payments: QuerySet, key: tuple[datetime, UUID] | None) -> QuerySet:
+    if key is None:
+        return payments
+
+    created, uid = key
+    return payments.filter(Q(created__gt=created) | Q(created=created, uid__gt=uid))
+
+
+def check_unfinished_payments(
+    within: timedelta = timedelta(hours=12),
+    batch_size: int = 100,
+    max_workers: int | None = None,
+) -> dict[str, PaymentsCheckResult]:
     """
     Reverse-check payment status: if payment webhook didn't pass through
     for some reason, ask payment provider about payment status, and
     update SubscriptionPayment status if needed.
+
+    Providers are checked concurrently (by default, in a thread per provider),
+    so that a slow provider doesn't delay others; each provider gets at most
+    `batch_size` payments at once.
     """
 
     log.debug('Fetching status of unfinished payments')
     now_ = now()
-    unfinished_payments = SubscriptionPayment.objects.filter(
+    unfinished_payments = exclude_charge_placeholders(SubscriptionPayment.objects.filter(
         created__gte=now_ - within,
         status=SubscriptionPayment.Status.PENDING,
-    )
+    ))
 
-    codenames = set(unfinished_payments.order_by('provider_codename').values_list('provider_codename', flat=True))
+    codenames = sorted(set(unfinished_payments.order_by('provider_codename').values_list('provider_codename', flat=True)))
+    kwargs = {'payments': unfinished_payments, 'batch_size': batch_size}
 
-    for codename in codenames:
-        get_provider(codename).check_payments(
-            unfinished_payments.filter(provider_codename=codename)
-        )
+    if len(codenames) < 2 or max_workers == 1:
+        results = [_check_provider_payments(codename, **kwargs) for codename in codenames]
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers or len(codenames), thread_name_prefix='check-unfinished-payments') as pool:
+            results = list(pool.map(partial(_check_provider_payments_in_thread, **kwargs), codenames))
 
+    return {result.codename: result for result in results}
 
-def check_duplicated_payments() -> dict[tuple[str, str], list[SubscriptionPayment]]:
-    # This is rather massive as it's checking all operations.
-    all_entries = SubscriptionPayment.objects.prefetch_related('subscription').all()
 
-    transaction_id_to_entries: defaultdict[tuple[str, str], list[SubscriptionPayment]] = defaultdict(list)
-    for entry in all_entries:
-        # This happens for e.g.: unconfirmed paddle. We don't worry about these.
-        if entry.provider_transaction_id is None:
-            continue
-        key = (entry.provider_codename, entry.provider_transaction_id)
-        transaction_id_to_entries[key].append(entry)
+def iter_duplicated_payments(
+    since: datetime | None = None,
+    chunk_size: int = 1000,
+) -> Iterator[tuple[tuple[str, str], list[SubscriptionPayment]]]:
+    """
+    Yield `(provider_codename, provider_transaction_id)` and payments sharing it,
+    for every such pair used by more than one payment. Pairs are found with
+    a single GROUP BY query, and only payments of duplicated pairs are fetched,
+    `chunk_size` pairs at a time. If `since` is set, only pairs with a payment
+    created since then are checked.
+    """
+
+    # unconfirmed payments (e.g. paddle) have no transaction id, we don't worry about these
+    duplicated_keys = (
+        SubscriptionPayment.objects
+        .filter(provider_transaction_id__isnull=False)
+        .values_list('provider_codename', 'provider_transaction_id')
+        .annotate(num_payments=Count('*'), last_created=Max('created'))
+        .filter(num_payments__gt=1)
+        .order_by('provider_codename', 'provider_transaction_id')
+    )
+    if since:
+        duplicated_keys = duplicated_keys.filter(last_created__gte=since)
+
+    keys = (row[:2] for row in duplicated_keys.iterator(chunk_size=chunk_size))
+    for keys_chunk in chunked(keys, chunk_size):
+        payments = (
+            SubscriptionPayment.objects
+            .filter(reduce(or_, (
+                Q(provider_codename=codename, provider_transaction_id=transaction_id)
+                for codename, transaction_id in keys_chunk
+            )))
+            .order_by('provider_codename', 'provider_transaction_id', 'created')
+            .iterator(chunk_size=chunk_size)
+        )
+        for key, entries in groupby(payments, key=attrgetter('provider_codename', 'provider_transaction_id')):
+            yield key, list(entries)
 
-    result = {}
-    for (provider_codename, transaction_id), transaction_id_entries in transaction_id_to_entries.items():
-        # Single entry – no issue.
-        if len(transaction_id_entries) == 1:
-            continue
 
+def check_duplicated_payments(since: datetime | None = None) -> dict[tuple[str, str], list[SubscriptionPayment]]:
+    result = {}
+    for (provider_codename, transaction_id), entries in iter_duplicated_payments(since=since):
         log.info('Found transaction ID: %s provider: %s with %s duplicates.',
-                 transaction_id, provider_codename, len(transaction_id_entries))
+                 transaction_id, provider_codename, len(entries))
 
-        for idx, entry in enumerate(transaction_id_entries):
+        for idx, entry in enumerate(entries):
             log.info('\t%s: Subscription UID: %s, payment UID: %s',
-                     (idx + 1), entry.subscription.uid, entry.uid)
+                     (idx + 1), entry.subscription_id, entry.uid)
 
-        result[(provider_codename, transaction_id)] = transaction_id_entries
+        result[(provider_codename, transaction_id)] = entries
 
     return result
 
+
+def update_report_snapshots(since: date | None = None, refresh_period: timedelta = DEFAULT_REPORT_SNAPSHOTS_REFRESH_PERIOD) -> list[date]:
+    """
+    Materialize daily report snapshots (see `SubscriptionsReport.make_snapshot` and
+    `TransactionsReport.make_snapshots`) for closed UTC days, starting with `since`,
+    or with last `refresh_period` before the latest snapshot, or with the first
+    subscription or payment. Snapshots are replaced, so running this again is safe.
+    Returns snapshotted days.
+    """
+
+    if since is None:
+        with suppress(SubscriptionsSnapshot.DoesNotExist):
+            since = SubscriptionsSnapshot.objects.latest().date - refresh_period
+
+    if since is None:
+        first_dates = [
+            value for value in (
+                Subscription.objects.aggregate(value=Min('start'))['value'],
+                SubscriptionPayment.objects.aggregate(value=Min('created'))['value'],
+            )
+            if value is not None
+        ]
+        if not first_dates:
+            return []
+        since = min(first_dates).astimezone(timezone.utc).date()
+
+    today = now().astimezone(timezone.utc).date()
+    days = [since + timedelta(days=i) for i in range((today - since).days)]
+
+    for day in days:
+        subscriptions_snapshot = SubscriptionsReport.make_snapshot(day)
+        payments_snapshots = TransactionsReport.make_snapshots(day)
+
+        with transaction.atomic():
+            subscriptions_snapshot.save()
+            PaymentsSnapshot.objects.filter(date=day).delete()
+            PaymentsSnapshot.objects.bulk_create(payments_snapshots)
+
+    log.info('Updated report snapshots for %s days since %s', len(days), since)
+    return days
+
 # TODO: check for concurrency issues, probably add transactions
@@ -1,10 +1,11 @@
 from django.urls import path
 
-from .views import PlanListView, PlanSubscriptionSuccessView, PlanSubscriptionView, PlanView
+from .views import PlanListView, PlanSubscriptionSuccessView, PlanSubscriptionView, PlanView, ReportExportView
 
 urlpatterns = [
     path('', PlanListView.as_view(), name='plan_list'),
     path('<int:plan_id>/', PlanView.as_view(), name='plan'),  # TODO
     path('<int:plan_id>/subscribe/', PlanSubscriptionView.as_view(), name='plan_subscription'),
     path('success', PlanSubscriptionSuccessView.as_view(), name='plan_subscription_success'),
+    path('reports/export/', ReportExportView.as_view(), name='report_export'),
 ]
@@ -3,11 +3,13 @@ from __future__ import annotations
 import hashlib
 import logging
 from datetime import datetime
-from typing import Callable, Iterable, Iterator, TypeVar
+from functools import wraps
+from typing import Awaitable, Callable, Iterable, Iterator, TypeVar
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.serializers.json import DjangoJSONEncoder
-from django.db import connections, models, transaction, router
+from django.db import close_old_connections, connections, models, transaction, router
 from djmoney.money import Money
 from environs import Env
 
@@ -51,6 +53,24 @@ def merge_iter(*iterables: Iterable[T], key: Callable = lambda x: x) -> Iterator
             del values[iterable]
 
 
+def database_sync_to_async(fn: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    """
+    Run `fn` in a worker thread, so that event loop is not blocked by DB queries.
+    Worker thread's DB connections are treated the same way as for each http request:
+    they are closed if broken or exceeded CONN_MAX_AGE.
+    """
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return sync_to_async(wrapper, thread_sensitive=False)
+
+
 def fromisoformat(value: str) -> datetime:
     return datetime.fromisoformat(value.replace('Z', '+00:00'))
 
@@ -1,11 +1,14 @@
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.core.exceptions import ValidationError
-from django.http import Http404
-from django.views.generic import DetailView, ListView, TemplateView
+from django.http import Http404, HttpResponseBadRequest, StreamingHttpResponse
+from django.utils.timezone import now
+from django.views.generic import DetailView, ListView, TemplateView, View
 
 from .exceptions import PaymentError, ProviderNotFound
 from .models import Plan
 from .providers import get_provider
+from .reports import EXPORT_FORMATS, export_report
+from .utils import fromisoformat
 
 
 class PlanListView(ListView):
@@ -50,3 +53,33 @@ class PlanSubscriptionView(LoginRequiredMixin, PlanView):
 
 class PlanSubscriptionSuccessView(TemplateView):
     template_name = 'subscriptions/subscribe-success.html'
+
+
+class ReportExportView(LoginRequiredMixin, UserPassesTestMixin, View):
+    """
+    Stream report rows as CSV or NDJSON (staff only), e.g.
+    ?report=transactions&kind=completed&provider=paddle&since=2023-01-01T00:00:00Z&format=ndjson
+    """
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        params = request.GET
+        format = params.get('format', 'csv')
+        try:
+            lines = export_report(
+                report=params.get('report', ''),
+                kind=params.get('kind', ''),
+                since=fromisoformat(params.get('since', '')),
+                until=fromisoformat(params['until']) if params.get('until') else now(),
+                format=format,
+                provider_codename=params.get('provider', ''),
+            )
+        except ValueError as exc:
+            return HttpResponseBadRequest(str(exc))
+
+        _, content_type = EXPORT_FORMATS[format]
+        response = StreamingHttpResponse(lines, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{params["report"]}-{params["kind"]}.{format}"'
+        return response